@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
+from experiment import prepare_argument_parser, set_up_experiment
+import candidates
+
+# Compare speed and recall@K of candidate search backends against the exact search.
+# Dictionary can be enlarged by a smaller -patch_size or a larger -patch_overlap.
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser()
+    args, _ = argparser.parse_known_args()
+
+    patches, em = set_up_experiment(args)
+    observed = patches.compact_observed_vectors
+    dictionary = patches.compact_dictionary_vectors
+    k = args.num_candidates
+
+    backends = [
+        ("exact", candidates.ExactSearch(block_size=args.candidate_block_size)),
+        ("kdtree", candidates.KDTreeSearch()),
+    ] + [
+        ("ivf_probes={}".format(probes), 
+         candidates.IVFSearch(lists=args.ivf_lists, probes=probes, seed=args.random_seed))
+        for probes in [1, 2, 4, 8, 16]
+    ]
+
+    exact_indices, _ = candidates.nearest_candidates(observed, dictionary, k)
+
+    with open(os.path.join(args.output, "candidate_search.txt"), "w") as f:
+        f.write("backend fit_seconds search_seconds recall_at_k\n")
+        for name, search in backends:
+            start = time.time()
+            search.fit(dictionary)
+            fit_seconds = time.time() - start
+            start = time.time()
+            indices, _ = search.search(observed, k)
+            search_seconds = time.time() - start
+
+            line = "{} {:.4f} {:.4f} {:.4f}".format(
+                name, fit_seconds, search_seconds, candidates.recall_at_k(indices, exact_indices))
+            print(line)
+            f.write(line + "\n")
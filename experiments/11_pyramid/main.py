@@ -0,0 +1,51 @@
+import copy
+import os
+import sys
+import time
+
+import numpy as np
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
+from experiment import prepare_argument_parser, set_up_experiment, run_em
+from pyramid import add_pyramid_arguments, run_pyramid
+
+# Compare runtime and results of EM on the full resolution against the coarse-to-fine 
+# pyramid, which runs -pyramid_iterations on coarser levels and only -refine_iterations 
+# on the full resolution. Differences of MAP images are measured against the full 
+# resolution EM. Larger images show larger speedups.
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser()
+    add_pyramid_arguments(argparser)
+    argparser.add_argument("-refine_iterations", type=int, default=1, 
+        help="Number of EM iterations of the pyramid on the full resolution.")
+    args, _ = argparser.parse_known_args()
+    output = args.output
+
+    start = time.time()
+    full_args = copy.copy(args)
+    full_args.output = os.path.join(output, "full_resolution")
+    patches, em = set_up_experiment(full_args)
+    log_posteriors = run_em(full_args, em)
+    results = [("full_resolution", time.time() - start, log_posteriors[-1], 
+                em.compute_maximized_term(), em.MAP_image())]
+
+    for levels in [2, 3, 4]:
+        start = time.time()
+        pyramid_args = copy.copy(args)
+        pyramid_args.output = os.path.join(output, "pyramid_{}".format(levels))
+        pyramid_args.pyramid_levels = levels
+        pyramid_args.em_iterations = args.refine_iterations
+        em, log_posteriors = run_pyramid(pyramid_args)
+        results.append(("pyramid_levels={}".format(levels), time.time() - start, 
+                        log_posteriors[-1], em.compute_maximized_term(), em.MAP_image()))
+
+    with open(os.path.join(output, "pyramid.txt"), "w") as f:
+        f.write("method seconds speedup log_posterior maximized_term MAP_rmse\n")
+        for name, seconds, log_posterior, maximized_term, image in results:
+            line = "{} {:.3f} {:.2f} {:.6g} {:.6g} {:.4f}".format(
+                name, seconds, results[0][1] / seconds, log_posterior, maximized_term, 
+                np.sqrt(np.mean((image - results[0][4]) ** 2)))
+            print(line)
+            f.write(line + "\n")
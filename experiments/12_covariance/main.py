@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.misc import imsave
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
+from experiment import prepare_argument_parser
+from sweep import sweep_points, run_sweep
+from em import EM
+
+# Compare structures of covariances of patch noise: time of recomputing psis 
+# (M step) and of posteriors (E step), memory of covariance factors and log 
+# a posterior probability. Patches and candidates are shared by all 
+# structures. Run with -workers=1 for comparable times.
+
+def run_experiment(args, patches, em):
+    psis_seconds, posteriors_seconds = 0, 0
+    for i in range(args.em_iterations):
+        em.loopy()
+        start = time.time()
+        em.compute_posteriors()
+        em.recompute_lambdas()
+        middle = time.time()
+        em.recompute_psis()
+        end = time.time()
+        em.compute_posteriors()
+        psis_seconds += end - middle
+        posteriors_seconds += time.time() - end
+        imsave(os.path.join(args.output, "{}.png".format(i + 1)), em.MAP_image())
+        print("EM iteration {}, log a posterior: {}".format(
+            i + 1, em.log_a_posterior_probability()))
+
+    return {
+        "psis_seconds": "{:.3f}".format(psis_seconds / args.em_iterations),
+        "posteriors_seconds": "{:.3f}".format(posteriors_seconds / args.em_iterations),
+        "psis_mb": "{:.3f}".format(sum(
+            value.nbytes for value in vars(em.psi_factors).values()) / 2 ** 20),
+        "log_posterior": "{:.6g}".format(em.log_a_posterior_probability()),
+        "maximized_term": "{:.6g}".format(em.compute_maximized_term()),
+    }
+
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser()
+    argparser.add_argument("-workers", type=int, default=1, 
+        help="Number of processes running EM for different structures (0 = all cores).")
+    args, _ = argparser.parse_known_args()
+
+    points = sweep_points(argparser, sys.argv[1:], 
+                          [("covariance", list(EM.psi_estimators.keys()))])
+    run_sweep(points, run_experiment, args.output, workers=args.workers, 
+              cache_dir=args.cache_dir)
@@ -0,0 +1,77 @@
+import copy
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.misc import imread, imsave
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
+from experiment import prepare_argument_parser, set_up_experiment, run_em, prepare_style_model
+from sequence import add_sequence_arguments, run_sequence
+import utils
+
+# Compare translation of each frame of a sequence from scratch against the sequence mode,
+# which starts every frame from EM of the previous one. Frames are made from the input
+# image with a block of it moving across, so that most patches stay the same. Differences
+# of MAP images are measured against translations from scratch.
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser()
+    add_sequence_arguments(argparser)
+    argparser.add_argument("-frames", type=int, default=6,
+        help="Number of frames.")
+    argparser.add_argument("-block_step", type=int, default=8,
+        help="Number of pixels the block moves by in each frame.")
+    args, _ = argparser.parse_known_args()
+    output = args.output
+
+    image = imread(args.input, mode="RGB")
+    size = min(image.shape[:2]) // 4
+    frames_dir = os.path.join(output, "input_frames")
+    if not os.path.exists(frames_dir):
+        os.makedirs(frames_dir)
+    for i in range(args.frames):
+        frame = image.copy()
+        x = min(i * args.block_step, image.shape[1] - size)
+        frame[size:(2 * size), x:(x + size)] = image[:size, -size:]
+        imsave(os.path.join(frames_dir, "{:04d}.png".format(i)), frame)
+
+    sequence_args = copy.copy(args)
+    sequence_args.inputs = frames_dir
+    sequence_args.output = os.path.join(output, "sequence")
+    summaries = run_sequence(sequence_args)
+
+    results = []
+    scratch_args = copy.copy(args)
+    scratch_args.output = os.path.join(output, "scratch")
+    scratch_args.resume = None
+    if not os.path.exists(scratch_args.output):
+        os.makedirs(scratch_args.output)
+    prepare_style_model(scratch_args)
+    for i, summary in enumerate(summaries):
+        start = time.time()
+        frame_args = copy.copy(scratch_args)
+        frame_args.input = os.path.join(frames_dir, "{:04d}.png".format(i))
+        frame_args.output = os.path.join(scratch_args.output, summary["frame"])
+        patches, em = set_up_experiment(frame_args)
+        log_posteriors = run_em(frame_args, em)
+        seconds = time.time() - start
+        scratch_image = utils.load_image_rgb(os.path.join(
+            frame_args.output, "{}.png".format(args.em_iterations)))
+        sequence_image = utils.load_image_rgb(os.path.join(
+            sequence_args.output, "frames", "{}.png".format(summary["frame"])))
+        results.append((summary, seconds, log_posteriors[-1],
+                        np.sqrt(np.mean((scratch_image - sequence_image) ** 2))))
+
+    with open(os.path.join(output, "sequence.txt"), "w") as f:
+        f.write("frame start changed_patches scratch_seconds sequence_seconds speedup "
+                "scratch_log_posterior sequence_log_posterior MAP_rmse\n")
+        for summary, seconds, log_posterior, rmse in results:
+            line = "{} {} {} {:.3f} {} {:.2f} {:.6g} {} {:.4f}".format(
+                summary["frame"], summary["start"], summary["changed_patches"], seconds,
+                summary["seconds"], seconds / float(summary["seconds"]), log_posterior,
+                summary["final_log_posterior"], rmse)
+            print(line)
+            f.write(line + "\n")
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.misc import imsave
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
+from experiment import prepare_argument_parser
+from sweep import sweep_points, run_sweep
+
+# Compare EM without pruning of candidates against pruning by a threshold and
+# by a mass of posteriors: time of EM iterations, pairwise potentials
+# evaluated by loopy, mean number of candidates of a patch after the last
+# iteration and log a posterior probability. Patches and candidates are
+# shared by all rules. Run with -workers=1 for comparable times.
+
+def run_experiment(args, patches, em):
+    seconds, potentials = 0, 0
+    for i in range(args.em_iterations):
+        start = time.time()
+        em.execute_iteration()
+        seconds += time.time() - start
+        potentials += em.lbp_statistics["potentials"]
+        imsave(os.path.join(args.output, "{}.png".format(i + 1)), em.MAP_image())
+        print("EM iteration {}, log a posterior: {}".format(
+            i + 1, em.log_a_posterior_probability()))
+
+    return {
+        "iteration_seconds": "{:.3f}".format(seconds / args.em_iterations),
+        "loopy_potentials": str(potentials),
+        "mean_candidates": "{:.2f}".format(
+            np.mean(np.sum(em.candidate_mask(), axis=1))),
+        "log_posterior": "{:.6g}".format(em.log_a_posterior_probability()),
+    }
+
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser()
+    argparser.add_argument("-workers", type=int, default=1,
+        help="Number of processes running EM for different rules (0 = all cores).")
+    args, _ = argparser.parse_known_args()
+
+    points = sweep_points(argparser, sys.argv[1:],
+                          [("prune", ["none", "threshold", "mass"])])
+    run_sweep(points, run_experiment, args.output, workers=args.workers,
+              cache_dir=args.cache_dir)
@@ -1,28 +1,30 @@
 import os
 import sys
 
-import numpy as np
 from scipy.misc import imsave
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
-from experiment import prepare_argument_parser, set_up_experiment
-from patches import plot_patch_vectors
+from experiment import prepare_argument_parser
+from sweep import sweep_points, run_sweep
 
-def run_experiment(args):
-    patches, em = set_up_experiment(args)
-    
+# Patches, candidates and potentials of each sigma are computed once, EM runs of
+# sigmas run in parallel on -workers processes.
+
+def run_experiment(args, patches, em):
     for i in range(1, args.em_iterations + 1):
         print("Executing EM iteration", i)
         em.execute_iteration()
     imsave(os.path.join(args.output, str(args.lbp_two_sigma2) + ".png"), em.MAP_image())
+    return {"log_posterior": em.log_a_posterior_probability()}
 
 if __name__ == "__main__":
     argparser = prepare_argument_parser()
+    argparser.add_argument("-workers", type=int, default=1, 
+        help="Number of processes running EM for different sigmas (0 = all cores).")
     args, _ = argparser.parse_known_args()
 
-    for two_sigma2 in [1e-4, 0.001, 0.01, 0.1, 1, 10, 100]: 
-        args.lbp_two_sigma2 = two_sigma2
-        run_experiment(args)
-
-    
\ No newline at end of file
+    points = sweep_points(argparser, sys.argv[1:], 
+                          [("lbp_two_sigma2", [1e-4, 0.001, 0.01, 0.1, 1, 10, 100])])
+    run_sweep(points, run_experiment, args.output, workers=args.workers, 
+              cache_dir=args.cache_dir)
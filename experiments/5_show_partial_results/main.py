@@ -5,7 +5,7 @@ from scipy.misc import imsave
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
-from experiment import prepare_argument_parser, set_up_experiment
+from experiment import prepare_argument_parser, set_up_experiment, save_checkpoint_if_due
 
 
 if __name__ == "__main__":
@@ -17,7 +17,7 @@ if __name__ == "__main__":
     imsave(os.path.join(args.output, "0_initial.png"), em.MAP_image())
     print("Initial log a posterior:", em.log_a_posterior_probability())
     
-    for i in range(1, args.em_iterations + 1):
+    for i in range(em.iteration + 1, args.em_iterations + 1):
         print("Executing EM iteration", i)
         
         print("staring loopy")
@@ -34,4 +34,6 @@ if __name__ == "__main__":
         imsave(os.path.join(args.output, "{}.3.max.png".format(i)), em.MAP_image())
 
         print("Log a posterior:", em.log_a_posterior_probability())
+        em.iteration = i
+        save_checkpoint_if_due(args, em)
     
\ No newline at end of file
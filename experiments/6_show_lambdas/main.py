@@ -6,14 +6,15 @@ from scipy.misc import imsave, toimage
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
-from experiment import prepare_argument_parser, set_up_experiment
+from experiment import prepare_argument_parser
 from patches import plot_patch_vectors
+from sweep import sweep_points, run_sweep
 from em import EM
 
+# Patches and candidates are shared by all initializations, which run in 
+# parallel on -workers processes.
 
-def run_experiment(args):
-    patches, em = set_up_experiment(args)
-
+def run_experiment(args, patches, em):
     imsave(os.path.join(args.output, "0_initial.png"), em.MAP_image())
     print("Initial log a posterior:", em.log_a_posterior_probability())
     
@@ -47,16 +48,18 @@ def run_experiment(args):
             em.execute_iteration()
             imsave(os.path.join(args.output, "{}_iter_MAP_image.png".format(i+1)), em.MAP_image())
             print("Log a posterior:", em.log_a_posterior_probability())
+
+    return {"log_posterior": em.log_a_posterior_probability()}
     
 
 if __name__ == "__main__":
     argparser = prepare_argument_parser()
+    argparser.add_argument("-workers", type=int, default=1, 
+        help="Number of processes running EM for different initializations (0 = all cores).")
     args, _ = argparser.parse_known_args()
-    
-    output = args.output
 
-    for init_type in EM.lambdas_init_dict.keys():
-        args.init_transformations = init_type
-        args.output = output + "_" + init_type
-        run_experiment(args)
+    points = sweep_points(argparser, sys.argv[1:], 
+                          [("init_transformations", list(EM.lambdas_init_dict.keys()))])
+    run_sweep(points, run_experiment, args.output, workers=args.workers, 
+              cache_dir=args.cache_dir)
     
\ No newline at end of file
@@ -5,7 +5,7 @@ from scipy.misc import imsave
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
-from experiment import prepare_argument_parser, set_up_experiment
+from experiment import prepare_argument_parser, set_up_experiment, save_checkpoint_if_due
 
 
 if __name__ == "__main__":
@@ -14,7 +14,7 @@ if __name__ == "__main__":
     
     patches, em = set_up_experiment(args)
 
-    for i in range(1, args.em_iterations + 1):
+    for i in range(em.iteration + 1, args.em_iterations + 1):
         print("Executing EM iteration", i)
         
         print("staring loopy")
@@ -30,3 +30,5 @@ if __name__ == "__main__":
         em.compute_posteriors()
         
         imsave(os.path.join(args.output, "{}.png".format(i)), em.MAP_image())
+        em.iteration = i
+        save_checkpoint_if_due(args, em)
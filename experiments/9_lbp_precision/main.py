@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
+from experiment import prepare_argument_parser, set_up_experiment
+from em import lbp_precision_dtypes
+
+# Compare speed and accuracy of loopy belief propagation computed with different
+# number types against long double results, for a range of sigmas.
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser()
+    args, _ = argparser.parse_known_args()
+
+    patches, em = set_up_experiment(args)
+
+    with open(os.path.join(args.output, "precision.txt"), "w") as f:
+        f.write("two_sigma2 precision seconds max_abs_error MAP_agreement nan_rows\n")
+        for two_sigma2 in [1e-4, 0.001, 0.01, 0.1, 1, 10, 100]:
+            em.lbp_params["two_sigma2"] = two_sigma2
+            results = dict()
+            precisions = sorted(lbp_precision_dtypes.keys(), key=lambda p: p != "longdouble")
+            for precision in precisions:
+                em.lbp_params["precision"] = precision
+                em.pairwise_potentials()
+                start = time.time()
+                em.loopy()
+                seconds = time.time() - start
+                results[precision] = em.loopy_probs
+
+                reference = results["longdouble"]
+                nan_rows = np.isnan(em.loopy_probs).any(axis=1)
+                valid = ~(nan_rows | np.isnan(reference).any(axis=1))
+                error = np.max(np.abs(em.loopy_probs - reference)[valid], initial=0)
+                agreement = np.mean(
+                    em.loopy_probs.argmax(axis=1)[valid] == reference.argmax(axis=1)[valid]
+                ) if valid.any() else 0
+                line = "{} {} {:.4f} {:.3g} {:.4f} {}".format(
+                    two_sigma2, precision, seconds, error, agreement, np.sum(nan_rows))
+                print(line)
+                f.write(line + "\n")
@@ -1,6 +1,6 @@
 from distutils.core import setup, Extension
 
-module = Extension('loopy', sources=['src/loopy_belief_propagation/loopy.cpp'], extra_compile_args=['-std=c++11'])
+module = Extension('loopy', sources=['src/loopy_belief_propagation/loopy.cpp'], extra_compile_args=['-std=c++11', '-pthread'], extra_link_args=['-pthread'])
 
 setup (name = 'loopy',
        version = '1.0',
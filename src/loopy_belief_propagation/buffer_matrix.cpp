@@ -0,0 +1,142 @@
+#ifndef CPP_BUFFER_MATRIX
+#define CPP_BUFFER_MATRIX
+
+#include <Python.h>
+#include <cstring>
+#include <vector>
+
+using namespace std;
+
+// Row-major 2D matrix stored in a contiguous block of memory which is owned
+// by someone else (a Python buffer or a flattened vector).
+template<class T>
+struct MatrixView {
+    T* data;
+    int rows;
+    int cols;
+
+    MatrixView(): data(NULL), rows(0), cols(0) {}
+
+    MatrixView(T* data, int rows, int cols)
+    : data(data), rows(rows), cols(cols) {}
+
+    T* row(int r) {
+        return data + (long long)r * cols;
+    }
+
+    T& at(int r, int c) {
+        return data[(long long)r * cols + c];
+    }
+};
+
+// Converts 2D vector with rows of equal length into a single flat vector,
+// so that it can be accessed through a MatrixView.
+template<class T>
+vector<T> flatten_matrix(vector<vector<T> > &matrix) {
+    vector<T> flat;
+    for (int row = 0; row < int(matrix.size()); row++) {
+        flat.insert(flat.end(), matrix[row].begin(), matrix[row].end());
+    }
+    return flat;
+}
+
+// Struct-module format characters of supported element types.
+template<class T> const char* buffer_format();
+template<> const char* buffer_format<unsigned char>() { return "B"; }
+template<> const char* buffer_format<int>() { return "i"; }
+template<> const char* buffer_format<float>() { return "f"; }
+template<> const char* buffer_format<double>() { return "d"; }
+template<> const char* buffer_format<long double>() { return "g"; }
+
+// Skips native byte order / alignment prefixes of a format string.
+const char* skip_format_prefix(const char *format) {
+    while (*format == '@' || *format == '=' || *format == '<') {
+        format++;
+    }
+    return format;
+}
+
+// Returns the format character of elements of a Python buffer (e.g. 'd' for
+// a float64 NumPy array), so that the element type can be chosen at runtime.
+// Returns 0 and sets a Python exception if the object is not a buffer.
+char buffer_element_format(PyObject *object) {
+    Py_buffer buffer;
+    if (PyObject_GetBuffer(object, &buffer, PyBUF_RECORDS_RO) != 0) {
+        return 0;
+    }
+    char format = buffer.format == NULL ? 
+        'B' : skip_format_prefix(buffer.format)[0];
+    PyBuffer_Release(&buffer);
+    return format;
+}
+
+// Holds a buffer exported by a C-contiguous 2D Python object (e.g. NumPy
+// array) independently of its element type.
+struct BufferMatrixBase {
+    Py_buffer buffer;
+    bool acquired;
+
+    BufferMatrixBase(): acquired(false) {}
+
+    virtual ~BufferMatrixBase() {
+        release();
+    }
+
+    // Acquires the buffer of "object". Returns false and sets a Python
+    // exception if the object is not a contiguous 2D array of elements with
+    // given format and size.
+    bool acquire_with_format(PyObject *object, const char *name, 
+                             bool writable, const char *expected_format, 
+                             int itemsize) {
+        int flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT;
+        if (writable) {
+            flags |= PyBUF_WRITABLE;
+        }
+        if (PyObject_GetBuffer(object, &buffer, flags) != 0) {
+            return false;
+        }
+        acquired = true;
+
+        const char *format = skip_format_prefix(buffer.format);
+        if (buffer.ndim != 2 || strcmp(format, expected_format) != 0 ||
+            buffer.itemsize != itemsize) {
+            PyErr_Format(PyExc_ValueError,
+                "%s must be a C-contiguous 2D array of type '%s'",
+                name, expected_format);
+            release();
+            return false;
+        }
+        return true;
+    }
+
+    void release() {
+        if (acquired) {
+            PyBuffer_Release(&buffer);
+            acquired = false;
+        }
+    }
+
+    int rows() {
+        return int(buffer.shape[0]);
+    }
+
+    int cols() {
+        return int(buffer.shape[1]);
+    }
+};
+
+// Buffer of a C-contiguous 2D Python object with elements of type T, whose 
+// memory is exposed as a MatrixView without copying it.
+template<class T>
+struct BufferMatrix : BufferMatrixBase {
+    bool acquire(PyObject *object, const char *name, bool writable) {
+        return acquire_with_format(
+            object, name, writable, buffer_format<T>(), sizeof(T));
+    }
+
+    MatrixView<T> view() {
+        return MatrixView<T>((T*)buffer.buf, rows(), cols());
+    }
+};
+
+#endif
@@ -4,6 +4,8 @@
 #include <iostream>
 #include <vector>
 
+#include "buffer_matrix.cpp"
+
 using namespace std;
 
 typedef long double ld;
@@ -60,9 +62,11 @@ void test_overlap_distances(vector<DictionaryPatch> &dictionary_patches) {
     } 
 }
 
-// Converts list of dictionary patch vectors into a list of DictionaryPatch.
+// Converts matrix of dictionary patch vectors (one patch per row) into a list
+// of DictionaryPatch.
+template<class T>
 vector<DictionaryPatch> prepare_dictionary_patches(
-    vector<vector<int> > &patch_vectors, int patch_size, int patch_overlap) {
+    MatrixView<T> patch_vectors, int patch_size, int patch_overlap) {
     int y0_for_direction[4] = {0, 0, patch_size - patch_overlap, 0};
     int dy_for_direction[4] = {
         patch_overlap, patch_size, patch_overlap, patch_size};
@@ -72,14 +76,14 @@ vector<DictionaryPatch> prepare_dictionary_patches(
 
     vector<DictionaryPatch> dictionary_patches;
 
-    for (int id = 0; id < int(patch_vectors.size()); id++) {
+    for (int id = 0; id < patch_vectors.rows; id++) {
         DictionaryPatch patch;
         
         // Converts a vector of pixels int 2D vector of pixel values.
         vector<vector<int> > pixel_values(patch_size, vector<int>(patch_size));
         for (int i=0; i<patch_size; i++) {
             for (int j=0; j<patch_size; j++) {
-                pixel_values[i][j] = patch_vectors[id][i * patch_size + j];
+                pixel_values[i][j] = patch_vectors.at(id, i * patch_size + j);
             }
         }
 
@@ -108,4 +112,55 @@ vector<DictionaryPatch> prepare_dictionary_patches(
     return dictionary_patches;
 }
 
+// Overlapping regions of all dictionary patches in a compact layout: a matrix
+// of 8-bit pixels with one row per dictionary patch, which holds its top, 
+// right, bottom and left region one after another, each in the order of 
+// DictionaryPatch::overlapping_region_pixels. The matrix can be computed 
+// once for a source image and stored (see overlap_strips in loopy.cpp).
+struct OverlapStrips {
+    MatrixView<unsigned char> pixels;
+    int region_size;
+    // Sums of squared pixel values of each region, 4 per dictionary patch.
+    vector<long long> norms;
+
+    OverlapStrips(MatrixView<unsigned char> pixels)
+    : pixels(pixels), region_size(pixels.cols / 4), norms(4LL * pixels.rows) {
+        for (int id = 0; id < pixels.rows; id++) {
+            for (int direction = 0; direction < 4; direction++) {
+                unsigned char *values = region(id, direction);
+                long long norm = 0;
+                for (int x = 0; x < region_size; x++) {
+                    norm += values[x] * values[x];
+                }
+                norms[4 * id + direction] = norm;
+            }
+        }
+    }
+
+    unsigned char* region(int id, int direction) {
+        return pixels.row(id) + direction * region_size;
+    }
+
+    long long norm(int id, int direction) {
+        return norms[4 * id + direction];
+    }
+};
+
+// Writes overlapping regions of dictionary patches into the OverlapStrips 
+// matrix "strips" of shape (dictionary size, 4 * region size). Pixel values 
+// are expected to be in 0 - 255.
+void write_overlap_strips(vector<DictionaryPatch> &dictionary_patches, 
+                          MatrixView<unsigned char> strips) {
+    for (int id = 0; id < int(dictionary_patches.size()); id++) {
+        unsigned char *row = strips.row(id);
+        for (int direction = 0; direction < 4; direction++) {
+            vector<int> &region = 
+                dictionary_patches[id].overlapping_region_pixels[direction];
+            for (int x = 0; x < int(region.size()); x++) {
+                *row++ = (unsigned char)region[x];
+            }
+        }
+    }
+}
+
 #endif
\ No newline at end of file
@@ -1,47 +1,68 @@
 #ifndef CPP_LATENT_PATCHES
 #define CPP_LATENT_PATCHES
 
+#include <cmath>
 #include <iostream>
 #include <vector>
 
+#include "buffer_matrix.cpp"
 #include "message.cpp"
 
-typedef long double ld;
-
 using namespace std;
 
+// A constant denoting unreachable neigbours of borderline nodes.
+const int NEIGHBOUR_UNREACHABLE = -1;
+
 // A latent variable of the MRF holding its prior, messages and indices
-// of neighbouring latent variables.
+// of neighbouring latent variables. Probabilities are represented as in 
+// Message<real, log_domain>.
+template<class real, bool log_domain>
 struct LatentPatch {
+    typedef Message<real, log_domain> Msg;
+
     // Count of considered dict. patches. 
-    // Also a dimension of a received message.
+    // Also a dimension of a received message. Patches whose candidates were 
+    // pruned consider only the first k of them, so k can differ between 
+    // patches, while potential tables keep rows for all candidates.
     int k;
 
-    // Indices and probabilities of k most probable dictionary patches.
-    vector<int> considered_dictionary_patches;
-    vector<ld> initial_probabilities;
+    // Probabilities of k most probable dictionary patches.
+    vector<real> initial_probabilities;
     
-    // List of lates received messages from each direction. 
-    vector<Message> received_messages;
+    // List of lates received messages from each direction, uniform before
+    // the first one is received.
+    vector<Msg> received_messages;
     
-    // A constant denoting unreachable neigbours of borderline nodes.
-    static const int NEIGHBOUR_UNREACHABLE = -1;
     // 4 indices of neighboring latent patches (or NEIGHBOUR_UNREACHABLE).
     vector<int> neighbours;
 
-    LatentPatch(vector<int>& considered_dictionary_patches, 
-                vector<ld>& initial_probabilities)
-    : considered_dictionary_patches(considered_dictionary_patches), 
-      initial_probabilities(initial_probabilities) {
-        k = considered_dictionary_patches.size();
-        received_messages.resize(4, Message(k, 1));
+    LatentPatch(double *initial_probabilities, int k): k(k) {
+        set_initial_probabilities(initial_probabilities);
+        received_messages.resize(4, Msg::uniform(k));
         neighbours.resize(4);
     }
 
+    // Replaces the prior by k probabilities stored at "probabilities".
+    void set_initial_probabilities(double *probabilities) {
+        initial_probabilities.resize(k);
+        for (int i=0; i<k; i++) {
+            initial_probabilities[i] = log_domain ? 
+                log(real(probabilities[i])) : real(probabilities[i]);
+        }
+    }
+
+    // Forgets all received messages. They are uniform, so that residuals of
+    // messages sent for the first time are comparable to later ones.
+    void reset_messages() {
+        for (int i=0; i<int(received_messages.size()); i++) {
+            received_messages[i] = Msg::uniform(k);
+        }
+    }
+
     // Compute the poinwise product of all received messages with exception of
     // message at index "excluded_direction".
-    Message product_of_messages(int excluded_direction) {
-        Message result(k, 1);
+    Msg product_of_messages(int excluded_direction) {
+        Msg result = Msg::ones(k);
         for (int i=0; i<int(received_messages.size()); i++) {
             if (i == excluded_direction) continue;
             result.multiply(received_messages[i]);
@@ -50,17 +71,21 @@ struct LatentPatch {
     }
 
     // Compute the distribution resulting from message passing.
-    vector<ld> resulting_distribution() {
-        Message product = product_of_messages(-1);
-        Message initial(initial_probabilities);
-        product.multiply(initial);
+    vector<double> resulting_distribution() {
+        Msg product = product_of_messages(-1);
+        product.multiply(initial_probabilities);
         product.normalize_sum();
-        return product.elements;
+        vector<double> distribution(k);
+        for (int i=0; i<k; i++) {
+            distribution[i] = product.probability(i);
+        }
+        return distribution;
     }
 };
 
 // Checks that the degree distibution is as expected.
-void check_patch_graph(int rows, int cols, vector<LatentPatch> &patches) {
+template<class Patch>
+void check_patch_graph(int rows, int cols, vector<Patch> &patches) {
     vector<int> expected = {
         0, 
         0, 
@@ -73,7 +98,7 @@ void check_patch_graph(int rows, int cols, vector<LatentPatch> &patches) {
     for (auto p : patches) {
         int n = 0;
         for (int i=0; i<4; i++)
-            n += (p.neighbours[i] != LatentPatch::NEIGHBOUR_UNREACHABLE);
+            n += (p.neighbours[i] != NEIGHBOUR_UNREACHABLE);
         nodes_of_degree[n]++;       
     } 
     for (int i=0; i<5; i++) {
@@ -85,14 +110,19 @@ void check_patch_graph(int rows, int cols, vector<LatentPatch> &patches) {
     }
 }
 
-// Creates separate patch objects from matrices of indices and probabilities.
-// Connects patches by building the graph (setting patch neighbours).
-vector<LatentPatch> prepare_latent_patches(int rows, int cols,
-    vector<vector<int> > k_best_patches, 
-    vector<vector<ld> > k_best_probabilities) {
-    vector<LatentPatch> patches;
-    for (int i=0; i<int(k_best_patches.size()); i++) {
-        patches.emplace_back(k_best_patches[i], k_best_probabilities[i]);
+// Creates separate patch objects from the matrix of probabilities of k most 
+// probable dictionary patches, of which patch i considers the first 
+// candidate_counts[i] if counts are given. Connects patches by building the 
+// graph (setting patch neighbours).
+template<class real, bool log_domain>
+vector<LatentPatch<real, log_domain> > prepare_latent_patches(int rows, int cols,
+    MatrixView<double> k_best_probabilities, int *candidate_counts = NULL) {
+    vector<LatentPatch<real, log_domain> > patches;
+    for (int i=0; i<k_best_probabilities.rows; i++) {
+        patches.emplace_back(
+            k_best_probabilities.row(i), 
+            candidate_counts == NULL ? 
+                k_best_probabilities.cols : candidate_counts[i]);
     }
 
     int dx[4] = {0, 1, 0, -1};
@@ -104,7 +134,7 @@ vector<LatentPatch> prepare_latent_patches(int rows, int cols,
                 int j2 = j + dx[direction];
                 if (i2 < 0 || i2 >= rows || j2 < 0 || j2 >= cols) {
                     patches[i * cols + j].neighbours[direction] = 
-                        LatentPatch::NEIGHBOUR_UNREACHABLE;    
+                        NEIGHBOUR_UNREACHABLE;    
                 } else {
                     patches[i * cols + j].neighbours[direction] = 
                         i2 * cols + j2;
@@ -118,4 +148,4 @@ vector<LatentPatch> prepare_latent_patches(int rows, int cols,
     return patches;
 }
 
-#endif
\ No newline at end of file
+#endif
@@ -1,13 +1,18 @@
 #include <Python.h>
+#include <chrono>
 #include <vector>
 #include <queue>
 #include <cmath>
 #include <iostream>
+#include <random>
+#include <thread>
 
+#include "buffer_matrix.cpp"
 #include "dictionary_patches.cpp"
 #include "io_matrix.cpp"
 #include "latent_patches.cpp"
 #include "message.cpp"
+#include "pairwise_potentials.cpp"
 
 #define DEBUG false
 
@@ -15,55 +20,208 @@ using namespace std;
 
 typedef long double ld;
 
-// Structure implementing loopy belief propagation.
-struct Loopy {
-    // Number of iterations of message passing algorithm.
+// Order in which messages are updated in one iteration of message passing.
+enum Schedule {
+    // Messages are sent sequentially along a random spanning tree.
+    RANDOM_TREE,
+    // Latent patches are colored as a checkerboard, all messages received by
+    // one color are updated in parallel, then all messages of the other one.
+    CHECKERBOARD,
+    // Messages are updated one by one, always the message which would change 
+    // the most (residual belief propagation). One iteration is as many 
+    // updates as there are messages.
+    RESIDUAL,
+};
+
+// Accumulates residuals (largest changes of elements) of updated messages 
+// and numbers of potentials evaluated by them.
+struct Residuals {
+    double max_residual;
+    double sum;
+    long long count;
+    long long potentials;
+
+    Residuals(): max_residual(0), sum(0), count(0), potentials(0) {}
+
+    void add(double residual) {
+        max_residual = max(max_residual, residual);
+        sum += residual;
+        count++;
+    }
+
+    void merge(Residuals &other) {
+        max_residual = max(max_residual, other.max_residual);
+        sum += other.sum;
+        count += other.count;
+        potentials += other.potentials;
+    }
+
+    double mean() {
+        return count > 0 ? sum / count : 0;
+    }
+};
+
+// Summary of a run of loopy belief propagation.
+struct LoopyStatistics {
+    // Number of executed iterations.
     int iterations;
-    
+    // Residuals of messages updated in the last iteration.
+    Residuals residuals;
+    // Number of computed messages (the residual schedule computes more 
+    // messages than it sends).
+    long long messages;
+    // Number of potentials evaluated by computed messages, k x k for each 
+    // of them unless candidates were pruned.
+    long long potentials;
+    // Wall time of each iteration.
+    vector<double> iteration_seconds;
+
+    LoopyStatistics(): iterations(0), messages(0), potentials(0) {}
+};
+
+typedef chrono::steady_clock Clock;
+
+double seconds_since(Clock::time_point start) {
+    return chrono::duration<double>(Clock::now() - start).count();
+}
+
+// Interface of loopy belief propagation which does not depend on the 
+// representation of probabilities, so that it can be chosen at runtime.
+struct LoopyBase {
+    // Size of potential tables, the number of candidates of latent patches.
+    int k;
+
+    virtual ~LoopyBase() {}
+
+    virtual int patch_count() = 0;
+    virtual LoopyStatistics run_loopy(int iterations, int seed, 
+                                      Schedule schedule, int threads, 
+                                      double tolerance) = 0;
+    virtual vector<vector<double> > resulting_distributions() = 0;
+    virtual void update_priors(MatrixView<double> k_best_probabilities) = 0;
+    virtual void reset_messages() = 0;
+    virtual void get_messages(MatrixView<double> messages) = 0;
+    virtual void set_messages(MatrixView<double> messages) = 0;
+};
+
+// Structure implementing loopy belief propagation. Messages are computed 
+// with numbers of type "real", in log domain if "log_domain" is set, in 
+// which case potentials hold logarithms of potentials.
+template<class real, bool log_domain>
+struct Loopy : LoopyBase {
+    typedef LatentPatch<real, log_domain> Patch;
+    typedef Message<real, log_domain> Msg;
+
     // Latent variables of MRF holding their prior distributions and messages.
-    vector<LatentPatch> latent_patches;    
-    // Dictionary of values that latent patches can achieve, dictionary patches
-    // cnan be accesed by their id (position in the source image).
-    vector<DictionaryPatch> dictionary_patches;
-    
-    ld two_sigma2;
+    vector<Patch> latent_patches;    
+    int grid_rows, grid_cols;
+    // Precomputed pairwise potential tables of edges between latent patches
+    // (see pairwise_potentials.cpp).
+    MatrixView<real> potentials;
 
-    Loopy(ld two_sigma2): two_sigma2(two_sigma2) {}
+    // Generator of random spanning trees, seeded at the start of each run.
+    mt19937 random_generator;
 
-    ld calculate_potential(ld distance) {
-        return exp(-distance / two_sigma2);
+    // Latent patch p considers only its first candidate_counts[p] 
+    // candidates if counts are given (see LatentPatch).
+    Loopy(int grid_rows, int grid_cols, MatrixView<double> k_best_probabilities,
+          MatrixView<real> potentials, int *candidate_counts = NULL)
+    : grid_rows(grid_rows), grid_cols(grid_cols), potentials(potentials) {
+        k = k_best_probabilities.cols;
+        latent_patches = prepare_latent_patches<real, log_domain>(
+            grid_rows, grid_cols, k_best_probabilities, candidate_counts);
+    }
+
+    int patch_count() {
+        return latent_patches.size();
     }
 
     // Create new message send from sender to receiver using the initial 
     // probabiliries of directory patches, past received messages and potential 
-    // from overlaps.
-    Message create_new_message(int sender, int receiver, int direction) {
-        LatentPatch& lp_sender = latent_patches[sender];
-        LatentPatch& lp_receiver = latent_patches[receiver];
-
-        Message new_message(lp_receiver.k, 0);
-        Message message_product = lp_sender.product_of_messages(direction);
-
-        for (int j=0; j<lp_receiver.k; j++) {
-            int dict_idx = lp_receiver.considered_dictionary_patches[j];
-            DictionaryPatch& dp_receiver = dictionary_patches[dict_idx];
-            
-            for (int i=0; i<lp_sender.k; i++) {
-                int dict_idx_2 = lp_receiver.considered_dictionary_patches[i];
-                DictionaryPatch& dp_sender = dictionary_patches[dict_idx_2];
-                ld potential = calculate_potential(
-                    dp_sender.compute_overlap_distance(dp_receiver, direction));
+    // from overlaps. The message is a product of the potential table of the 
+    // edge and the vector of sender's beliefs.
+    Msg create_new_message(int sender, int receiver, int direction) {
+        Patch& lp_sender = latent_patches[sender];
+        Patch& lp_receiver = latent_patches[receiver];
+
+        Msg new_message(lp_receiver.k, 0);
+        Msg message_product = lp_sender.product_of_messages(direction);
+        message_product.multiply(lp_sender.initial_probabilities);
 
-                new_message.elements[j] += lp_sender.initial_probabilities[i] * 
-                    potential * message_product.elements[i];
+        // Element [i][j] of the table of this edge is at 
+        // table[i * sender_stride + j * receiver_stride].
+        real *table;
+        int sender_stride, receiver_stride;
+        if (direction == 1 || direction == 2) {
+            // Table of sender, rows correspond to sender's candidates.
+            table = potentials.row(sender) + 
+                potential_table_offset(direction, k);
+            sender_stride = k;
+            receiver_stride = 1;
+        } else {
+            // Table of receiver, rows correspond to receiver's candidates.
+            table = potentials.row(receiver) + 
+                potential_table_offset((direction + 2) % 4, k);
+            sender_stride = 1;
+            receiver_stride = k;
+        }
+
+        if (log_domain) {
+            // Sums of products are computed as log-sum-exp of sums.
+            for (int j=0; j<lp_receiver.k; j++) {
+                real *column = table + j * receiver_stride;
+                real maxi = -numeric_limits<real>::infinity();
+                for (int i=0; i<lp_sender.k; i++) {
+                    maxi = max(maxi, message_product.elements[i] + 
+                                     column[i * sender_stride]);
+                }
+                real sum = 0;
+                for (int i=0; i<lp_sender.k; i++) {
+                    sum += exp(message_product.elements[i] + 
+                               column[i * sender_stride] - maxi);
+                }
+                new_message.elements[j] = maxi + log(sum);
+            }
+        } else if (receiver_stride == 1) {
+            for (int i=0; i<lp_sender.k; i++) {
+                real belief = message_product.elements[i];
+                real *table_row = table + i * sender_stride;
+                for (int j=0; j<lp_receiver.k; j++) {
+                    new_message.elements[j] += belief * table_row[j];
+                }
+            }
+        } else {
+            for (int j=0; j<lp_receiver.k; j++) {
+                real *table_row = table + j * receiver_stride;
+                for (int i=0; i<lp_sender.k; i++) {
+                    new_message.elements[j] += 
+                        message_product.elements[i] * table_row[i];
+                }
             }
-            
         }
 
         new_message.normalize_sum();
         return new_message;
     }
     
+    // Returns the number of potentials evaluated by the message received by
+    // "receiver" from "direction".
+    long long message_potentials(int receiver, int direction) {
+        int sender = latent_patches[receiver].neighbours[direction];
+        return (long long)latent_patches[receiver].k * latent_patches[sender].k;
+    }
+
+    // Replaces the message received by "receiver" from "direction" and 
+    // records its residual.
+    void replace_message(int receiver, int direction, Msg message, 
+                         Residuals &residuals) {
+        Msg &old_message = 
+            latent_patches[receiver].received_messages[direction];
+        residuals.add(old_message.max_difference(message));
+        residuals.potentials += message_potentials(receiver, direction);
+        old_message = message;
+    }
+
     // Gnerates a random tree as a list of pairs (node, direction to neighbour).
     // The tree roughly correspondst to BFS search tree, but the next node
     // is selected randomly from the border of visited/unvisited nodes.
@@ -71,13 +229,13 @@ struct Loopy {
         vector<pair<int, int> > edges;
 
         int n = latent_patches.size();
-        int first = rand() % n;
+        int first = random_generator() % n;
         vector<int> next_vertices(1, first);
         vector<bool> visited(n, false);
         visited[first] = true;
 
         while (next_vertices.size() > 0){
-            int position = rand() % next_vertices.size();
+            int position = random_generator() % next_vertices.size();
             int current_vertex = next_vertices[position];
             next_vertices[position] = next_vertices.back();
             next_vertices.pop_back();
@@ -85,7 +243,7 @@ struct Loopy {
             for (int direction=0; direction<4; direction++) {
                 int neighbour = 
                     latent_patches[current_vertex].neighbours[direction];
-                if (neighbour == LatentPatch::NEIGHBOUR_UNREACHABLE || 
+                if (neighbour == NEIGHBOUR_UNREACHABLE || 
                     visited[neighbour]) {
                     continue;
                 }
@@ -100,7 +258,7 @@ struct Loopy {
 
     // At first a random tree is genearated, messages are collected from leaves 
     // to the root and then messages are propagated from root to leaves.
-    void execute_one_message_passing_iteration() {
+    void execute_one_message_passing_iteration(Residuals &residuals) {
         vector<pair<int, int> > edges = generate_random_tree();
 
         for (int i = int(edges.size()) - 1; i >= 0; i--) {
@@ -109,8 +267,9 @@ struct Loopy {
             int sender = 
                 latent_patches[receiver].neighbours[receiver_direction];
             int sender_direction = (receiver_direction + 2) % 4;
-            latent_patches[receiver].received_messages[receiver_direction] = 
-                create_new_message(sender, receiver, sender_direction);
+            replace_message(receiver, receiver_direction, 
+                create_new_message(sender, receiver, sender_direction), 
+                residuals);
         }
 
         for (int i=0; i<(int)edges.size(); i++) {
@@ -118,25 +277,391 @@ struct Loopy {
             int sender_direction = edges[i].second;
             int receiver = latent_patches[sender].neighbours[sender_direction];
             int receiver_direction = (sender_direction + 2) % 4;
-            latent_patches[receiver].received_messages[receiver_direction] = 
-                create_new_message(sender, receiver, sender_direction);
+            replace_message(receiver, receiver_direction, 
+                create_new_message(sender, receiver, sender_direction), 
+                residuals);
         }
     }
 
-    vector<vector<ld> > run_loopy(int iterations) {
-        for(int iteration = 0; iteration < iterations; iteration++){
-            execute_one_message_passing_iteration();
+    // Updates messages received by latent patches of given color in rows
+    // first_row ... last_row - 1. The senders are of the other color, so 
+    // messages sent by them do not depend on messages updated here.
+    void update_messages_received_by_color(int color, int first_row, 
+                                           int last_row, 
+                                           Residuals *residuals) {
+        for (int row = first_row; row < last_row; row++) {
+            for (int col = (row + color) % 2; col < grid_cols; col += 2) {
+                int receiver = row * grid_cols + col;
+                for (int direction = 0; direction < 4; direction++) {
+                    int sender = latent_patches[receiver].neighbours[direction];
+                    if (sender == NEIGHBOUR_UNREACHABLE) continue;
+                    replace_message(receiver, direction, 
+                        create_new_message(
+                            sender, receiver, (direction + 2) % 4), 
+                        *residuals);
+                }
+            }
         }
-        vector<vector<ld> > result_probabilities;
+    }
+
+    // Updates messages received by both colors of the checkerboard, rows 
+    // of the grid are split between threads. The messages do not depend on 
+    // the number of threads.
+    void execute_one_checkerboard_iteration(int threads, 
+                                            Residuals &residuals) {
+        for (int color = 0; color < 2; color++) {
+            if (threads == 1) {
+                update_messages_received_by_color(
+                    color, 0, grid_rows, &residuals);
+                continue;
+            }
+            vector<thread> workers;
+            vector<Residuals> thread_residuals(threads);
+            for (int t = 0; t < threads; t++) {
+                workers.emplace_back(
+                    &Loopy::update_messages_received_by_color, this, color,
+                    grid_rows * t / threads, grid_rows * (t + 1) / threads, 
+                    &thread_residuals[t]);
+            }
+            for (int t = 0; t < threads; t++) {
+                workers[t].join();
+                residuals.merge(thread_residuals[t]);
+            }
+        }
+    }
+
+    // Computes the message which would be received by "receiver" from 
+    // "direction" if it was sent now, and its residual. Used by the residual 
+    // schedule, where message received by patch p from direction d is 
+    // indexed as 4 * p + d.
+    void compute_pending_message(int receiver, int direction, 
+                                 vector<Msg> &pending_messages,
+                                 vector<double> &pending_residuals) {
+        int sender = latent_patches[receiver].neighbours[direction];
+        int index = 4 * receiver + direction;
+        pending_messages[index] = 
+            create_new_message(sender, receiver, (direction + 2) % 4);
+        pending_residuals[index] = 
+            latent_patches[receiver].received_messages[direction]
+                .max_difference(pending_messages[index]);
+    }
+
+    // Residual belief propagation: the message with the largest residual is
+    // sent and messages depending on it are recomputed. Runs until the 
+    // largest residual of an iteration drops below tolerance.
+    LoopyStatistics run_residual_schedule(int iterations, double tolerance) {
+        int message_count = 0;
+        vector<Msg> pending_messages(4 * latent_patches.size(), Msg(0, 0));
+        vector<double> pending_residuals(4 * latent_patches.size(), 0);
+        vector<int> versions(4 * latent_patches.size(), 0);
+        // Queue of (residual, (version, message index)), outdated versions
+        // are skipped.
+        priority_queue<pair<double, pair<int, int> > > queue;
+        LoopyStatistics statistics;
+        Clock::time_point start = Clock::now();
+
+        for (int p = 0; p < int(latent_patches.size()); p++) {
+            for (int direction = 0; direction < 4; direction++) {
+                if (latent_patches[p].neighbours[direction] == 
+                    NEIGHBOUR_UNREACHABLE) continue;
+                compute_pending_message(
+                    p, direction, pending_messages, pending_residuals);
+                int index = 4 * p + direction;
+                queue.push(make_pair(pending_residuals[index], 
+                                     make_pair(0, index)));
+                message_count++;
+                statistics.potentials += message_potentials(p, direction);
+            }
+        }
+        statistics.messages = message_count;
+
+        while (statistics.iterations < iterations && !queue.empty()) {
+            Residuals residuals;
+            while (residuals.count < message_count && !queue.empty()) {
+                int version = queue.top().second.first;
+                int index = queue.top().second.second;
+                queue.pop();
+                if (version != versions[index]) continue;
+
+                int receiver = index / 4, direction = index % 4;
+                int sender = latent_patches[receiver].neighbours[direction];
+                replace_message(receiver, direction, pending_messages[index], 
+                                residuals);
+                versions[index]++;
+
+                // Messages sent by the receiver to its other neighbours.
+                for (int d = 0; d < 4; d++) {
+                    int neighbour = latent_patches[receiver].neighbours[d];
+                    if (neighbour == NEIGHBOUR_UNREACHABLE || 
+                        neighbour == sender) continue;
+                    int neighbour_direction = (d + 2) % 4;
+                    int neighbour_index = 4 * neighbour + neighbour_direction;
+                    compute_pending_message(neighbour, neighbour_direction, 
+                        pending_messages, pending_residuals);
+                    statistics.messages++;
+                    statistics.potentials += 
+                        message_potentials(neighbour, neighbour_direction);
+                    versions[neighbour_index]++;
+                    queue.push(make_pair(pending_residuals[neighbour_index], 
+                        make_pair(versions[neighbour_index], neighbour_index)));
+                }
+            }
+            statistics.iterations++;
+            statistics.residuals = residuals;
+            // The first iteration includes computing all pending messages.
+            statistics.iteration_seconds.push_back(seconds_since(start));
+            start = Clock::now();
+            if (residuals.max_residual < tolerance) break;
+        }
+        return statistics;
+    }
+
+    // Runs iterations of message passing, stopping early when the largest 
+    // residual of an iteration is below tolerance. Random trees depend only 
+    // on the seed, so results are reproducible for a given seed (and any 
+    // number of threads for the checkerboard schedule).
+    LoopyStatistics run_loopy(int iterations, int seed, Schedule schedule,
+                              int threads, double tolerance) {
+        random_generator.seed(seed);
+        if (threads <= 0) {
+            threads = max(1, int(thread::hardware_concurrency()));
+        }
+        threads = min(threads, max(1, grid_rows));
+
+        if (schedule == RESIDUAL) {
+            return run_residual_schedule(iterations, tolerance);
+        }
+
+        LoopyStatistics statistics;
+        while (statistics.iterations < iterations) {
+            Clock::time_point start = Clock::now();
+            Residuals residuals;
+            if (schedule == CHECKERBOARD) {
+                execute_one_checkerboard_iteration(threads, residuals);
+            } else {
+                execute_one_message_passing_iteration(residuals);
+            }
+            statistics.iterations++;
+            statistics.residuals = residuals;
+            statistics.messages += residuals.count;
+            statistics.potentials += residuals.potentials;
+            statistics.iteration_seconds.push_back(seconds_since(start));
+            if (residuals.max_residual < tolerance) break;
+        }
+        return statistics;
+    }
+
+    vector<vector<double> > resulting_distributions() {
+        vector<vector<double> > result_probabilities;
         for (int p=0; p<int(latent_patches.size()); p++) {
             result_probabilities.push_back(
                 latent_patches[p].resulting_distribution());
         }
         return result_probabilities;
     }
+
+    // Replaces priors of all latent patches, messages are kept.
+    void update_priors(MatrixView<double> k_best_probabilities) {
+        for (int p=0; p<int(latent_patches.size()); p++) {
+            latent_patches[p].set_initial_probabilities(
+                k_best_probabilities.row(p));
+        }
+    }
+
+    void reset_messages() {
+        for (int p=0; p<int(latent_patches.size()); p++) {
+            latent_patches[p].reset_messages();
+        }
+    }
+
+    // Copies messages received by each latent patch from its 4 directions 
+    // into a row of a matrix of shape (patch count, 4 * k), as elements are
+    // stored (logarithms in log domain). Elements of pruned candidates are 
+    // zero probabilities.
+    void get_messages(MatrixView<double> messages) {
+        double zero = log_domain ? -numeric_limits<double>::infinity() : 0;
+        for (int p=0; p<int(latent_patches.size()); p++) {
+            for (int direction=0; direction<4; direction++) {
+                Msg &message = latent_patches[p].received_messages[direction];
+                for (int i=0; i<k; i++) {
+                    messages.at(p, direction * k + i) = 
+                        i < latent_patches[p].k ? 
+                            double(message.elements[i]) : zero;
+                }
+            }
+        }
+    }
+
+    // Replaces all messages by rows of a matrix in the layout of 
+    // get_messages, elements of pruned candidates are ignored.
+    void set_messages(MatrixView<double> messages) {
+        for (int p=0; p<int(latent_patches.size()); p++) {
+            for (int direction=0; direction<4; direction++) {
+                Msg &message = latent_patches[p].received_messages[direction];
+                for (int i=0; i<latent_patches[p].k; i++) {
+                    message.elements[i] = 
+                        real(messages.at(p, direction * k + i));
+                }
+            }
+        }
+    }
 };
 
+// Copies resulting distributions into a matrix with one row per latent patch,
+// probabilities of pruned candidates are zeros.
+void write_probabilities(vector<vector<double> > &probabilities, 
+                         MatrixView<double> result) {
+    for (int p = 0; p < result.rows; p++) {
+        for (int i = 0; i < result.cols; i++) {
+            result.at(p, i) = 
+                i < int(probabilities[p].size()) ? probabilities[p][i] : 0;
+        }
+    }
+}
+
+// Acquires an optional int32 matrix of candidate counts of shape 
+// (patch count, 1) with values from 1 to k, or does nothing for None. 
+// Returns false and sets a Python exception if it is invalid.
+bool acquire_candidate_counts(PyObject *object, int patch_count, int k,
+                              BufferMatrix<int> &counts) {
+    if (object == NULL || object == Py_None) {
+        return true;
+    }
+    if (!counts.acquire(object, "candidate_counts", false)) {
+        return false;
+    }
+    if (counts.rows() != patch_count || counts.cols() != 1) {
+        PyErr_SetString(PyExc_ValueError, 
+            "candidate_counts must have shape (patch count, 1).");
+        return false;
+    }
+    MatrixView<int> view = counts.view();
+    for (int p = 0; p < patch_count; p++) {
+        if (view.at(p, 0) < 1 || view.at(p, 0) > k) {
+            PyErr_SetString(PyExc_ValueError, 
+                "candidate_counts must be between 1 and k.");
+            return false;
+        }
+    }
+    return true;
+}
+
+// Returns pointer to counts acquired by acquire_candidate_counts, or NULL.
+int *candidate_counts_data(BufferMatrix<int> &counts) {
+    return counts.acquired ? counts.view().data : NULL;
+}
+
+// Builds the MRF from probabilities of k best candidates of each latent patch
+// and precomputed pairwise potentials, runs loopy belief propagation and 
+// returns resulting distributions.
+template<class real>
+vector<vector<double> > run_loopy_belief_propagation(
+    int iterations, int grid_rows, int grid_cols, int seed, 
+    MatrixView<double> k_best_probabilities, MatrixView<real> potentials) {
+    if (DEBUG) {
+        cout << "Loopy loaded:\n" 
+             << "    " << k_best_probabilities.rows 
+             << " lists of k best patch probabilities\n";
+    }
+
+    Loopy<real, false> loopy(
+        grid_rows, grid_cols, k_best_probabilities, potentials);
+    loopy.run_loopy(iterations, seed, RANDOM_TREE, 1, 0);
+    return loopy.resulting_distributions();
+}
+
+// Fills the potentials matrix with elements of type "real", see 
+// pairwise_potentials.
+template<class real>
+static PyObject *
+fill_pairwise_potentials(int grid_rows, int grid_cols, double two_sigma2, 
+                         bool log_potentials,
+                         PyObject *overlap_strips_object, 
+                         PyObject *k_best_patches_object, 
+                         PyObject *potentials_object,
+                         PyObject *candidate_counts_object)
+{
+    BufferMatrix<unsigned char> overlap_strips;
+    BufferMatrix<int> k_best_patches;
+    BufferMatrix<real> potentials;
+    if (!overlap_strips.acquire(
+            overlap_strips_object, "overlap_strips", false) ||
+        !k_best_patches.acquire(
+            k_best_patches_object, "k_best_patches", false) ||
+        !potentials.acquire(potentials_object, "potentials", true)) {
+        return NULL;
+    }
+
+    int patch_count = grid_rows * grid_cols;
+    int k = k_best_patches.cols();
+    if (overlap_strips.cols() % 4 != 0 || overlap_strips.cols() == 0 ||
+        k_best_patches.rows() != patch_count ||
+        potentials.rows() != patch_count || potentials.cols() != 2 * k * k) {
+        PyErr_SetString(PyExc_ValueError, 
+            "Shapes of arrays do not match the grid.");
+        return NULL;
+    }
+    BufferMatrix<int> candidate_counts;
+    if (!acquire_candidate_counts(
+            candidate_counts_object, patch_count, k, candidate_counts)) {
+        return NULL;
+    }
+
+    OverlapStrips strips(overlap_strips.view());
+    compute_pairwise_potentials(
+        strips, grid_rows, grid_cols, k_best_patches.view(), 
+        two_sigma2, log_potentials, potentials.view(), 
+        candidate_counts_data(candidate_counts));
+
+    Py_RETURN_NONE;
+}
+
+// Creates Loopy computing with numbers of type "real" which references the 
+// potentials array, with optional counts of candidates of latent patches. 
+// On success, the acquired buffer of the array is stored in 
+// "potentials_buffer".
+template<class real>
+static LoopyBase *
+create_loopy(int grid_rows, int grid_cols, bool log_domain, 
+             PyObject *potentials_object, PyObject *candidate_counts_object,
+             BufferMatrixBase **potentials_buffer)
+{
+    BufferMatrix<real> *potentials = new BufferMatrix<real>();
+    if (!potentials->acquire(potentials_object, "potentials", false)) {
+        delete potentials;
+        return NULL;
+    }
+
+    int patch_count = grid_rows * grid_cols;
+    int k = int(round(sqrt(potentials->cols() / 2)));
+    if (potentials->rows() != patch_count || potentials->cols() != 2 * k * k) {
+        PyErr_SetString(PyExc_ValueError, 
+            "Shape of potentials does not match the grid.");
+        delete potentials;
+        return NULL;
+    }
+    // Counts are copied by latent patches, the buffer is released here.
+    BufferMatrix<int> candidate_counts;
+    if (!acquire_candidate_counts(
+            candidate_counts_object, patch_count, k, candidate_counts)) {
+        delete potentials;
+        return NULL;
+    }
+
+    vector<double> uniform(patch_count * k, 1.0 / k);
+    MatrixView<double> priors(uniform.data(), patch_count, k);
+    *potentials_buffer = potentials;
+    int *counts = candidate_counts_data(candidate_counts);
+    if (log_domain) {
+        return new Loopy<real, true>(
+            grid_rows, grid_cols, priors, potentials->view(), counts);
+    }
+    return new Loopy<real, false>(
+        grid_rows, grid_cols, priors, potentials->view(), counts);
+}
+
 extern "C" {
+// Debug entry point: matrices are passed in and out through text files.
 static PyObject *
 loopy_belief_propagation(PyObject *self, PyObject *args)
 {
@@ -151,40 +676,498 @@ loopy_belief_propagation(PyObject *self, PyObject *args)
         &k_best_probabilities_path, &result_probabilites_path)) {
         return NULL;    
     }
-    srandom(seed);
     
     vector<vector<int> > dictionary_vectors = 
         read_matrix_from_file<int>(
             dictionary_vectors_path, patch_size * patch_size);
     vector<vector<int> > k_best_patches = 
         read_matrix_from_file<int>(k_best_patches_path, k);
-    vector<vector<ld> > k_best_probabilities = 
-        read_matrix_from_file<ld>(k_best_probabilities_path, k);
+    vector<vector<double> > k_best_probabilities = 
+        read_matrix_from_file<double>(k_best_probabilities_path, k);
 
-    if (DEBUG) {
-        cout << "Loopy loaded:\n" 
-             << "    " << int(dictionary_vectors.size()) << " dictionary_vectors\n"
-             << "    " << int(k_best_patches.size()) 
-             << " lists of k best dict. patches for latent patches\n"
-             << "    " << int(k_best_probabilities.size()) 
-             << " lists of k best patch probabilities\n";
-    }
+    vector<int> flat_dictionary_vectors = flatten_matrix(dictionary_vectors);
+    vector<int> flat_k_best_patches = flatten_matrix(k_best_patches);
+    vector<double> flat_k_best_probabilities = 
+        flatten_matrix(k_best_probabilities);
+    vector<ld> flat_potentials(k_best_patches.size() * 2 * k * k);
 
-    Loopy loopy(two_sigma2);
-    loopy.dictionary_patches = prepare_dictionary_patches(
-        dictionary_vectors, patch_size, patch_overlap);
-    loopy.latent_patches = prepare_latent_patches(
-        grid_rows, grid_cols, k_best_patches, k_best_probabilities);
+    vector<DictionaryPatch> dictionary_patches = prepare_dictionary_patches(
+        MatrixView<int>(flat_dictionary_vectors.data(), 
+                        dictionary_vectors.size(), patch_size * patch_size),
+        patch_size, patch_overlap);
+    int strip_size = 4 * dictionary_patches[0].overlapping_region_pixels[0].size();
+    vector<unsigned char> flat_overlap_strips(
+        dictionary_patches.size() * strip_size);
+    MatrixView<unsigned char> overlap_strips(
+        flat_overlap_strips.data(), dictionary_patches.size(), strip_size);
+    write_overlap_strips(dictionary_patches, overlap_strips);
+    OverlapStrips strips(overlap_strips);
 
-    vector<vector<ld> > probabilities = loopy.run_loopy(iterations);
-    write_matrix_to_file<ld>(result_probabilites_path, probabilities);
+    MatrixView<ld> potentials(
+        flat_potentials.data(), k_best_patches.size(), 2 * k * k);
+    compute_pairwise_potentials(
+        strips, grid_rows, grid_cols, 
+        MatrixView<int>(flat_k_best_patches.data(), k_best_patches.size(), k),
+        two_sigma2, false, potentials);
+
+    vector<vector<double> > probabilities = run_loopy_belief_propagation(
+        iterations, grid_rows, grid_cols, seed, 
+        MatrixView<double>(flat_k_best_probabilities.data(), 
+                           k_best_probabilities.size(), k),
+        potentials);
+    write_matrix_to_file<double>(result_probabilites_path, probabilities);
 
     return Py_BuildValue("i", 0);
 }
+
+// Extracts overlapping regions of dictionary patches into the compact 
+// OverlapStrips layout (see dictionary_patches.cpp) used by 
+// pairwise_potentials. Dictionary patches are given as a uint8 matrix of 
+// pixel values with one patch per row, strips are written into the writable 
+// uint8 matrix "overlap_strips" of shape 
+// (dictionary size, 4 * patch_overlap * patch_size).
+static PyObject *
+overlap_strips(PyObject *self, PyObject *args)
+{
+    int patch_size, patch_overlap;
+    PyObject * dictionary_pixels_object, * overlap_strips_object;
+
+    if (!PyArg_ParseTuple(args, "iiOO", &patch_size, &patch_overlap, 
+        &dictionary_pixels_object, &overlap_strips_object)) {
+        return NULL;    
+    }
+
+    BufferMatrix<unsigned char> dictionary_pixels, strips;
+    if (!dictionary_pixels.acquire(
+            dictionary_pixels_object, "dictionary_pixels", false) ||
+        !strips.acquire(overlap_strips_object, "overlap_strips", true)) {
+        return NULL;
+    }
+    if (patch_overlap <= 0 || patch_overlap > patch_size ||
+        dictionary_pixels.cols() != patch_size * patch_size ||
+        strips.rows() != dictionary_pixels.rows() || 
+        strips.cols() != 4 * patch_overlap * patch_size) {
+        PyErr_SetString(PyExc_ValueError, 
+            "Shapes of arrays do not match the patch size and overlap.");
+        return NULL;
+    }
+
+    vector<DictionaryPatch> dictionary_patches = prepare_dictionary_patches(
+        dictionary_pixels.view(), patch_size, patch_overlap);
+    write_overlap_strips(dictionary_patches, strips.view());
+
+    Py_RETURN_NONE;
+}
+
+// Computes pairwise potentials of the MRF for latent patches in a grid with 
+// given candidate dictionary patches (see pairwise_potentials.cpp). 
+// Overlapping regions of dictionary patches are given in the uint8 
+// OverlapStrips layout computed by overlap_strips, indices of k best patches 
+// are an int32 matrix. Potentials are written into the writable matrix 
+// "potentials" of shape (patch count, 2 * k * k) and type float32, float64 
+// or longdouble, which also determines precision of loopy.LoopyState using 
+// them. If "log_potentials" is true, logarithms of potentials are written, 
+// as needed by the log-domain LoopyState. The potentials depend only on 
+// candidates and sigma, so they can be reused by many runs of loopy belief 
+// propagation. Optional "candidate_counts", an int32 matrix of shape 
+// (patch count, 1), limits candidates of each latent patch to the first 
+// ones, potentials of the others are zeros.
+static PyObject *
+pairwise_potentials(PyObject *self, PyObject *args)
+{
+    double two_sigma2;
+    int grid_rows, grid_cols;
+    int log_potentials = 0;
+    PyObject * overlap_strips_object, * k_best_patches_object, 
+             * potentials_object, * candidate_counts_object = NULL;
+
+    if (!PyArg_ParseTuple(args, "iidOOO|pO",
+        &grid_rows, &grid_cols, &two_sigma2, &overlap_strips_object, 
+        &k_best_patches_object, &potentials_object, &log_potentials, 
+        &candidate_counts_object)) {
+        return NULL;    
+    }
+
+    switch (buffer_element_format(potentials_object)) {
+        case 0:
+            return NULL;
+        case 'f':
+            return fill_pairwise_potentials<float>(
+                grid_rows, grid_cols, two_sigma2, log_potentials, 
+                overlap_strips_object, k_best_patches_object, 
+                potentials_object, candidate_counts_object);
+        case 'g':
+            return fill_pairwise_potentials<long double>(
+                grid_rows, grid_cols, two_sigma2, log_potentials, 
+                overlap_strips_object, k_best_patches_object, 
+                potentials_object, candidate_counts_object);
+        default:
+            return fill_pairwise_potentials<double>(
+                grid_rows, grid_cols, two_sigma2, log_potentials, 
+                overlap_strips_object, k_best_patches_object, 
+                potentials_object, candidate_counts_object);
+    }
+}
+
+// Entry point operating on contiguous 2D float64 arrays (e.g. NumPy arrays) 
+// passed through the buffer protocol without copying. Potentials are 
+// precomputed by pairwise_potentials. Resulting distributions are written 
+// into the writable array "result_probabilities" of the same shape as 
+// "k_best_probabilities".
+static PyObject *
+loopy_belief_propagation_arrays(PyObject *self, PyObject *args)
+{
+    int iterations, grid_rows, grid_cols, seed;
+    PyObject * k_best_probabilities_object, * potentials_object, 
+             * result_probabilities_object;
+
+    if (!PyArg_ParseTuple(args, "iiiiOOO",
+        &iterations, &grid_rows, &grid_cols, &seed, 
+        &k_best_probabilities_object, &potentials_object, 
+        &result_probabilities_object)) {
+        return NULL;    
+    }
+
+    BufferMatrix<double> k_best_probabilities, potentials, 
+                         result_probabilities;
+    if (!k_best_probabilities.acquire(
+            k_best_probabilities_object, "k_best_probabilities", false) ||
+        !potentials.acquire(potentials_object, "potentials", false) ||
+        !result_probabilities.acquire(
+            result_probabilities_object, "result_probabilities", true)) {
+        return NULL;
+    }
+
+    int patch_count = grid_rows * grid_cols;
+    int k = k_best_probabilities.cols();
+    if (k_best_probabilities.rows() != patch_count || 
+        potentials.rows() != patch_count || potentials.cols() != 2 * k * k ||
+        result_probabilities.rows() != patch_count || 
+        result_probabilities.cols() != k) {
+        PyErr_SetString(PyExc_ValueError, 
+            "Shapes of arrays do not match the grid.");
+        return NULL;
+    }
+
+    vector<vector<double> > probabilities;
+    Py_BEGIN_ALLOW_THREADS
+    probabilities = run_loopy_belief_propagation(
+        iterations, grid_rows, grid_cols, seed, k_best_probabilities.view(), 
+        potentials.view());
+    Py_END_ALLOW_THREADS
+    write_probabilities(probabilities, result_probabilities.view());
+
+    Py_RETURN_NONE;
+}
+
+// Python type holding the MRF between runs of loopy belief propagation: the 
+// grid graph, pairwise potentials (the array is referenced, not copied) and 
+// messages. Consecutive runs continue from messages of the previous run 
+// unless they are reset, so EM iterations can warm start loopy.
+typedef struct {
+    PyObject_HEAD
+    LoopyBase *loopy;
+    BufferMatrixBase *potentials;
+    // Set while message passing runs without holding the GIL.
+    bool running;
+} LoopyStateObject;
+
+static void
+LoopyState_dealloc(LoopyStateObject *self)
+{
+    delete self->loopy;
+    delete self->potentials;
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+// LoopyState(grid_rows, grid_cols, potentials, log_domain=False, 
+//            candidate_counts=None): potentials are computed by 
+// pairwise_potentials, their type (float32, float64 or longdouble) 
+// determines precision of computation. If log_domain is set, messages are 
+// computed in log domain from logarithms of potentials. Priors are uniform 
+// until update_priors is called. Candidate counts, an int32 matrix of shape 
+// (patch count, 1), limit latent patches to their first candidates (the 
+// same as for potentials); matrices of priors, messages and results keep 
+// k columns, those of pruned candidates are zero probabilities.
+static int
+LoopyState_init(LoopyStateObject *self, PyObject *args, PyObject *kwds)
+{
+    static const char *keywords[] = {
+        "grid_rows", "grid_cols", "potentials", "log_domain", 
+        "candidate_counts", NULL
+    };
+    int grid_rows, grid_cols, log_domain = 0;
+    PyObject * potentials_object, * candidate_counts_object = NULL;
+
+    if (self->running) {
+        PyErr_SetString(PyExc_RuntimeError, 
+            "LoopyState is running in another thread.");
+        return -1;
+    }
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "iiO|pO", (char **)keywords,
+        &grid_rows, &grid_cols, &potentials_object, &log_domain, 
+        &candidate_counts_object)) {
+        return -1;
+    }
+
+    LoopyBase *loopy;
+    BufferMatrixBase *potentials = NULL;
+    switch (buffer_element_format(potentials_object)) {
+        case 0:
+            return -1;
+        case 'f':
+            loopy = create_loopy<float>(grid_rows, grid_cols, log_domain, 
+                                        potentials_object, 
+                                        candidate_counts_object, &potentials);
+            break;
+        case 'g':
+            loopy = create_loopy<long double>(grid_rows, grid_cols, log_domain,
+                                              potentials_object, 
+                                              candidate_counts_object, 
+                                              &potentials);
+            break;
+        default:
+            loopy = create_loopy<double>(grid_rows, grid_cols, log_domain, 
+                                         potentials_object, 
+                                         candidate_counts_object, &potentials);
+    }
+    if (loopy == NULL) {
+        return -1;
+    }
+
+    delete self->loopy;
+    delete self->potentials;
+    self->loopy = loopy;
+    self->potentials = potentials;
+    return 0;
+}
+
+// Sets a Python exception if __init__ of the object has not succeeded or if
+// the object is being used by a run in another thread.
+static bool
+LoopyState_check_initialized(LoopyStateObject *self)
+{
+    if (self->loopy == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "LoopyState is not initialized.");
+        return false;
+    }
+    if (self->running) {
+        PyErr_SetString(PyExc_RuntimeError, 
+            "LoopyState is running in another thread.");
+        return false;
+    }
+    return true;
+}
+
+// Converts name of a message passing schedule to Schedule.
+static bool
+parse_schedule(const char *name, Schedule *schedule)
+{
+    if (strcmp(name, "tree") == 0) {
+        *schedule = RANDOM_TREE;
+    } else if (strcmp(name, "checkerboard") == 0) {
+        *schedule = CHECKERBOARD;
+    } else if (strcmp(name, "residual") == 0) {
+        *schedule = RESIDUAL;
+    } else {
+        PyErr_Format(PyExc_ValueError, "Unknown schedule '%s', expected "
+            "'tree', 'checkerboard' or 'residual'.", name);
+        return false;
+    }
+    return true;
+}
+
+// update_priors(k_best_probabilities): replaces priors of latent patches by
+// rows of a float64 matrix of shape (patch count, k).
+static PyObject *
+LoopyState_update_priors(LoopyStateObject *self, PyObject *args)
+{
+    PyObject * k_best_probabilities_object;
+    if (!LoopyState_check_initialized(self) ||
+        !PyArg_ParseTuple(args, "O", &k_best_probabilities_object)) {
+        return NULL;
+    }
+
+    BufferMatrix<double> k_best_probabilities;
+    if (!k_best_probabilities.acquire(
+            k_best_probabilities_object, "k_best_probabilities", false)) {
+        return NULL;
+    }
+    if (k_best_probabilities.rows() != self->loopy->patch_count() 
+        || k_best_probabilities.cols() != self->loopy->k) {
+        PyErr_SetString(PyExc_ValueError, 
+            "k_best_probabilities must have shape (patch count, k).");
+        return NULL;
+    }
+
+    self->loopy->update_priors(k_best_probabilities.view());
+    Py_RETURN_NONE;
+}
+
+// reset_messages(): sets all messages to uniform, as before the first run.
+static PyObject *
+LoopyState_reset_messages(LoopyStateObject *self, PyObject *Py_UNUSED(args))
+{
+    if (!LoopyState_check_initialized(self)) {
+        return NULL;
+    }
+    self->loopy->reset_messages();
+    Py_RETURN_NONE;
+}
+
+// Acquires a float64 matrix of messages of shape (patch count, 4 * k).
+static bool
+acquire_messages(LoopyStateObject *self, PyObject *messages_object, 
+                 bool writable, BufferMatrix<double> &messages)
+{
+    if (!messages.acquire(messages_object, "messages", writable)) {
+        return false;
+    }
+    if (messages.rows() != self->loopy->patch_count() 
+        || messages.cols() != 4 * self->loopy->k) {
+        PyErr_SetString(PyExc_ValueError, 
+            "messages must have shape (patch count, 4 * k).");
+        return false;
+    }
+    return true;
+}
+
+// get_messages(messages): writes messages received by each latent patch 
+// from directions up, right, down and left into a row of the writable 
+// float64 matrix of shape (patch count, 4 * k). In log domain, logarithms
+// of messages are written.
+static PyObject *
+LoopyState_get_messages(LoopyStateObject *self, PyObject *args)
+{
+    PyObject * messages_object;
+    BufferMatrix<double> messages;
+    if (!LoopyState_check_initialized(self) ||
+        !PyArg_ParseTuple(args, "O", &messages_object) ||
+        !acquire_messages(self, messages_object, true, messages)) {
+        return NULL;
+    }
+    self->loopy->get_messages(messages.view());
+    Py_RETURN_NONE;
+}
+
+// set_messages(messages): replaces all messages by a matrix in the layout 
+// of get_messages, so that the next run continues from them.
+static PyObject *
+LoopyState_set_messages(LoopyStateObject *self, PyObject *args)
+{
+    PyObject * messages_object;
+    BufferMatrix<double> messages;
+    if (!LoopyState_check_initialized(self) ||
+        !PyArg_ParseTuple(args, "O", &messages_object) ||
+        !acquire_messages(self, messages_object, false, messages)) {
+        return NULL;
+    }
+    self->loopy->set_messages(messages.view());
+    Py_RETURN_NONE;
+}
+
+// run(iterations, seed, result_probabilities, schedule="tree", threads=1, 
+//     tolerance=0): executes at most "iterations" iterations of message 
+// passing and writes resulting distributions into the writable float64 
+// matrix of shape (patch count, k). Schedule is "tree", "checkerboard" or 
+// "residual", the checkerboard uses given number of threads (all cores if 
+// threads <= 0). Message passing stops once the largest residual of an 
+// iteration is below tolerance. The GIL is released while messages are 
+// passed. Returns a dict with the number of executed iterations, the 
+// largest and mean residual of the last iteration, numbers of computed 
+// messages and of potentials evaluated by them and a list of wall times of 
+// iterations in seconds.
+static PyObject *
+LoopyState_run(LoopyStateObject *self, PyObject *args, PyObject *kwds)
+{
+    static const char *keywords[] = {
+        "iterations", "seed", "result_probabilities", "schedule", "threads", 
+        "tolerance", NULL
+    };
+    int iterations, seed, threads = 1;
+    double tolerance = 0;
+    const char *schedule_name = "tree";
+    PyObject * result_probabilities_object;
+    if (!LoopyState_check_initialized(self) ||
+        !PyArg_ParseTupleAndKeywords(args, kwds, "iiO|sid", (char **)keywords,
+        &iterations, &seed, &result_probabilities_object, &schedule_name, 
+        &threads, &tolerance)) {
+        return NULL;
+    }
+
+    Schedule schedule;
+    if (!parse_schedule(schedule_name, &schedule)) {
+        return NULL;
+    }
+
+    BufferMatrix<double> result_probabilities;
+    if (!result_probabilities.acquire(
+            result_probabilities_object, "result_probabilities", true)) {
+        return NULL;
+    }
+    if (result_probabilities.rows() != 
+            self->loopy->patch_count() || 
+        result_probabilities.cols() != self->loopy->k) {
+        PyErr_SetString(PyExc_ValueError, 
+            "result_probabilities must have shape (patch count, k).");
+        return NULL;
+    }
+
+    LoopyStatistics statistics;
+    vector<vector<double> > probabilities;
+    LoopyBase *loopy = self->loopy;
+    self->running = true;
+    Py_BEGIN_ALLOW_THREADS
+    statistics = loopy->run_loopy(
+        iterations, seed, schedule, threads, tolerance);
+    probabilities = loopy->resulting_distributions();
+    Py_END_ALLOW_THREADS
+    self->running = false;
+    write_probabilities(probabilities, result_probabilities.view());
+
+    PyObject *iteration_seconds = 
+        PyList_New(statistics.iteration_seconds.size());
+    if (iteration_seconds == NULL) {
+        return NULL;
+    }
+    for (int i=0; i<int(statistics.iteration_seconds.size()); i++) {
+        PyList_SET_ITEM(iteration_seconds, i, 
+                        PyFloat_FromDouble(statistics.iteration_seconds[i]));
+    }
+    return Py_BuildValue("{s:i,s:d,s:d,s:L,s:L,s:N}", 
+        "iterations", statistics.iterations, 
+        "max_residual", double(statistics.residuals.max_residual), 
+        "mean_residual", double(statistics.residuals.mean()),
+        "messages", statistics.messages, 
+        "potentials", statistics.potentials, 
+        "iteration_seconds", iteration_seconds);
+}
+
+static PyMethodDef LoopyStateMethods[] = {
+    {"update_priors", (PyCFunction) LoopyState_update_priors, METH_VARARGS, 
+     "Replaces priors of latent patches."},
+    {"reset_messages", (PyCFunction) LoopyState_reset_messages, METH_NOARGS, 
+     "Sets all messages to uniform."},
+    {"get_messages", (PyCFunction) LoopyState_get_messages, METH_VARARGS, 
+     "Copies messages into a matrix."},
+    {"set_messages", (PyCFunction) LoopyState_set_messages, METH_VARARGS, 
+     "Replaces messages by a matrix."},
+    {"run", (PyCFunction) LoopyState_run, METH_VARARGS | METH_KEYWORDS, 
+     "Runs loopy belief propagation, continuing from current messages."},
+    {NULL, NULL, 0, NULL}        /* Sentinel */
+};
+
+static PyTypeObject LoopyStateType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+};
 }
 
 static PyMethodDef LoopyMethods[] = {
     {"loopy_belief_propagation",  loopy_belief_propagation, METH_VARARGS, ""},
+    {"loopy_belief_propagation_arrays",  loopy_belief_propagation_arrays, 
+     METH_VARARGS, ""},
+    {"overlap_strips",  overlap_strips, METH_VARARGS, ""},
+    {"pairwise_potentials",  pairwise_potentials, METH_VARARGS, ""},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -201,7 +1184,33 @@ extern "C" {
 PyMODINIT_FUNC
 PyInit_loopy(void)
 {
-    return PyModule_Create(&loopy);
+    LoopyStateType.tp_name = "loopy.LoopyState";
+    LoopyStateType.tp_doc = "MRF state kept between runs of loopy belief "
+                            "propagation.";
+    LoopyStateType.tp_basicsize = sizeof(LoopyStateObject);
+    LoopyStateType.tp_flags = Py_TPFLAGS_DEFAULT;
+    LoopyStateType.tp_new = PyType_GenericNew;
+    LoopyStateType.tp_init = (initproc) LoopyState_init;
+    LoopyStateType.tp_dealloc = (destructor) LoopyState_dealloc;
+    LoopyStateType.tp_methods = LoopyStateMethods;
+    if (PyType_Ready(&LoopyStateType) < 0) {
+        return NULL;
+    }
+
+    PyObject *module = PyModule_Create(&loopy);
+    if (module == NULL) {
+        return NULL;
+    }
+
+    Py_INCREF(&LoopyStateType);
+    if (PyModule_AddObject(
+            module, "LoopyState", (PyObject *) &LoopyStateType) < 0) {
+        Py_DECREF(&LoopyStateType);
+        Py_DECREF(module);
+        return NULL;
+    }
+
+    return module;
 }
 }
 
@@ -2,28 +2,62 @@
 #define CPP_MESSAGE
 
 #include <algorithm>
+#include <cmath>
+#include <limits>
 #include <vector>
 
-typedef long double ld;
-
 using namespace std;
 
 // Message holds the signals delivered from sender node to receiver node.
 // i-th element of the signal corresponds with how likely it is for 
 // the receiver node to have i-th value, conditioned on the subgraph
-// in direction of sender node.
+// in direction of sender node. Elements are stored as numbers of type "real",
+// or as their logarithms if "log_domain" is set (which avoids underflow when
+// the potentials are very small).
+template<class real, bool log_domain>
 struct Message {
-    vector<ld> elements;
+    vector<real> elements;
 
-    Message(int length, ld values) {
+    Message(int length, real values) {
         elements.resize(length, values);
     }
 
-    Message(vector<ld> &elements) : elements(elements) {}
+    Message(vector<real> &elements) : elements(elements) {}
+
+    // Creates a message with all elements representing probability 1.
+    static Message ones(int length) {
+        return Message(length, log_domain ? 0 : 1);
+    }
+
+    // Creates a normalized message with all elements equal, i.e. a message
+    // carrying no information.
+    static Message uniform(int length) {
+        return Message(length, log_domain ? -log(real(length)) : 1 / real(length));
+    }
+
+    // Returns the probability represented by i-th element.
+    real probability(int i) {
+        return log_domain ? exp(elements[i]) : elements[i];
+    }
 
     // Normalizes the message so that its elements sum to 1.
     void normalize_sum(){
-        ld sum = 0;
+        if (log_domain) {
+            real maxi = -numeric_limits<real>::infinity();
+            for(int i=0; i<int(elements.size()); i++){
+                maxi = max(maxi, elements[i]);
+            }
+            real sum = 0;
+            for(int i=0; i<int(elements.size()); i++){
+                sum += exp(elements[i] - maxi);
+            }
+            real log_sum = maxi + log(sum);
+            for(int i=0; i<int(elements.size()); i++){
+                elements[i] -= log_sum;
+            }
+            return;
+        }
+        real sum = 0;
         for(int i=0; i<int(elements.size()); i++){
             sum += elements[i];
         }
@@ -34,21 +68,44 @@ struct Message {
 
     // Normalizes the message so that its elements are in range [0, 1].
     void normalize_max(){
-        ld maxi = 0;
+        real maxi = log_domain ? -numeric_limits<real>::infinity() : 0;
         for(int i=0; i<int(elements.size()); i++){
             maxi = max(maxi, elements[i]);
         }
         for(int i=0; i<int(elements.size()); i++){
-            elements[i] /= maxi;
+            if (log_domain) {
+                elements[i] -= maxi;
+            } else {
+                elements[i] /= maxi;
+            }
         }
     }
 
+    // Returns the largest absolute difference of probabilities represented 
+    // by elements of two messages.
+    double max_difference(Message& other) {
+        double difference = 0;
+        for(int i=0; i<int(elements.size()); i++){
+            difference = max(difference, 
+                double(fabs(probability(i) - other.probability(i))));
+        }
+        return difference;
+    }
+
     // Poinntwise multiplies current message with another.
-    void multiply(Message& other) {
+    void multiply(vector<real>& other) {
         for(int i=0; i<int(elements.size()); i++){
-            elements[i] *= other.elements[i];
+            if (log_domain) {
+                elements[i] += other[i];
+            } else {
+                elements[i] *= other[i];
+            }
         }
     }
+
+    void multiply(Message& other) {
+        multiply(other.elements);
+    }
 };
 
-#endif
\ No newline at end of file
+#endif
@@ -0,0 +1,114 @@
+#ifndef CPP_PAIRWISE_POTENTIALS
+#define CPP_PAIRWISE_POTENTIALS
+
+#include <cmath>
+#include <vector>
+
+#include "buffer_matrix.cpp"
+#include "dictionary_patches.cpp"
+
+typedef long double ld;
+
+using namespace std;
+
+// Pairwise potentials of the MRF are precomputed into k x k tables, two for
+// each latent patch: for the edge to its right (direction 1) and to its bottom
+// (direction 2) neighbour. Tables are stored in a matrix with one row per 
+// latent patch, which holds the two tables one after another. Element [i][j] 
+// of a table is the potential between i-th candidate of the latent patch and 
+// j-th candidate of its neighbour. Potentials of edges to top and left 
+// neighbours are read from transposed tables of these neighbours.
+
+// Returns the position of the table of "direction" (right or bottom) 
+// within a row of the potentials matrix.
+inline int potential_table_offset(int direction, int k) {
+    return (direction - 1) * k * k;
+}
+
+// Gathers overlapping region pixels in "direction" of candidate dictionary 
+// patches into a contiguous k x region_size matrix and their squared norms.
+void gather_overlapping_regions(OverlapStrips &strips, int *candidates, 
+                                int k, int direction, vector<int> &regions, 
+                                vector<long long> &norms) {
+    int region_size = strips.region_size;
+    regions.resize(k * region_size);
+    norms.resize(k);
+    for (int i = 0; i < k; i++) {
+        unsigned char *region = strips.region(candidates[i], direction);
+        copy(region, region + region_size, regions.begin() + i * region_size);
+        norms[i] = strips.norm(candidates[i], direction);
+    }
+}
+
+// Fills the potentials matrix (see above) for latent patches in a grid, 
+// given their k best candidate dictionary patches. Overlap distances of all 
+// candidate pairs of an edge are computed at once as squared distances 
+// |a - b|^2 = |a|^2 + |b|^2 - 2 a.b of gathered overlapping regions. Tables 
+// of edges leading outside of the grid are filled with zeros. If 
+// "log_potentials" is set, logarithms of potentials are stored instead, 
+// which do not underflow for small sigmas. If "candidate_counts" is given, 
+// only the first candidate_counts[p] candidates of latent patch p are 
+// considered (the others were pruned, see LatentPatch), elements of tables 
+// of other candidates are zeros.
+template<class real>
+void compute_pairwise_potentials(OverlapStrips &strips,
+                                 int grid_rows, int grid_cols, 
+                                 MatrixView<int> k_best_patches, 
+                                 ld two_sigma2, bool log_potentials,
+                                 MatrixView<real> potentials,
+                                 int *candidate_counts = NULL) {
+    int k = k_best_patches.cols;
+    int region_size = strips.region_size;
+    ld normalization = ld(255 * 255) * region_size;
+
+    vector<int> regions, neighbour_regions;
+    vector<long long> norms, neighbour_norms;
+
+    int dx[4] = {0, 1, 0, -1}, dy[4] = {-1, 0, 1, 0};
+    for (int row = 0; row < grid_rows; row++) {
+        for (int col = 0; col < grid_cols; col++) {
+            int patch = row * grid_cols + col;
+            for (int direction = 1; direction <= 2; direction++) {
+                real *table = potentials.row(patch) + 
+                    potential_table_offset(direction, k);
+                int row2 = row + dy[direction], col2 = col + dx[direction];
+                if (row2 >= grid_rows || col2 >= grid_cols) {
+                    fill(table, table + k * k, real(0));
+                    continue;
+                }
+                int neighbour = row2 * grid_cols + col2;
+                int k1 = k, k2 = k;
+                if (candidate_counts != NULL) {
+                    k1 = candidate_counts[patch];
+                    k2 = candidate_counts[neighbour];
+                    fill(table, table + k * k, real(0));
+                }
+
+                gather_overlapping_regions(
+                    strips, k_best_patches.row(patch), k1, 
+                    direction, regions, norms);
+                gather_overlapping_regions(
+                    strips, k_best_patches.row(neighbour), k2, 
+                    (direction + 2) % 4, neighbour_regions, neighbour_norms);
+
+                for (int i = 0; i < k1; i++) {
+                    int *a = &regions[i * region_size];
+                    for (int j = 0; j < k2; j++) {
+                        int *b = &neighbour_regions[j * region_size];
+                        long long dot = 0;
+                        for (int x = 0; x < region_size; x++) {
+                            dot += a[x] * b[x];
+                        }
+                        ld distance = (norms[i] + neighbour_norms[j] - 2 * dot) 
+                            / normalization;
+                        table[i * k + j] = log_potentials ? 
+                            -distance / two_sigma2 : 
+                            exp(-distance / two_sigma2);
+                    }
+                }
+            }
+        }
+    }
+}
+
+#endif
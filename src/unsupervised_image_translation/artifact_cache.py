@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+
+# Container file: magic, version, length of a JSON header describing arrays
+# (dtype, shape and offset), the header and raw C-ordered array data, each
+# array starting at a multiple of ALIGNMENT bytes.
+MAGIC = b"UITCACHE"
+VERSION = 1
+ALIGNMENT = 64
+PREAMBLE = struct.Struct("<8sIQ")
+EXTENSION = ".arrays"
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_arrays(path, arrays):
+    """
+    Stores a dict of numeric NumPy arrays in a single container file.
+    """
+    arrays = {name: np.require(array, requirements="C")
+              for name, array in arrays.items()}
+
+    header = dict()
+    offset = 0
+    for name, array in sorted(arrays.items()):
+        if array.dtype.hasobject:
+            raise ValueError("Array {} can't be cached: it holds Python "
+                             "objects.".format(name))
+        header[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset = _aligned(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _aligned(PREAMBLE.size + len(header_bytes))
+
+    with open(path, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in sorted(arrays.items()):
+            f.seek(data_start + header[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+
+def replace_arrays(path, arrays):
+    """
+    Writes arrays like write_arrays under a temporary name in the same 
+    directory and then renames it to path, so that readers see either the 
+    previous or the new file, never a partially written one.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(fd)
+    try:
+        write_arrays(temporary_path, arrays)
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def read_arrays(path):
+    """
+    Returns a dict of read-only arrays memory-mapped from a container file.
+    Raises ValueError if the file is not a valid container.
+    """
+    with open(path, "rb") as f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) != PREAMBLE.size:
+            raise ValueError("Truncated cache file " + path)
+        magic, version, header_length = PREAMBLE.unpack(preamble)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Unknown cache file format of " + path)
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = _aligned(PREAMBLE.size + header_length)
+    file_size = os.path.getsize(path)
+
+    arrays = dict()
+    for name, info in header.items():
+        dtype = np.dtype(info["dtype"])
+        shape = tuple(info["shape"])
+        offset = data_start + info["offset"]
+        if offset + dtype.itemsize * int(np.prod(shape)) > file_size:
+            raise ValueError("Truncated cache file " + path)
+        if np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(
+                path, dtype=dtype, mode="r", offset=offset, 
+                shape=(shape or (1,))).reshape(shape)
+    return arrays
+
+
+def file_digest(path):
+    """
+    Returns SHA-256 of file content, so that cached artifacts are keyed by
+    image content rather than by path.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    """
+    Content-addressed on-disk cache of dicts of arrays. Each entry is a
+    container file named by a hash of its key fields. Entries older than
+    max_age seconds are evicted, then least recently used entries are
+    evicted until the cache holds at most max_bytes.
+    """
+    def __init__(self, directory, max_bytes=None, max_age=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, **fields):
+        """
+        Returns a key of an entry identified by JSON-serializable fields.
+        """
+        serialized = json.dumps(fields, sort_keys=True)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + EXTENSION)
+
+    def load(self, key):
+        """
+        Returns memory-mapped arrays stored under key or None on a miss.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            arrays = read_arrays(path)
+        except ValueError:
+            os.remove(path)
+            return None
+        # Modification time marks the last use for eviction.
+        os.utime(path, None)
+        return arrays
+
+    def store(self, key, arrays):
+        """
+        Stores a dict of arrays under key and evicts old entries. The file is
+        written under a temporary name first, so concurrent readers never
+        see a partially written entry.
+        """
+        replace_arrays(self.path(key), arrays)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes entries older than max_age, then least recently used entries
+        until total size is at most max_bytes.
+        """
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(EXTENSION):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+        entries.sort()
+
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            too_old = self.max_age is not None and now - mtime > self.max_age
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            if not (too_old or too_big):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,159 @@
+import contextlib
+import copy
+import multiprocessing
+import os
+import time
+import traceback
+
+from experiment import (prepare_argument_parser, set_up_experiment, run_em,
+                        prepare_style_model, create_style_model_search)
+from style_model import StyleModel
+
+# Translates many input images with one style in a single run. The source
+# image is compiled into a style model once (or -style_model is used), which
+# worker processes memory-map, and each of them fits the candidate search
+# once. Every input image gets its own output folder with MAP images,
+# args.txt and log.txt, and a line in summary.txt of the output folder.
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff")
+
+SUMMARY_COLUMNS = [
+    "image", "status", "setup_seconds", "em_seconds", "seconds",
+    "initial_log_posterior", "final_log_posterior",
+]
+
+
+def list_inputs(inputs):
+    """
+    Returns (name, path) pairs of input images in a directory or listed in a
+    manifest file, one path per line relative to the manifest; empty lines
+    and lines starting with # are skipped. Names are unique file names
+    without extension, used as names of output folders.
+    """
+    if os.path.isdir(inputs):
+        paths = [
+            os.path.join(inputs, filename)
+            for filename in sorted(os.listdir(inputs))
+            if filename.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+    else:
+        directory = os.path.dirname(inputs)
+        with open(inputs) as f:
+            lines = [line.strip() for line in f]
+        paths = [
+            os.path.join(directory, line) for line in lines
+            if line and not line.startswith("#")
+        ]
+
+    jobs = []
+    names = set()
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        unique_name, i = name, 1
+        while unique_name in names:
+            unique_name = "{}_{}".format(name, i)
+            i += 1
+        names.add(unique_name)
+        jobs.append((unique_name, path))
+    return jobs
+
+
+# State shared by translations in a worker process, set by init_worker.
+_worker_args = None
+_worker_style_model = None
+_worker_candidate_search = None
+
+
+def init_worker(args):
+    """
+    Loads the style model and fits the candidate search on its dictionary
+    once per worker process.
+    """
+    global _worker_args, _worker_style_model, _worker_candidate_search
+    _worker_args = args
+    _worker_style_model = StyleModel(args.style_model)
+    _worker_candidate_search = create_style_model_search(
+        args, _worker_style_model)
+
+
+def translate_image(job):
+    """
+    Translates one input image into its own output folder, printing into its
+    log.txt. Returns a dict with a value for each of SUMMARY_COLUMNS;
+    failure of one image is reported in it and does not stop the batch.
+    """
+    name, input_path = job
+    args = copy.copy(_worker_args)
+    args.input = input_path
+    args.output = os.path.join(_worker_args.output, name)
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    summary = dict.fromkeys(SUMMARY_COLUMNS, "-")
+    summary["image"] = name
+    start = time.time()
+    with open(os.path.join(args.output, "log.txt"), "w") as log, \
+            contextlib.redirect_stdout(log):
+        try:
+            _, em = set_up_experiment(
+                args, style_model=_worker_style_model,
+                candidate_search=_worker_candidate_search)
+            setup_end = time.time()
+            log_posteriors = run_em(args, em)
+            end = time.time()
+        except Exception:
+            traceback.print_exc(file=log)
+            summary["status"] = "failed"
+            summary["seconds"] = "{:.3f}".format(time.time() - start)
+            return summary
+
+    summary["status"] = "ok"
+    summary["setup_seconds"] = "{:.3f}".format(setup_end - start)
+    summary["em_seconds"] = "{:.3f}".format(end - setup_end)
+    summary["seconds"] = "{:.3f}".format(end - start)
+    summary["initial_log_posterior"] = "{:.6g}".format(log_posteriors[0])
+    summary["final_log_posterior"] = "{:.6g}".format(log_posteriors[-1])
+    return summary
+
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser(batch=True)
+    args, _ = argparser.parse_known_args()
+
+    jobs = list_inputs(args.inputs)
+    print("Input images:", len(jobs))
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    start = time.time()
+    prepare_style_model(args)
+    print("Style model prepared in {:.3f} s: {}".format(
+        time.time() - start, args.style_model))
+
+    workers = args.workers or multiprocessing.cpu_count()
+    workers = min(workers, len(jobs)) or 1
+    start = time.time()
+    with open(os.path.join(args.output, "summary.txt"), "w") as f:
+        f.write(" ".join(SUMMARY_COLUMNS) + "\n")
+        if workers == 1:
+            init_worker(args)
+            summaries = map(translate_image, jobs)
+        else:
+            pool = multiprocessing.Pool(
+                workers, initializer=init_worker, initargs=(args,))
+            summaries = pool.imap_unordered(translate_image, jobs)
+
+        failed = 0
+        for i, summary in enumerate(summaries, 1):
+            line = " ".join(summary[column] for column in SUMMARY_COLUMNS)
+            print("[{}/{}] {}".format(i, len(jobs), line))
+            f.write(line + "\n")
+            f.flush()
+            failed += summary["status"] != "ok"
+
+        if workers > 1:
+            pool.close()
+            pool.join()
+
+    print("Translated {} images ({} failed) in {:.3f} s with {} workers.".format(
+        len(jobs) - failed, failed, time.time() - start, workers))
@@ -0,0 +1,289 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+from scipy.misc import imsave
+
+from experiment import (prepare_argument_parser, create_patches, create_em,
+                        create_candidate_search)
+from metrics import Metrics
+
+# Performance benchmarks of the pipeline on synthetic images, which are
+# generated from a seed, so the suite runs offline and reproducibly. Every
+# case varies one parameter of a base case; each stage is timed by phases
+# recorded by metrics.Metrics, taking the minimum over repeats (as timeit,
+# the least disturbed by other processes). Each run is a fresh process, so
+# that its peak RSS is not that of an earlier, larger case. Results are
+# written to a JSON file, which can be compared to a stored baseline to flag
+# regressions of stages.
+
+BASE_CASE = {
+    "size": 256,
+    "patch_size": 10,
+    "pca_k": 12,
+    "num_candidates": 8,
+    "num_transformations": 3,
+}
+
+SUITES = {
+    "quick": {
+        "size": [128, 512],
+        "patch_size": [8],
+        "pca_k": [8],
+        "num_candidates": [4],
+        "num_transformations": [1],
+    },
+    "full": {
+        "size": [128, 512, 1024],
+        "patch_size": [6, 8, 15],
+        "pca_k": [6, 20, 30],
+        "num_candidates": [4, 16, 32],
+        "num_transformations": [1, 5],
+    },
+}
+
+# Stages and phases recorded by metrics whose times they sum. Phases nested
+# in these (pairwise_potentials in loopy) are not counted twice.
+STAGES = [
+    ("patch_extraction", ["patch_extraction"]),
+    ("pca", ["pca"]),
+    ("candidate_search", ["candidate_search"]),
+    ("lbp", ["loopy"]),
+    ("e_step", ["compute_posteriors"]),
+    ("m_step", ["recompute_lambdas", "recompute_psis"]),
+    ("reconstruction", ["reconstruction"]),
+]
+
+FORMAT = "benchmark/1"
+
+
+def synthetic_image(size, seed):
+    """
+    Returns a size x size 8-bit RGB image of a few random oriented waves
+    and smoothed noise, a texture with structure at several scales.
+    """
+    random = np.random.RandomState(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    image = np.zeros([size, size, 3])
+    for _ in range(6):
+        angle, frequency, phase = random.rand(3) * [np.pi, 30, 2 * np.pi]
+        wave = np.sin(2 * np.pi * frequency *
+                      (x * np.cos(angle) + y * np.sin(angle)) + phase)
+        image += wave[:, :, np.newaxis] * random.rand(3)
+
+    noise = random.rand(size, size, 3)
+    for _ in range(3):
+        noise = (noise + np.roll(noise, 1, axis=0) + np.roll(noise, 1, axis=1)) / 3
+    image += 2 * noise
+
+    image -= image.min()
+    return (255 * image / image.max()).astype(np.uint8)
+
+
+def suite_cases(suite):
+    """
+    Returns (name, parameters) of the base case and of cases which vary one
+    of its parameters by values of the suite.
+    """
+    cases = [("base", dict(BASE_CASE))]
+    for name, values in SUITES[suite].items():
+        for value in values:
+            if value == BASE_CASE[name]:
+                continue
+            parameters = dict(BASE_CASE)
+            parameters[name] = value
+            cases.append(("{}={}".format(name, value), parameters))
+    return cases
+
+
+def case_arguments(parameters, images_dir, output, em_iterations):
+    """
+    Returns experiment arguments of a case, synthetic input and source
+    images of its size are created in images_dir if they do not exist.
+    """
+    size = parameters["size"]
+    paths = []
+    for kind, seed in [("input", 1), ("source", 2)]:
+        path = os.path.join(images_dir, "{}_{}.png".format(kind, size))
+        if not os.path.exists(path):
+            imsave(path, synthetic_image(size, seed))
+        paths.append(path)
+
+    argv = [
+        "-input={}".format(paths[0]), "-source={}".format(paths[1]),
+        "-output={}".format(output), "-color=yiq",
+        "-em_iterations={}".format(em_iterations),
+    ]
+    argv += ["-{}={}".format(name, value) for name, value in parameters.items()
+             if name != "size"]
+    args, _ = prepare_argument_parser().parse_known_args(argv)
+    return args
+
+
+def run_case(args):
+    """
+    Runs the pipeline once and returns seconds of each stage and the peak
+    RSS of the process, see run_case_in_process.
+    """
+    records = []
+    metrics = Metrics(callbacks=[records.append])
+    np.random.seed(args.random_seed)
+    patches = create_patches(args, metrics=metrics)
+    em = create_em(args, patches, create_candidate_search(args),
+                   metrics=metrics)
+    for _ in range(args.em_iterations):
+        em.execute_iteration()
+        with metrics.phase("reconstruction"):
+            em.MAP_image()
+
+    seconds = dict()
+    for stage, phases in STAGES:
+        seconds[stage] = sum(record["wall_seconds"] for record in records
+                             if record["phase"] in phases)
+    return seconds, max(record["max_rss_mb"] for record in records)
+
+
+def run_case_in_process(args, log_path):
+    """
+    Runs run_case in a new process, printing into log_path, and returns its
+    results.
+    """
+    with multiprocessing.Pool(1) as pool:
+        return pool.apply(logged_run_case, (args, log_path))
+
+
+def logged_run_case(args, log_path):
+    with open(log_path, "a") as log, contextlib.redirect_stdout(log):
+        return run_case(args)
+
+
+def run_suite(suite, output, repeats=5, em_iterations=1):
+    """
+    Runs all cases of a suite, each repeats times in new processes, and
+    returns results with the minimal seconds of each stage and the largest
+    peak RSS of a run. Prints of the pipeline go to output/log.txt.
+    """
+    images_dir = os.path.join(output, "images")
+    if not os.path.exists(images_dir):
+        os.makedirs(images_dir)
+    log_path = os.path.join(output, "log.txt")
+    open(log_path, "w").close()
+
+    results = []
+    for name, parameters in suite_cases(suite):
+        args = case_arguments(parameters, images_dir,
+                              os.path.join(output, "runs"), em_iterations)
+        runs = [run_case_in_process(args, log_path) for _ in range(repeats)]
+        stages = {
+            stage: min(seconds[stage] for seconds, _ in runs)
+            for stage, _ in STAGES
+        }
+        results.append({
+            "case": name,
+            "parameters": parameters,
+            "stages": stages,
+            "total_seconds": sum(stages.values()),
+            "max_rss_mb": max(rss for _, rss in runs),
+        })
+        print("{} {:.3f} s".format(name, results[-1]["total_seconds"]))
+
+    return {
+        "format": FORMAT,
+        "suite": suite,
+        "repeats": repeats,
+        "em_iterations": em_iterations,
+        "environment": environment(),
+        "results": results,
+    }
+
+
+def environment():
+    import scipy
+    import sklearn
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "sklearn": sklearn.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def compare(baseline, current, threshold=0.25, min_seconds=0.01):
+    """
+    Returns lines comparing stages of cases present in both results and the
+    number of regressions: stages slower than the baseline by more than
+    threshold (relative) and min_seconds (absolute, ignoring noise of very
+    short stages).
+    """
+    baseline_cases = {result["case"]: result for result in baseline["results"]}
+    lines = ["case stage baseline_seconds seconds change status"]
+    regressions = 0
+    for result in current["results"]:
+        base = baseline_cases.get(result["case"])
+        if base is None:
+            lines.append("{} - - - - new".format(result["case"]))
+            continue
+        for stage, _ in STAGES:
+            before, after = base["stages"][stage], result["stages"][stage]
+            change = (after - before) / before if before > 0 else 0
+            status = "ok"
+            if after - before > min_seconds and change > threshold:
+                status = "REGRESSION"
+                regressions += 1
+            elif before - after > min_seconds and -change > threshold:
+                status = "improved"
+            lines.append("{} {} {:.4f} {:.4f} {:+.1%} {}".format(
+                result["case"], stage, before, after, change, status))
+    return lines, regressions
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Benchmark stages of the pipeline on synthetic images.")
+    argparser.add_argument("-output", default="benchmark",
+        help="Output folder, results are written to benchmark.json.")
+    argparser.add_argument("-suite", default="quick", choices=SUITES.keys(),
+        help="Cases to run, each varies one parameter of the base case.")
+    argparser.add_argument("-repeats", type=int, default=5,
+        help="Number of runs of each case, the minimal time of each stage is reported.")
+    argparser.add_argument("-em_iterations", type=int, default=1,
+        help="Number of EM iterations of each run.")
+    argparser.add_argument("-results", default=None,
+        help="Compare existing results instead of running the suite.")
+    argparser.add_argument("-compare", default=None,
+        help="Baseline results to compare with, exits with status 1 on regressions.")
+    argparser.add_argument("-threshold", type=float, default=0.25,
+        help="Relative slowdown of a stage reported as a regression.")
+    argparser.add_argument("-min_seconds", type=float, default=0.01,
+        help="Slowdowns of a stage by fewer seconds are never regressions.")
+    args = argparser.parse_args()
+
+    if args.results is not None:
+        with open(args.results) as f:
+            current = json.load(f)
+    else:
+        if not os.path.exists(args.output):
+            os.makedirs(args.output)
+        current = run_suite(args.suite, args.output, args.repeats,
+                            args.em_iterations)
+        with open(os.path.join(args.output, "benchmark.json"), "w") as f:
+            json.dump(current, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(baseline, current, args.threshold,
+                                     args.min_seconds)
+        print("\n".join(lines))
+        print("Regressions:", regressions)
+        sys.exit(1 if regressions else 0)
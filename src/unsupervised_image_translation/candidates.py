@@ -0,0 +1,322 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from sklearn.cluster import KMeans
+
+
+# Number of observed and dictionary vectors compared at once. Peak memory of
+# nearest_candidates is proportional to block_size * block_size.
+DEFAULT_BLOCK_SIZE = 1024
+
+
+def squared_distances(vectors, other_vectors):
+    """
+    Returns a 2D array of squared Euclidean distances between every row of
+    vectors and every row of other_vectors.
+    """
+    distances = (
+        np.sum(vectors ** 2, axis=1)[:, np.newaxis] -
+        2 * np.dot(vectors, other_vectors.T) +
+        np.sum(other_vectors ** 2, axis=1)[np.newaxis, :]
+    )
+    return np.maximum(distances, 0)
+
+
+def merge_nearest(indices, distances, new_indices, new_distances, k):
+    """
+    Merges two sets of dictionary vectors found for each observed vector
+    (rows of 2D arrays of their indices and distances) and keeps at most k
+    nearest of them, in arbitrary order.
+    """
+    indices = np.hstack([indices, new_indices])
+    distances = np.hstack([distances, new_distances])
+    if distances.shape[1] <= k:
+        return indices, distances
+
+    rows = np.arange(distances.shape[0])[:, np.newaxis]
+    nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return indices[rows, nearest], distances[rows, nearest]
+
+
+def sort_from_farthest(indices, distances):
+    """
+    Orders dictionary vectors found for each observed vector from the
+    farthest to the nearest one (from the least to the most probable).
+    """
+    rows = np.arange(distances.shape[0])[:, np.newaxis]
+    order = np.argsort(-distances, axis=1)
+    return indices[rows, order], distances[rows, order]
+
+
+def nearest_candidates(observed_vectors, dictionary_vectors, k,
+                       block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Exact search of k nearest dictionary vectors for each observed vector,
+    i.e. k most probable dictionary patches under a normal distribution with
+    identity covariance. Streams over blocks of observed and dictionary
+    vectors, so at most block_size x block_size distances are held in memory.
+    Returns a 2D array of indices of nearest dictionary vectors and a 2D
+    array of their squared distances, both ordered from the farthest to the
+    nearest vector (from the least to the most probable).
+    """
+    patch_count = observed_vectors.shape[0]
+    dictionary_size = dictionary_vectors.shape[0]
+    k = min(k, dictionary_size)
+
+    k_indices = np.empty([patch_count, k], dtype=int)
+    k_distances = np.empty([patch_count, k])
+    for start in range(0, patch_count, block_size):
+        observed_block = observed_vectors[start:(start + block_size)]
+        block_indices = np.empty([observed_block.shape[0], 0], dtype=int)
+        block_distances = np.empty([observed_block.shape[0], 0])
+
+        for dictionary_start in range(0, dictionary_size, block_size):
+            dictionary_block = dictionary_vectors[
+                dictionary_start:(dictionary_start + block_size)]
+            new_indices = np.broadcast_to(
+                np.arange(dictionary_start,
+                          dictionary_start + dictionary_block.shape[0]),
+                [observed_block.shape[0], dictionary_block.shape[0]])
+            block_indices, block_distances = merge_nearest(
+                block_indices, block_distances, new_indices,
+                squared_distances(observed_block, dictionary_block), k)
+
+        k_indices[start:(start + block_size)], \
+            k_distances[start:(start + block_size)] = \
+            sort_from_farthest(block_indices, block_distances)
+
+    return k_indices, k_distances
+
+
+def recall_at_k(indices, exact_indices):
+    """
+    Returns the average fraction of exact k nearest candidates of a patch
+    which were also found by an approximate search.
+    """
+    found = [
+        len(np.intersect1d(row, exact_row))
+        for row, exact_row in zip(indices, exact_indices)
+    ]
+    return np.mean(found) / exact_indices.shape[1]
+
+
+def keep_above_threshold(probabilities, threshold):
+    """
+    Returns a boolean array marking candidates whose probability (rows of
+    probabilities of candidates of patches) is at least threshold.
+    """
+    return probabilities >= threshold
+
+
+def keep_mass(probabilities, mass):
+    """
+    Returns a boolean array marking for each patch the smallest set of its
+    most probable candidates whose probabilities sum to at least a fraction
+    mass of the total.
+    """
+    rows = np.arange(probabilities.shape[0])[:, np.newaxis]
+    order = np.argsort(-probabilities, axis=1, kind="stable")
+    sorted_probabilities = probabilities[rows, order]
+    preceding = np.cumsum(sorted_probabilities, axis=1) - sorted_probabilities
+    total = np.sum(probabilities, axis=1, keepdims=True)
+    keep = np.empty(probabilities.shape, dtype=bool)
+    keep[rows, order] = preceding < mass * total
+    return keep
+
+
+class ExactSearch:
+    """
+    Brute-force candidate search, see nearest_candidates.
+    """
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE):
+        self.block_size = block_size
+
+    def fit(self, dictionary_vectors):
+        self.dictionary_vectors = dictionary_vectors
+        return self
+
+    def search(self, observed_vectors, k):
+        return nearest_candidates(observed_vectors, self.dictionary_vectors,
+                                  k, block_size=self.block_size)
+
+    def index_arrays(self):
+        """
+        Returns a dict of arrays of the fitted index other than dictionary
+        vectors, from which restore_index rebuilds it (e.g. stored in a
+        style model). Brute force has none.
+        """
+        return {}
+
+    def restore_index(self, dictionary_vectors, arrays):
+        return self.fit(dictionary_vectors)
+
+
+class KDTreeSearch:
+    """
+    Exact candidate search with a KD-tree over dictionary vectors. It is
+    faster than brute force only if pca_k is small.
+    """
+    def __init__(self, leaf_size=16):
+        self.leaf_size = leaf_size
+
+    def fit(self, dictionary_vectors):
+        self.tree = cKDTree(dictionary_vectors, leafsize=self.leaf_size)
+        return self
+
+    def search(self, observed_vectors, k):
+        k = min(k, self.tree.n)
+        distances, indices = self.tree.query(observed_vectors, k=k)
+        distances = distances.reshape([-1, k])
+        indices = indices.reshape([-1, k])
+        return sort_from_farthest(indices, distances ** 2)
+
+    def index_arrays(self):
+        # The tree is built again from dictionary vectors, which is fast.
+        return {}
+
+    def restore_index(self, dictionary_vectors, arrays):
+        return self.fit(dictionary_vectors)
+
+
+class IVFSearch:
+    """
+    Approximate candidate search with an inverted file index: dictionary
+    vectors are clustered by k-means into "lists" lists and each observed
+    vector is compared only with vectors in "probes" lists with the nearest
+    centroids. Patches for which the probed lists hold fewer than k vectors
+    are searched exactly.
+    """
+    def __init__(self, lists=None, probes=1, seed=0):
+        self.lists = lists
+        self.probes = probes
+        self.seed = seed
+
+    def fit(self, dictionary_vectors):
+        lists = self.lists or max(1, int(round(np.sqrt(len(dictionary_vectors)))))
+        kmeans = KMeans(n_clusters=lists, n_init=1, random_state=self.seed)
+        labels = kmeans.fit_predict(dictionary_vectors)
+        return self.use_lists(dictionary_vectors, kmeans.cluster_centers_,
+                              labels)
+
+    def use_lists(self, dictionary_vectors, centroids, labels):
+        self.dictionary_vectors = dictionary_vectors
+        self.centroids = centroids
+        self.labels = labels
+        self.list_members = [
+            np.flatnonzero(labels == c) for c in range(len(centroids))
+        ]
+        return self
+
+    def index_arrays(self):
+        return {"centroids": self.centroids, "labels": self.labels}
+
+    def restore_index(self, dictionary_vectors, arrays):
+        return self.use_lists(dictionary_vectors,
+                              np.array(arrays["centroids"]),
+                              np.array(arrays["labels"]))
+
+    def search(self, observed_vectors, k):
+        patch_count = observed_vectors.shape[0]
+        k = min(k, self.dictionary_vectors.shape[0])
+        probes = min(self.probes, len(self.list_members))
+
+        centroid_distances = squared_distances(observed_vectors, self.centroids)
+        probed_lists = np.argpartition(
+            centroid_distances, probes - 1, axis=1)[:, :probes]
+
+        k_indices = np.full([patch_count, k], -1, dtype=int)
+        k_distances = np.full([patch_count, k], np.inf)
+        for c, members in enumerate(self.list_members):
+            rows = np.flatnonzero(np.any(probed_lists == c, axis=1))
+            if len(rows) == 0 or len(members) == 0:
+                continue
+            k_indices[rows], k_distances[rows] = merge_nearest(
+                k_indices[rows], k_distances[rows],
+                np.broadcast_to(members, [len(rows), len(members)]),
+                squared_distances(observed_vectors[rows],
+                                  self.dictionary_vectors[members]), k)
+
+        incomplete = np.flatnonzero(np.isinf(k_distances).any(axis=1))
+        if len(incomplete) > 0:
+            k_indices[incomplete], k_distances[incomplete] = nearest_candidates(
+                observed_vectors[incomplete], self.dictionary_vectors, k)
+
+        return sort_from_farthest(k_indices, k_distances)
+
+
+class FittedSearch:
+    """
+    Wraps a candidate search backend fitted in advance (e.g. an index stored 
+    in a style model), which is not fitted again.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def fit(self, dictionary_vectors):
+        return self
+
+    def search(self, observed_vectors, k):
+        return self.backend.search(observed_vectors, k)
+
+
+class PrecomputedSearch:
+    """
+    Returns candidates found earlier for the same observed vectors (e.g. 
+    for a tile in a previous pass of tiled translation).
+    """
+    def __init__(self, indices, distances):
+        self.indices = indices
+        self.distances = distances
+
+    def fit(self, dictionary_vectors):
+        return self
+
+    def search(self, observed_vectors, k):
+        return self.indices, self.distances
+
+
+class CachedSearch:
+    """
+    Wraps a candidate search backend and stores found candidates in an 
+    artifact_cache.ArtifactCache, under a key made of the patches (see 
+    Patches.cache_key), the backend, its settings and k. The backend is 
+    fitted only on a cache miss.
+    """
+    def __init__(self, backend, cache, patches_key):
+        self.backend = backend
+        self.cache = cache
+        self.key_fields = dict(
+            kind="candidates",
+            patches=patches_key,
+            backend=type(backend).__name__,
+            settings=dict(vars(backend)),
+        )
+
+    def fit(self, dictionary_vectors):
+        self.dictionary_vectors = dictionary_vectors
+        return self
+
+    def search(self, observed_vectors, k):
+        key = self.cache.key(k=k, **self.key_fields)
+        artifacts = self.cache.load(key)
+        if artifacts is not None:
+            return np.array(artifacts["indices"]), np.array(artifacts["distances"])
+
+        indices, distances = self.backend.fit(self.dictionary_vectors).search(
+            observed_vectors, k)
+        self.cache.store(key, {"indices": indices, "distances": distances})
+        return indices, distances
+
+
+candidate_searches = {
+    "exact": ExactSearch,
+    "kdtree": KDTreeSearch,
+    "ivf": IVFSearch,
+}
+
+# Rules of EM.prune_candidates, functions of probabilities of candidates and
+# a parameter (-prune_threshold or -prune_mass) which return candidates to
+# keep.
+candidate_pruning = {
+    "threshold": keep_above_threshold,
+    "mass": keep_mass,
+}
@@ -0,0 +1,103 @@
+import json
+import os
+
+import numpy as np
+
+import artifact_cache
+import candidates
+from patches import global_random_state, set_global_random_state
+
+# Checkpoints of EM: its state after an iteration (see EM.checkpoint_state)
+# and the state of NumPy's random generator in a single container file of
+# artifact_cache, replaced at once when saved again. EM resumed from a
+# checkpoint with the same arguments continues exactly as the original run.
+# Arguments which do not change shapes of the state (e.g. of loopy or of
+# covariances) can differ, so that new settings branch off the checkpoint.
+
+FORMAT = "checkpoint/2"
+
+FILENAME = "checkpoint" + artifact_cache.EXTENSION
+
+
+def checkpoint_path(path):
+    """
+    Returns path of the checkpoint file in a folder, or path of a file.
+    """
+    if os.path.isdir(path):
+        return os.path.join(path, FILENAME)
+    return path
+
+
+def save_checkpoint(path, em):
+    arrays = em.checkpoint_state()
+    arrays.update(global_random_state())
+    settings = {
+        "format": FORMAT,
+        "covariance": em.covariance,
+        "psis": len(em.psis),
+    }
+    arrays["settings"] = np.frombuffer(
+        json.dumps(settings).encode("utf-8"), np.uint8)
+    artifact_cache.replace_arrays(path, arrays)
+
+
+class Checkpoint:
+    """
+    Checkpoint saved by save_checkpoint, memory-mapped from its file.
+    """
+    def __init__(self, path):
+        self.path = checkpoint_path(path)
+        self.arrays = artifact_cache.read_arrays(self.path)
+        if "settings" not in self.arrays:
+            raise ValueError("{} is not a checkpoint.".format(self.path))
+        self.settings = json.loads(
+            self.arrays["settings"].tobytes().decode("utf-8"))
+        if self.settings.get("format") != FORMAT:
+            raise ValueError("{} has unknown checkpoint format {}.".format(
+                self.path, self.settings.get("format")))
+        self.iteration = int(self.arrays["iteration"])
+
+    def check_shapes(self, patch_count, num_candidates, num_transformations,
+                     pca_k):
+        """
+        Raises ValueError if EM with given settings can't continue from the
+        checkpoint.
+        """
+        shapes = [
+            ("probs", (patch_count, num_candidates, num_transformations)),
+            ("lambdas", (num_transformations, pca_k, pca_k)),
+        ]
+        for name, shape in shapes:
+            if self.arrays[name].shape != shape:
+                raise ValueError(
+                    "Checkpoint {} has {} of shape {}, not {}.".format(
+                        self.path, name, self.arrays[name].shape, shape))
+
+    def candidate_search(self):
+        return candidates.PrecomputedSearch(
+            np.array(self.arrays["candidate_indices"]),
+            np.array(self.arrays["candidate_distances"]))
+
+    def state(self, covariance, warm_start):
+        """
+        Returns state of EM for its constructor, with counts of candidates
+        if they were pruned. Psis are recomputed if the covariance structure
+        differs and loopy messages are used only with warm start.
+        """
+        state = {
+            name: self.arrays[name]
+            for name in ["iteration", "probs", "loopy_probs", "lambdas"]
+        }
+        if covariance == self.settings["covariance"]:
+            state["psis"] = [
+                self.arrays["psis_{}".format(i)]
+                for i in range(self.settings["psis"])
+            ]
+        if "candidate_counts" in self.arrays:
+            state["candidate_counts"] = self.arrays["candidate_counts"]
+        if warm_start and "initial_lbp_messages" in self.arrays:
+            state["initial_lbp_messages"] = self.arrays["initial_lbp_messages"]
+        return state
+
+    def restore_random_state(self):
+        set_global_random_state(self.arrays)
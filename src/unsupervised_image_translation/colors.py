@@ -0,0 +1,164 @@
+import abc
+
+import numpy as np
+
+
+# Number of pixels converted at once. Temporary arrays of a conversion hold
+# a few times this many values, regardless of image size.
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+class ColorSpace(abc.ABC):
+    """
+    Luminance / chrominance color space. Images are arrays [..., 3] with RGB
+    values in [0, 1]; channel 0 of a converted image is luminance, also
+    scaled to [0, 1], which is the channel translated by patches.
+    Conversions keep floating point type of the image (e.g. float32) and
+    process it in chunks of pixels, so they can be done in place.
+    """
+    @abc.abstractmethod
+    def convert_pixels_from_rgb(self, pixels):
+        """
+        Returns a 2D array [pixels, 3] of RGB pixels converted to this color
+        space, of the same floating point type.
+        """
+
+    @abc.abstractmethod
+    def convert_pixels_to_rgb(self, pixels):
+        """
+        Returns a 2D array [pixels, 3] of pixels of this color space
+        converted to RGB clipped to [0, 1], of the same floating point type.
+        """
+
+    def from_rgb(self, image, out=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Converts RGB image to this color space. Pass out=image to convert
+        a floating point image in place.
+        """
+        return self._convert(self.convert_pixels_from_rgb, image, out,
+                             chunk_size)
+
+    def to_rgb(self, image, out=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Converts image from this color space to RGB clipped to [0, 1]. Pass
+        out=image to convert a floating point image in place.
+        """
+        return self._convert(self.convert_pixels_to_rgb, image, out,
+                             chunk_size)
+
+    def _convert(self, convert_pixels, image, out, chunk_size):
+        image = np.asarray(image)
+        if out is None:
+            dtype = image.dtype if image.dtype.kind == "f" else np.float64
+            out = np.empty(image.shape, dtype=dtype)
+
+        pixels = image.reshape([-1, 3])
+        out_pixels = out.reshape([-1, 3])
+        for start in range(0, pixels.shape[0], chunk_size):
+            chunk = slice(start, start + chunk_size)
+            out_pixels[chunk] = convert_pixels(
+                pixels[chunk].astype(out.dtype, copy=False))
+        return out
+
+
+class LinearColorSpace(ColorSpace):
+    """
+    Color space given by an affine transform of RGB values.
+    """
+    def __init__(self, matrix, offset=(0, 0, 0), inverse_matrix=None):
+        self.matrix = np.array(matrix, dtype=np.float64)
+        self.offset = np.array(offset, dtype=np.float64)
+        if inverse_matrix is None:
+            inverse_matrix = np.linalg.inv(self.matrix)
+        self.inverse_matrix = np.array(inverse_matrix, dtype=np.float64)
+
+    def convert_pixels_from_rgb(self, pixels):
+        converted = np.dot(pixels, self.matrix.T.astype(pixels.dtype))
+        converted += self.offset.astype(pixels.dtype)
+        return converted
+
+    def convert_pixels_to_rgb(self, pixels):
+        rgb = np.dot(pixels - self.offset.astype(pixels.dtype),
+                     self.inverse_matrix.T.astype(pixels.dtype))
+        return np.clip(rgb, 0, 1, out=rgb)
+
+
+class LabColorSpace(ColorSpace):
+    """
+    CIE L*a*b* color space of sRGB images with D65 white point. L* is
+    divided by 100 to lie in [0, 1], a* and b* are kept as they are.
+    """
+    rgb_to_xyz = np.array([
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ])
+    white_point = np.array([0.95047, 1.0, 1.08883])
+    delta = 6 / 29
+
+    def convert_pixels_from_rgb(self, pixels):
+        linear = np.where(pixels <= 0.04045, pixels / 12.92,
+                          ((pixels + 0.055) / 1.055) ** 2.4)
+        xyz = np.dot(linear, self.rgb_to_xyz.T.astype(pixels.dtype))
+        xyz /= self.white_point.astype(pixels.dtype)
+        f = np.where(xyz > self.delta ** 3, np.cbrt(xyz),
+                     xyz / (3 * self.delta ** 2) + 4 / 29)
+
+        lab = np.empty(pixels.shape, dtype=pixels.dtype)
+        lab[:, 0] = (116 * f[:, 1] - 16) / 100
+        lab[:, 1] = 500 * (f[:, 0] - f[:, 1])
+        lab[:, 2] = 200 * (f[:, 1] - f[:, 2])
+        return lab
+
+    def convert_pixels_to_rgb(self, pixels):
+        f = np.empty(pixels.shape, dtype=pixels.dtype)
+        f[:, 1] = (pixels[:, 0] * 100 + 16) / 116
+        f[:, 0] = f[:, 1] + pixels[:, 1] / 500
+        f[:, 2] = f[:, 1] - pixels[:, 2] / 200
+        xyz = np.where(f > self.delta, f ** 3,
+                       3 * self.delta ** 2 * (f - 4 / 29))
+        xyz *= self.white_point.astype(pixels.dtype)
+
+        linear = np.dot(
+            xyz, np.linalg.inv(self.rgb_to_xyz).T.astype(pixels.dtype))
+        np.clip(linear, 0, 1, out=linear)
+        rgb = np.where(linear <= 0.0031308, 12.92 * linear,
+                       1.055 * linear ** (1 / 2.4) - 0.055)
+        return np.clip(rgb, 0, 1, out=rgb)
+
+
+# YIQ with the same coefficients as colorsys.rgb_to_yiq and yiq_to_rgb.
+yiq = LinearColorSpace(
+    matrix=[
+        [0.30, 0.59, 0.11],
+        [0.74 * 0.70 + 0.27 * 0.30, -0.74 * 0.59 + 0.27 * 0.59,
+         -0.74 * 0.11 - 0.27 * 0.89],
+        [0.48 * 0.70 - 0.41 * 0.30, -0.48 * 0.59 - 0.41 * 0.59,
+         -0.48 * 0.11 + 0.41 * 0.89],
+    ],
+    inverse_matrix=[
+        [1, 0.9468822170900693, 0.6235565819861433],
+        [1, -0.27478764629897834, -0.6356910791873801],
+        [1, -1.1085450346420322, 1.7090069284064666],
+    ],
+)
+
+# Full-range YCbCr of JPEG (ITU-R BT.601), chrominance centered at 0.5.
+ycbcr = LinearColorSpace(
+    matrix=[
+        [0.299, 0.587, 0.114],
+        [-0.168736, -0.331264, 0.5],
+        [0.5, -0.418688, -0.081312],
+    ],
+    offset=[0, 0.5, 0.5],
+)
+
+lab = LabColorSpace()
+
+# Color spaces selectable by -color, "color" is kept as an alias of YIQ.
+color_spaces = {
+    "yiq": yiq,
+    "color": yiq,
+    "ycbcr": ycbcr,
+    "lab": lab,
+}
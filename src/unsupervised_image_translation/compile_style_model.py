@@ -0,0 +1,60 @@
+import argparse
+
+import candidates
+import colors
+from experiment import create_candidate_search
+from style_model import compile_style_model
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Compiles a source image (style) into a style model file, which can be "
+                    "passed to unsupervised image translation as -style_model instead of -source.")
+
+    argparser.add_argument("-source", required=True, 
+        help="Path to source image (style).")
+    argparser.add_argument("-output", required=True, 
+        help="Path to the style model file.")
+    argparser.add_argument("-color", default="gray", 
+        help="Color space of translation, a luminance / chrominance color space (\"color\" is YIQ).", 
+        choices=["gray"] + list(colors.color_spaces.keys()))
+    argparser.add_argument("-patch_size", type=int, default=15, 
+        help="Source image will be split to patch_size x patch_size squares.")
+    argparser.add_argument("-patch_overlap", type=int, default=3, 
+        help="Overlap depth of two neighbouring patches.")
+    argparser.add_argument("-pca_k", type=int, default=50, 
+        help="Number of PCA components of patches, fitted on the source image only.")
+
+    argparser.add_argument("-candidate_search", default=None, 
+        help="Backend of candidate search whose index is stored in the model, none by default.", 
+        choices=candidates.candidate_searches.keys())
+    argparser.add_argument("-candidate_block_size", type=int, 
+        default=candidates.DEFAULT_BLOCK_SIZE, 
+        help="Number of patches compared at once in exact candidate search.")
+    argparser.add_argument("-ivf_lists", type=int, default=None, 
+        help="Number of k-means lists of the ivf search, sqrt of dictionary size by default.")
+    argparser.add_argument("-ivf_probes", type=int, default=1, 
+        help="Number of lists searched by the ivf search for each patch.")
+
+    argparser.add_argument("-random_seed", type=int, default=0, 
+        help="Seed for random number generators.")
+
+    args = argparser.parse_args()
+
+    candidate_search = None
+    if args.candidate_search is not None:
+        candidate_search = create_candidate_search(args)
+
+    settings = compile_style_model(
+        source_path=args.source, 
+        model_path=args.output, 
+        patch_size=args.patch_size, 
+        patch_overlap=args.patch_overlap, 
+        pca_k=args.pca_k, 
+        color=(None if args.color == "gray" else args.color), 
+        candidate_search=candidate_search, 
+        random_state=args.random_seed,
+    )
+    print("Style model written to", args.output)
+    for name, value in sorted(settings.items()):
+        print("{:<17}: {}".format(name, value))
@@ -0,0 +1,377 @@
+import argparse
+import base64
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+
+import candidates
+from artifact_cache import file_digest
+from experiment import (prepare_argument_parser, set_up_experiment, run_em,
+                        load_style_model, create_candidate_search,
+                        create_style_model_search)
+from style_model import SETTINGS, compile_style_model
+
+# Long-running translation worker. Jobs are JSON requests, one per line, read
+# from stdin or from connections to a Unix socket; events of each job
+# (set-up, every EM iteration with its MAP image, result or error) are
+# written back as JSON lines. Imports, the loopy extension and the following
+# artifacts stay in memory between jobs, in an LRU cache with a size limit:
+#
+# - style models compiled from source images (dictionary patches and PCA
+#   fitted on the source) with fitted candidate searches,
+# - candidates of input images,
+# - pairwise potentials of loopy for these candidates.
+#
+# A request is {"id": ..., "args": [...]} with arguments of main.py as a list
+# (["-input=a.png", "-source=b.png"]) or a dict ({"input": "a.png", ...}, true
+# for flags), and optionally "inline_images": true to receive MAP images as
+# base64 PNG. {"command": "stats"} returns statistics of the cache and
+# {"command": "shutdown"} stops the worker.
+
+
+class LRUCache:
+    """
+    In-memory cache of values with given sizes in bytes. Least recently used
+    values are evicted when the total size exceeds max_bytes; a value larger
+    than max_bytes is not stored.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value, size):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def statistics(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def object_bytes(value, depth=3):
+    """
+    Returns total size of NumPy arrays held by a value, its attributes and
+    items (up to a depth), an estimate of its memory.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if depth == 0:
+        return 0
+    if isinstance(value, dict):
+        values = value.values()
+    elif isinstance(value, (list, tuple)):
+        values = value
+    elif hasattr(value, "__dict__"):
+        values = vars(value).values()
+    else:
+        return 0
+    return sum(object_bytes(item, depth - 1) for item in values)
+
+
+def argument_list(arguments):
+    """
+    Converts arguments of a request to a list of command line arguments.
+    """
+    if not isinstance(arguments, dict):
+        return [str(argument) for argument in arguments]
+    argv = []
+    for name, value in arguments.items():
+        if value is True:
+            argv.append("-{}".format(name))
+        elif value is not False and value is not None:
+            argv.append("-{}={}".format(name, value))
+    return argv
+
+
+class Translator:
+    """
+    Runs translation jobs, keeping artifacts shared by them in an LRU cache
+    of max_bytes. Style models compiled from source images are written to
+    model_dir.
+    """
+    def __init__(self, model_dir, max_bytes):
+        self.model_dir = model_dir
+        self.cache = LRUCache(max_bytes)
+        self.argparser = prepare_argument_parser()
+
+    def parse_arguments(self, arguments):
+        argv = argument_list(arguments)
+        # Errors of argparse exit, they are reported as errors of the job.
+        try:
+            args, _ = self.argparser.parse_known_args(argv)
+        except SystemExit:
+            raise ValueError("Invalid arguments: {}".format(" ".join(argv)))
+        return args
+
+    def style(self, args):
+        """
+        Returns a cache key of the style, its style model with a fitted
+        candidate search, compiled from -source or loaded from -style_model, 
+        and whether they were cached. Sets args to use the style model like 
+        experiment.prepare_style_model.
+        """
+        search_settings = (args.candidate_search, args.candidate_block_size,
+                           args.ivf_lists, args.ivf_probes)
+        if args.source is not None:
+            key = ("style", file_digest(args.source), args.patch_size,
+                   args.patch_overlap, args.pca_k, args.color,
+                   args.random_seed) + search_settings
+        else:
+            key = ("style", file_digest(args.style_model)) + search_settings
+
+        cached = self.cache.get(key)
+        if cached is None:
+            if args.source is not None:
+                model_path = os.path.join(self.model_dir, "{}.model".format(
+                    hashlib.sha256(repr(key).encode("utf-8")).hexdigest()))
+                compile_style_model(
+                    source_path=args.source,
+                    model_path=model_path,
+                    patch_size=args.patch_size,
+                    patch_overlap=args.patch_overlap,
+                    pca_k=args.pca_k,
+                    color=(None if args.color == "gray" else args.color),
+                    candidate_search=(None if args.candidate_search == "exact"
+                                      else create_candidate_search(args)),
+                    random_state=args.random_seed,
+                )
+                args.style_model, args.source = model_path, None
+            style_model = load_style_model(args)
+            candidate_search = create_style_model_search(args, style_model)
+            cached = (style_model, candidate_search)
+            self.cache.put(key, cached, object_bytes(cached))
+            hit = False
+        else:
+            hit = True
+
+        style_model, candidate_search = cached
+        args.style_model, args.source = style_model.path, None
+        for name in SETTINGS:
+            setattr(args, name, style_model.settings[name])
+        args.color = args.color or "gray"
+        return key, style_model, candidate_search, hit
+
+    def translate(self, request, emit):
+        """
+        Translates an image given by arguments of the request, emitting
+        events of the job. Prints of the pipeline go to log.txt in the
+        output folder.
+        """
+        start = time.time()
+        args = self.parse_arguments(request.get("args", []))
+        if not os.path.exists(args.output):
+            os.makedirs(args.output)
+
+        with open(os.path.join(args.output, "log.txt"), "w") as log, \
+                contextlib.redirect_stdout(log):
+            style_key, style_model, candidate_search, style_hit = \
+                self.style(args)
+            hits = {"style": style_hit}
+
+            # Candidates and potentials of a resumed EM come from its
+            # checkpoint, so they are not cached.
+            candidates_key = potentials_key = None
+            if args.resume is None:
+                candidates_key = style_key + (
+                    "candidates", file_digest(args.input), args.num_candidates)
+                potentials_key = candidates_key + (
+                    "potentials", args.lbp_two_sigma2, args.lbp_precision)
+            found = candidates_key and self.cache.get(candidates_key)
+            hits["candidates"] = bool(found)
+            if found:
+                candidate_search = candidates.PrecomputedSearch(*found)
+
+            _, em = set_up_experiment(args, style_model, candidate_search)
+            if candidates_key is not None and not found:
+                found = (em.candidate_indices, em.candidate_distances)
+                self.cache.put(candidates_key, found, object_bytes(found))
+
+            potentials = potentials_key and self.cache.get(potentials_key)
+            hits["potentials"] = potentials is not None
+            if potentials is not None and not args.lbp_debug_files:
+                em.use_pairwise_potentials(potentials)
+            emit({"event": "set_up", "seconds": time.time() - start,
+                  "cache_hits": hits})
+
+            def progress(iteration, image_path, log_posterior):
+                event = {"event": "iteration", "iteration": iteration,
+                         "log_posterior": log_posterior, "image": image_path,
+                         "seconds": time.time() - start}
+                if request.get("inline_images"):
+                    with open(image_path, "rb") as f:
+                        event["image_base64"] = base64.b64encode(
+                            f.read()).decode("ascii")
+                emit(event)
+
+            log_posteriors = run_em(args, em, progress)
+            # Potentials of pruned candidates are not computed.
+            if (potentials_key is not None and potentials is None and
+                    em.potentials is not None and em.candidate_counts is None):
+                self.cache.put(potentials_key, em.potentials,
+                               em.potentials.nbytes)
+
+        emit({"event": "done", "seconds": time.time() - start,
+              "output": args.output, "log_posteriors": log_posteriors})
+
+
+def handle_request(translator, request, emit):
+    """
+    Handles a request, emitting its events. Returns False for shutdown.
+    Failure of a job is reported as an error event.
+    """
+    command = request.get("command", "translate")
+    if command == "shutdown":
+        emit({"event": "shutdown"})
+        return False
+    try:
+        if command == "stats":
+            emit({"event": "stats", "cache": translator.cache.statistics()})
+        elif command == "translate":
+            translator.translate(request, emit)
+        else:
+            raise ValueError("Unknown command {}".format(command))
+    except Exception as e:
+        emit({"event": "error", "error": str(e),
+              "traceback": traceback.format_exc()})
+    return True
+
+
+def serve_stream(translator, lines, out):
+    """
+    Handles requests from lines of a stream until it ends or a shutdown
+    request. Returns False after shutdown.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            request = {"command": "invalid"}
+            error = str(e)
+        else:
+            error = None
+
+        def emit(event):
+            event["id"] = request.get("id")
+            out.write(json.dumps(event) + "\n")
+            out.flush()
+
+        if error is not None:
+            emit({"event": "error", "error": "Invalid request: " + error})
+        elif not handle_request(translator, request, emit):
+            return False
+    return True
+
+
+def serve_socket(translator, path):
+    """
+    Serves connections to a Unix socket one at a time, each can send any
+    number of requests.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    try:
+        running = True
+        while running:
+            connection, _ = server.accept()
+            with connection, connection.makefile("r") as lines, \
+                    connection.makefile("w") as out:
+                try:
+                    running = serve_stream(translator, lines, out)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+    finally:
+        server.close()
+        os.remove(path)
+
+
+def send_requests(path, requests):
+    """
+    Sends requests to a worker listening on a Unix socket and yields their
+    events until the last request is done.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    with client, client.makefile("r") as lines, client.makefile("w") as out:
+        for request in requests:
+            out.write(json.dumps(request) + "\n")
+        out.flush()
+        pending = len(requests)
+        for line in lines:
+            event = json.loads(line)
+            yield event
+            if event["event"] in ("done", "error", "stats", "shutdown"):
+                pending -= 1
+                if pending == 0:
+                    break
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Translation worker reading JSON requests from stdin or a Unix socket.")
+    argparser.add_argument("-socket", default=None,
+        help="Path of a Unix socket to listen on instead of reading stdin.")
+    argparser.add_argument("-client", default=None,
+        help="Send requests read from stdin to a worker listening on this socket and print its events.")
+    argparser.add_argument("-cache_mb", type=float, default=1024,
+        help="Memory limit of cached style models, candidates and potentials in megabytes.")
+    argparser.add_argument("-model_dir", default=None,
+        help="Directory of compiled style models, a temporary one removed at exit by default.")
+    args = argparser.parse_args()
+
+    if args.client is not None:
+        requests = [json.loads(line) for line in sys.stdin if line.strip()]
+        for event in send_requests(args.client, requests):
+            print(json.dumps(event))
+        sys.exit(0)
+
+    model_dir = args.model_dir or tempfile.mkdtemp(prefix="daemon")
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+    translator = Translator(model_dir, int(args.cache_mb * 2 ** 20))
+    try:
+        if args.socket is not None:
+            serve_socket(translator, args.socket)
+        else:
+            serve_stream(translator, sys.stdin, sys.stdout)
+    finally:
+        if args.model_dir is None:
+            shutil.rmtree(model_dir, ignore_errors=True)
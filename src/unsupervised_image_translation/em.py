@@ -1,16 +1,102 @@
+import contextlib
 import os
 
 import numpy as np
-from scipy.stats import multivariate_normal
 
+import candidates
+import likelihood
 import loopy
 import utils
+from metrics import Metrics
 
 
-def loopy_belief_propagation(patches, k_indices, k_posteriors, lbp_params):
+# Precisions of loopy belief propagation and types of potentials they use.
+# Messages are computed with the same type as potentials, "log" computes 
+# them in log domain, which does not underflow for small sigmas.
+lbp_precision_dtypes = {
+    "float32": np.float32,
+    "float64": np.float64,
+    "longdouble": np.longdouble,
+    "log": np.float64,
+}
+
+
+def pairwise_potentials(patches, k_indices, two_sigma2, precision="float64",
+                        candidate_counts=None):
+    """
+    Computes pairwise potentials of the MRF used in loopy belief propagation:
+    a 2D array with a row for each observed patch, which holds k x k tables 
+    of potentials between its candidates and candidates of its right and 
+    bottom neighbour. For "log" precision, logarithms of potentials are 
+    returned. With candidate_counts, only potentials of first 
+    candidate_counts[p] candidates of each patch p are computed. Patches 
+    which do not overlap have uniform potentials.
+    """
+    patches_in_row, patches_in_col = patches.observed_grid_size
+    k = k_indices.shape[1]
+    potentials = np.empty([patches.patch_count, 2 * k * k], 
+                          dtype=lbp_precision_dtypes[precision])
+    if patches.dictionary_overlap_strips is None:
+        potentials.fill(0 if precision == "log" else 1)
+        return potentials
+
+    loopy.pairwise_potentials(
+        patches_in_row, patches_in_col, two_sigma2, 
+        patches.dictionary_overlap_strips, 
+        np.ascontiguousarray(k_indices, dtype=np.int32), potentials, 
+        precision == "log", loopy_candidate_counts(candidate_counts),
+    )
+
+    return potentials
+
+
+def loopy_candidate_counts(candidate_counts):
+    """
+    Converts counts of candidates of patches to the int32 matrix of shape 
+    [patches, 1] taken by the loopy extension (None stays None).
+    """
+    if candidate_counts is None:
+        return None
+    return np.ascontiguousarray(candidate_counts, dtype=np.int32).reshape(
+        [-1, 1])
+
+
+def uniform_messages(active, log_domain=False):
     """
-    A wrapper function handling loopy belief propagation, mostly parameter 
-    passing and communication via matrices in text files.
+    Returns loopy messages carrying no information (see EM.loopy_messages)
+    to patches whose considered candidates are marked by a boolean array
+    [..., k]: probabilities 1 / number of considered candidates and zero
+    for pruned ones, or their logarithms if log_domain is set.
+    """
+    messages = active / np.sum(active, axis=-1, keepdims=True)
+    if log_domain:
+        with np.errstate(divide="ignore"):
+            return np.log(messages)
+    return messages
+
+
+def normalize_messages(messages, active, log_domain=False):
+    """
+    Normalizes loopy messages [..., k] (logarithms if log_domain is set) to
+    sum to 1 over considered candidates, marked by a boolean array
+    broadcast to messages, like messages sent by loopy. Pruned candidates
+    get zero probabilities.
+    """
+    if log_domain:
+        messages = np.where(active, messages, -np.inf)
+        maxima = np.max(messages, axis=-1, keepdims=True)
+        return messages - maxima - np.log(np.sum(
+            np.exp(messages - maxima), axis=-1, keepdims=True))
+    messages = np.where(active, messages, 0)
+    return messages / np.sum(messages, axis=-1, keepdims=True)
+
+
+def loopy_belief_propagation_via_files(patches, k_indices, k_posteriors, 
+                                       lbp_params):
+    """
+    Debug version of loopy belief propagation, a wrapper communicating with 
+    the C++ extension via matrices in text files, which are kept for 
+    inspection. Unlike loopy.LoopyState, it builds the MRF from scratch.
     """
     two_sigma2 = lbp_params["two_sigma2"]
     output_dir = lbp_params["output_dir"]
@@ -28,7 +114,7 @@ def loopy_belief_propagation(patches, k_indices, k_posteriors, lbp_params):
         os.path.join(output_dir, filename) for filename in io_file_paths
     ]
      
-    np.savetxt(io_file_paths[0], patches.dictionary_vectors * 255, fmt='%i')
+    np.savetxt(io_file_paths[0], patches.dictionary_pixel_values, fmt='%i')
     np.savetxt(io_file_paths[1], k_indices, fmt='%i')
     np.savetxt(io_file_paths[2], k_posteriors)
 
@@ -49,75 +135,100 @@ def loopy_belief_propagation(patches, k_indices, k_posteriors, lbp_params):
 
 class EM:
     def __init__(self, patches, num_candidates, num_transformations, 
-                 lbp_params, lambdas_init_type):
+                 lbp_params, lambdas_init_type, 
+                 chunk_size=likelihood.DEFAULT_CHUNK_SIZE, 
+                 candidate_search=None, state=None, covariance="full", 
+                 covariance_rank=4, metrics=None, pruning=None):
         self.patches = patches
         self.num_candidates = num_candidates
         self.num_transformations = num_transformations
         self.lbp_params = lbp_params
+        # Structure of covariances of patch noise (psis), a key of 
+        # EM.psi_estimators, and rank of the "lowrank" structure.
+        self.covariance = covariance
+        self.covariance_rank = min(covariance_rank, patches.pca_k)
+        # Records of phases of EM (see metrics.py), dropped by default.
+        self.metrics = metrics or Metrics()
+        # Number of executed iterations.
+        self.iteration = 0
+        # Number of patches processed at once in vectorized E and M steps.
+        self.chunk_size = chunk_size
+        # Parameters of pruning of candidates (see prune_candidates) or None.
+        self.pruning = pruning
+        # After pruning, only first candidate_counts[p] candidates of patch p 
+        # are considered, None while all candidates are.
+        self.candidate_counts = None
 
-        self.initial_posteriors = \
-            self.compute_initial_posterior_marginals(patches)
+        # Calculate initial P(y, t) (prop. to P(y | t) with identity 
+        # covariance) of k most probable candidates, found by a search 
+        # backend from candidates.candidate_searches (exact by default).
+        if candidate_search is None:
+            candidate_search = candidates.ExactSearch()
+        with self.metrics.phase("candidate_search", 
+                                backend=type(candidate_search).__name__):
+            self.candidate_search = candidate_search.fit(
+                patches.compact_dictionary_vectors)
+            self.candidate_indices, self.candidate_distances = \
+                self.candidate_search.search(
+                    patches.compact_observed_vectors, num_candidates)
+        init_probs = likelihood.normalize_log_probabilities(
+            -0.5 * self.candidate_distances)
         
-        # Calculate initial P(y, t) (prop. to P(y | t)) to select relevant candidates.
-        self.candidate_indices, init_probs = \
-            self.find_k_most_probable_patches(self.initial_posteriors)
-        init_probs = init_probs / np.sum(init_probs, axis=1, keepdims=True)
-        
-        # Set initial P(l) as random.
+        # Set initial P(l) as random. It is drawn even if the state below 
+        # replaces probs, so that later random numbers do not depend on it.
         init_lambdas_marginals = np.random.rand(self.patches.patch_count, num_transformations)
         init_lambdas_marginals /= np.sum(init_probs, axis=-1, keepdims=True)
 
+        # Pairwise potentials and the MRF state for loopy, created lazily and 
+        # reused while candidates and sigma stay the same.
+        self.potentials = None
+        self.potentials_settings = None
+        self.lbp_state = None
+        # Messages (see loopy_messages) the next loopy run starts from, e.g. 
+        # mapped from a coarser level of a pyramid (see pyramid.py).
+        self.initial_lbp_messages = None
+        # Number of iterations and final residuals of the last loopy run.
+        self.lbp_statistics = None
+
         # Set initial P(t) as uniform
         self.loopy_probs = np.ones([self.patches.patch_count, self.num_candidates])
         self.loopy_probs /= self.num_candidates
 
+        # A dict can replace initial probs, loopy_probs, lambdas, 
+        # initial_lbp_messages, iteration, candidate_counts and psis (a list 
+        # of arrays, see recompute_psis), e.g. with a state stored by tiled translation (see 
+        # tiling.py), taken from a coarser level of a pyramid (see pyramid.py) 
+        # or from a checkpoint (see checkpoint.py).
+        state = dict(state or {})
+        unknown = sorted(set(state) - set(EM.state_names))
+        if unknown:
+            raise ValueError("Unknown state of EM: {}.".format(
+                ", ".join(unknown)))
+
         # Set initial P(y, t, l) = P(y, t) * P(l)
-        self.probs = np.array([
-                np.outer(init_probs[p], init_lambdas_marginals[p])
-                for p in range(self.patches.patch_count)
-            ]).reshape([patches.patch_count, num_candidates, num_transformations])
+        if "probs" not in state:
+            self.probs = np.array([
+                    np.outer(init_probs[p], init_lambdas_marginals[p])
+                    for p in range(self.patches.patch_count)
+                ]).reshape([patches.patch_count, num_candidates, num_transformations])
         
         # Set initial lambdas and psis.
         self.lambdas = np.array([
             self.lambdas_init_dict[lambdas_init_type](self.patches.pca_k)
             for _ in range(self.num_transformations)
         ])
-        self.recompute_psis()
 
-        
-    def compute_initial_posterior_marginals(self, patches):
-        """
-        Returns a 2D array where posterior[observed_patch][dictionary_patch]
-        is probability of generating observed patch x_i from dictionary patch.
-        """
-        covmat = np.identity(patches.pca_k)
+        psis = state.pop("psis", None)
+        for name, value in state.items():
+            setattr(self, name, np.array(value))
+        self.iteration = int(self.iteration)
+        if psis is None:
+            with self.phase("recompute_psis", iteration=self.iteration):
+                self.recompute_psis()
+        else:
+            self.use_psis(psis)
 
-        posteriors = np.zeros([patches.patch_count, patches.dictionary_size])
-        for t in range(patches.dictionary_size):
-            posteriors[:, t] = multivariate_normal.pdf(
-                patches.compact_observed_vectors, 
-                mean=patches.compact_dictionary_vectors[t], 
-                cov=covmat
-            )
-
-        posteriors /= np.sum(posteriors, axis=1, keepdims=True)
-
-        return posteriors
-
-    def find_k_most_probable_patches(self, probabilities):
-        """
-        Returns a 2D array of indices: indices of  k most probable dictionary
-        patches for each observed patch.
-        Returns a 2D array of probabilities: probabilities of k most probable 
-        dictionary patches for each observed patch.
-        """
-        sorted_probabilities = probabilities.copy()
-        sorted_probabilities.sort()
         
-        k_indices = probabilities.argsort()[:, -self.num_candidates:]
-        k_posteriors = sorted_probabilities[:, -self.num_candidates:]
-        return k_indices, k_posteriors
-
     def find_most_probable_patches_from_k(self, k_probabilities):
         """
         Returns an array of indices: index of most probable dictionary patch 
@@ -150,132 +261,446 @@ class EM:
         Runs loopy belief propagation on probabilities with marginalized 
         transformations.
         """
-        self.loopy_probs = loopy_belief_propagation(
-            patches=self.patches, 
-            k_indices=self.candidate_indices, 
-            k_posteriors=np.sum(self.probs, axis=-1), 
-            lbp_params=self.lbp_params,
+        k_posteriors = np.sum(self.probs, axis=-1)
+        if self.lbp_params["debug_files"]:
+            self.loopy_probs = loopy_belief_propagation_via_files(
+                patches=self.patches, 
+                k_indices=self.candidate_indices, 
+                k_posteriors=k_posteriors, 
+                lbp_params=self.lbp_params,
+            )
+            if self.candidate_counts is not None:
+                # Pruned candidates have zero priors.
+                self.loopy_probs *= self.candidate_mask()
+                self.loopy_probs /= np.sum(
+                    self.loopy_probs, axis=1, keepdims=True)
+            self.lbp_statistics = None
+            return
+
+        lbp_state = self.loopy_state()
+        if self.initial_lbp_messages is not None:
+            lbp_state.set_messages(self.initial_lbp_messages)
+            self.initial_lbp_messages = None
+        elif not self.lbp_params["warm_start"]:
+            lbp_state.reset_messages()
+        lbp_state.update_priors(k_posteriors)
+        self.loopy_probs = np.empty(k_posteriors.shape)
+        self.lbp_statistics = lbp_state.run(
+            self.lbp_params["iterations"], self.lbp_params["seed"], 
+            self.loopy_probs, schedule=self.lbp_params["schedule"], 
+            threads=self.lbp_params["threads"], 
+            tolerance=self.lbp_params["tolerance"],
         )
+
+    def loopy_state(self):
+        """
+        Returns loopy.LoopyState holding the MRF and messages between loopy 
+        runs. It is created again only when pairwise potentials change.
+        """
+        potentials = self.pairwise_potentials()
+        if self.lbp_state is None:
+            patches_in_row, patches_in_col = self.patches.observed_grid_size
+            self.lbp_state = loopy.LoopyState(
+                patches_in_row, patches_in_col, potentials, 
+                log_domain=(self.lbp_params["precision"] == "log"),
+                candidate_counts=loopy_candidate_counts(self.candidate_counts))
+        return self.lbp_state
+
+    def loopy_messages(self):
+        """
+        Returns messages of the last loopy run as an array [patches, 4, k] 
+        of messages received from directions up, right, down and left 
+        (logarithms for log precision), or None before the first run. 
+        Messages of pruned candidates are zero probabilities.
+        """
+        if self.lbp_state is None:
+            return None
+        messages = np.empty([self.patches.patch_count, 4 * self.num_candidates])
+        self.lbp_state.get_messages(messages)
+        return messages.reshape([self.patches.patch_count, 4, 
+                                 self.num_candidates])
+
+    def pairwise_potentials(self):
+        """
+        Returns pairwise potentials for current candidates, recomputing them 
+        only if sigma or precision has changed since the last call.
+        """
+        settings = (self.lbp_params["two_sigma2"], self.lbp_params["precision"])
+        if self.potentials is None or self.potentials_settings != settings:
+            with self.metrics.phase("pairwise_potentials", 
+                                    iteration=self.iteration + 1):
+                self.potentials = pairwise_potentials(
+                    self.patches, self.candidate_indices, *settings, 
+                    candidate_counts=self.candidate_counts)
+            self.potentials_settings = settings
+            self.lbp_state = None
+        return self.potentials
+    
+    def use_pairwise_potentials(self, potentials):
+        """
+        Uses pairwise potentials computed elsewhere for current candidates, 
+        sigma and precision, e.g. shared by points of a sweep (see sweep.py).
+        """
+        self.potentials = potentials
+        self.potentials_settings = (self.lbp_params["two_sigma2"], 
+                                    self.lbp_params["precision"])
+        self.lbp_state = None
     
-    def unnormalized_multivariate_normal_pdf(self, x, mean, invcov):
+    def log_likelihoods(self, normalized=False):
         """
-        Optimized version.
-        As we normalize P(l_p, t_p | y_p) for each patch seaparately,
-        we don't need to compute the normalization factor in normal PDF, 
-        only renormalize all probabilities to sum to 1.
-        Also, as we compite pdfs more times with one covariance matrix,
-        we first compute its inverse and then reuse it.
+        Returns array of log P(y_p | t_p, l_p) for all patches, their 
+        candidates and transformations, see likelihood.log_likelihoods 
+        (-inf for pruned candidates).
         """
-        diff = (x - mean)
-        diff_cov_diff = np.clip(np.dot(np.dot(diff, invcov), diff), -100, 100)
-        return np.exp(- 0.5 * diff_cov_diff)
+        return likelihood.log_likelihoods(
+            self.patches.compact_observed_vectors, 
+            self.patches.compact_dictionary_vectors, 
+            self.candidate_indices, self.lambdas, self.psi_factors, 
+            normalized=normalized, chunk_size=self.chunk_size,
+            candidate_counts=self.candidate_counts,
+        )
 
     def compute_posteriors(self):
+        """
+        Computes P(t_p, l_p | y_p) proportional to loopy posterior of t_p, 
+        current marginal of l_p and P(y_p | t_p, l_p). As probabilities are 
+        normalized for each patch separately, constant terms of normal PDF 
+        are left out and the product is computed in log domain.
+        """
         marginals_for_lambdas = np.sum(self.probs, axis=1)
-        
-        new_probs = np.zeros(self.probs.shape)
-
-        for p in range(self.patches.patch_count):
-            invpsi = np.linalg.pinv(self.psis[p])
-            for t in range(self.num_candidates):
-                patch = self.patches.compact_dictionary_vectors[
-                    self.candidate_indices[p][t]]
-                for l in range(self.num_transformations):
-                    transformed_patch = np.matmul(self.lambdas[l], patch)
-                    new_probs[p][t][l] = (
-                        self.loopy_probs[p][t] * 
-                        marginals_for_lambdas[p][l] * 
-                        self.unnormalized_multivariate_normal_pdf(
-                            self.patches.compact_observed_vectors[p], 
-                            mean=transformed_patch, 
-                            invcov=invpsi,
-                        )
-                    )  
-        
-        self.probs = new_probs / np.sum(new_probs, axis=(1, 2), keepdims=True)      
+
+        log_probs = self.log_likelihoods()
+        with np.errstate(divide="ignore"):
+            log_probs += np.log(self.loopy_probs)[:, :, np.newaxis]
+            log_probs += np.log(marginals_for_lambdas)[:, np.newaxis, :]
+
+        self.probs = likelihood.normalize_log_probabilities(log_probs)
     
     def compute_maximized_term(self):
         """
         Computes term that the maximization tries to maximize:
         sum through patches, sum through all parameters l, t: 
             posterior P(t_p, l_p) * log P(y_p | t_p, l_p).
-        Currently the pdf for some p, t, l is >> 1 (probably because of small 
-        values in covariance matrices)
-        """
-        result = 0
-
-        conditionals = np.zeros(self.probs.shape)
-        for p in range(self.patches.patch_count):
-            for t in range(self.num_candidates):
-                patch = self.patches.compact_dictionary_vectors[
-                    self.candidate_indices[p][t]]
-                for l in range(self.num_transformations):
-                    transformed_patch = np.matmul(self.lambdas[l], patch)
-                    conditionals[p][t][l] = multivariate_normal.pdf(
-                        self.patches.compact_observed_vectors[p], 
-                        mean=transformed_patch, 
-                        cov=self.psis[p],
-                        allow_singular=True,
-                    )
-        conditionals[conditionals == 0] = 1e-200
-
-        return np.sum(self.probs * np.log(conditionals))
+        The pdf for some p, t, l can be >> 1 (probably because of small 
+        values in covariance matrices), so the term can be positive.
+        """
+        log_likelihoods = self.log_likelihoods(normalized=True)
+        if self.candidate_counts is not None:
+            # Pruned candidates have zero posteriors and no likelihoods.
+            active = self.candidate_mask()
+            return np.sum(self.probs[active] * log_likelihoods[active])
+        return np.sum(self.probs * log_likelihoods)
 
-    def recompute_lambdas(self):
-        self.lambdas = np.zeros(self.lambdas.shape)
+    def patch_chunks(self, patch_indices=None):
+        """
+        Yields slices of patches (or arrays of patch indices) which are 
+        processed together by vectorized E and M steps, so that their memory 
+        is bounded by chunk_size, see likelihood.patch_chunks.
+        """
+        return likelihood.patch_chunks(
+            self.patches.patch_count, self.chunk_size, self.candidate_counts, 
+            patch_indices)
+
+    def chunk_candidates(self, chunk):
+        """
+        Returns the number of candidates considered for patches in a chunk.
+        """
+        if self.candidate_counts is None:
+            return self.num_candidates
+        return self.candidate_counts[chunk[0]]
+
+    def candidate_mask(self):
+        """
+        Returns a boolean array [patches, k] marking considered candidates.
+        """
+        counts = self.candidate_counts
+        if counts is None:
+            counts = np.full(self.patches.patch_count, self.num_candidates)
+        return np.arange(self.num_candidates) < counts[:, np.newaxis]
+
+    def candidate_vectors(self, chunk):
+        """
+        Returns array [patches, k, pca_k] of compact vectors of candidates 
+        of patches in a chunk (only considered ones).
+        """
+        return self.patches.compact_dictionary_vectors[
+            self.candidate_indices[chunk, :self.chunk_candidates(chunk)]]
+
+    def lambda_statistics(self, patch_indices=None):
+        """
+        Returns sums of numerators and of denominators of lambdas over all 
+        patches or patches with given indices. Sums of disjoint sets of 
+        patches (e.g. tiles, see tiling.py) can be added together.
+        """
+        lambda_numerator = np.zeros(self.lambdas.shape)
         lambda_denominator = np.zeros(self.lambdas[0].shape)
-            
-        for l in range(self.num_transformations):             
-            for p in range(self.patches.patch_count):
-                candidates = self.patches.compact_dictionary_vectors[
-                    self.candidate_indices[p]]
-                for t in range(self.num_candidates):
-                    self.lambdas[l] += ( 
-                        self.probs[p, t, l] * 
-                        np.outer(self.patches.compact_observed_vectors[p], 
-                                 candidates[t])
-                    )
-
-                    lambda_denominator += (
-                        self.probs[p, t, l] *
-                        np.outer(candidates[t], candidates[t])
-                    )
 
+        for chunk in self.patch_chunks(patch_indices):
+            candidates = self.candidate_vectors(chunk)
+            probs = self.probs[chunk, :candidates.shape[1]]
+
+            # sum_p sum_t probs[p, t, l] * outer(y_p, candidates[p, t])
+            weighted_candidates = np.einsum("ptl,ptj->plj", probs, candidates)
+            lambda_numerator += np.tensordot(
+                weighted_candidates, self.patches.compact_observed_vectors[chunk],
+                axes=([0], [0])).transpose(0, 2, 1)
+
+            # sum_p sum_t sum_l probs[p, t, l] * outer(candidates[p, t], ...)
+            candidate_weights = np.sum(probs, axis=-1)[:, :, np.newaxis]
+            lambda_denominator += np.tensordot(
+                candidates * candidate_weights, candidates, axes=([0, 1], [0, 1]))
+
+        return lambda_numerator, lambda_denominator
+
+    def recompute_lambdas(self):
+        lambda_numerator, lambda_denominator = self.lambda_statistics()
         lambda_denominator = np.linalg.inv(lambda_denominator)
-        
-        for l in range(self.num_transformations):
-            self.lambdas[l] = self.lambdas[l].dot(lambda_denominator)
+        self.lambdas = np.matmul(lambda_numerator, lambda_denominator)
+
+    def weighted_differences(self, chunk):
+        """
+        Returns differences of observed vectors of patches in a chunk from 
+        all their transformed candidates, array [patches, k * l, pca_k], and 
+        posteriors of the pairs (t, l) as weights [patches, k * l, 1].
+        """
+        pca_k = self.patches.pca_k
+        transformed = likelihood.transform_candidates(
+            self.candidate_vectors(chunk), self.lambdas)
+        diffs = (
+            self.patches.compact_observed_vectors[chunk, 
+                                                  np.newaxis, np.newaxis] - 
+            transformed
+        ).reshape([transformed.shape[0], -1, pca_k])
+        weights = self.probs[chunk, :transformed.shape[1]].reshape(
+            [diffs.shape[0], -1, 1])
+        return diffs, weights
 
     def recompute_psis(self):
-        self.psis = np.zeros([self.patches.patch_count, 
-                              self.patches.pca_k, self.patches.pca_k])
-            
-        for p in range(self.patches.patch_count):
-            candidates = self.patches.compact_dictionary_vectors[
-                    self.candidate_indices[p]]
-            for t in range(self.num_candidates):
-                for l in range(self.num_transformations):
-                    diff = (
-                        self.patches.compact_observed_vectors[p] -
-                        np.matmul(self.lambdas[l], candidates[t])
-                    )
-                    self.psis[p] += ( 
-                        self.probs[p, t, l] * np.outer(diff, diff)
-                    )
+        """
+        Recomputes covariances of patch noise from posteriors and lambdas, 
+        with the structure selected by self.covariance. Psis are a tuple of 
+        arrays, parameters of the structure's factors class in 
+        likelihood.covariance_factors.
+        """
+        self.use_psis(self.psi_estimators[self.covariance](self))
+
+    def use_psis(self, psis):
+        self.psis = tuple(np.array(array) for array in psis)
+        self.psi_factors = likelihood.covariance_factors[self.covariance](
+            *self.psis)
+
+    def full_psis(self):
+        """
+        A full covariance matrix for each patch.
+        """
+        pca_k = self.patches.pca_k
+        psis = np.zeros([self.patches.patch_count, pca_k, pca_k])
+        for chunk in self.patch_chunks():
+            diffs, weights = self.weighted_differences(chunk)
+            psis[chunk] = np.matmul((weights * diffs).transpose(0, 2, 1), diffs)
         
         # This renormalization does not make sense / should not be necessary 
         # in the paper if probabilities are already normalized.
-        self.psis /= np.sum(self.probs, axis=(1, 2), keepdims=True)
+        psis /= np.sum(self.probs, axis=(1, 2))[:, np.newaxis, np.newaxis]
+        return psis,
+
+    def diagonal_psis(self):
+        """
+        Diagonal of the full covariance matrix of each patch, without the 
+        eigendecomposition of full_psis and with pca_k values per patch.
+        """
+        variances = np.zeros([self.patches.patch_count, self.patches.pca_k])
+        for chunk in self.patch_chunks():
+            diffs, weights = self.weighted_differences(chunk)
+            variances[chunk] = np.sum(weights * diffs ** 2, axis=1)
+        variances /= np.sum(self.probs, axis=(1, 2))[:, np.newaxis]
+        return variances,
+
+    def shared_covariance(self):
+        """
+        Returns the covariance matrix of differences of all patches.
+        """
+        pca_k = self.patches.pca_k
+        psi = np.zeros([pca_k, pca_k])
+        for chunk in self.patch_chunks():
+            diffs, weights = self.weighted_differences(chunk)
+            psi += np.tensordot(weights * diffs, diffs, axes=([0, 1], [0, 1]))
+        return psi / np.sum(self.probs)
+
+    def shared_psis(self):
+        """
+        A single covariance matrix shared by all patches.
+        """
+        return self.shared_covariance(),
+
+    def low_rank_psis(self):
+        """
+        Low-rank plus diagonal covariances: the covariance of each patch 
+        restricted to covariance_rank principal directions of the shared 
+        covariance, where each patch has its own variances, plus an 
+        isotropic residual variance of the patch in the other directions.
+        """
+        pca_k, rank = self.patches.pca_k, self.covariance_rank
+        _, eigenvectors = np.linalg.eigh(self.shared_covariance())
+        basis = eigenvectors[:, ::-1][:, :rank]
+
+        variances = np.zeros([self.patches.patch_count, rank])
+        totals = np.zeros(self.patches.patch_count)
+        for chunk in self.patch_chunks():
+            diffs, weights = self.weighted_differences(chunk)
+            variances[chunk] = np.sum(
+                weights * np.matmul(diffs, basis) ** 2, axis=1)
+            totals[chunk] = np.sum(weights * diffs ** 2, axis=(1, 2))
+
+        normalizers = np.sum(self.probs, axis=(1, 2))
+        variances /= normalizers[:, np.newaxis]
+        residual_variances = np.zeros(self.patches.patch_count)
+        if rank < pca_k:
+            residual_variances = np.maximum(
+                totals / normalizers - np.sum(variances, axis=1), 0
+            ) / (pca_k - rank)
+        return basis, variances, residual_variances
     
     def maximization(self):
         self.recompute_lambdas()
         self.recompute_psis()
 
+    def prune_candidates(self):
+        """
+        Drops candidates of patches which are unlikely under both their 
+        posteriors (probs marginalized over transformations) and loopy 
+        posteriors: candidates kept by the rule of candidate_pruning of the 
+        larger of the two probabilities, and always the most probable one 
+        of each. Kept candidates are moved to the front, in the same order, and 
+        probabilities of the dropped ones become zero. Loopy and E and M 
+        steps then consider only candidate_counts[p] first candidates of 
+        patch p. Returns whether any candidate was dropped.
+        """
+        marginals = np.sum(self.probs, axis=-1)
+        active = self.candidate_mask()
+        probabilities = np.where(
+            active, np.maximum(marginals, self.loopy_probs), 0)
+        keep = candidates.candidate_pruning[self.pruning["rule"]](
+            probabilities, self.pruning["parameter"])
+        rows = np.arange(self.patches.patch_count)[:, np.newaxis]
+        keep[rows[:, 0], np.argmax(marginals, axis=1)] = True
+        keep[rows[:, 0], np.argmax(self.loopy_probs, axis=1)] = True
+        keep &= active
+        counts = np.sum(keep, axis=1)
+        if np.array_equal(counts, np.sum(active, axis=1)):
+            return False
+
+        # Messages of the kept candidates are moved with them.
+        messages = self.initial_lbp_messages
+        if messages is None and self.lbp_params["warm_start"]:
+            messages = self.loopy_messages()
+        order = np.argsort(~keep, axis=1, kind="stable")
+        if messages is not None:
+            messages = np.reshape(messages, [self.patches.patch_count, 4, -1])
+            self.initial_lbp_messages = messages[
+                rows[:, :, np.newaxis], np.arange(4)[:, np.newaxis], 
+                order[:, np.newaxis, :]].reshape([self.patches.patch_count, -1])
+
+        self.candidate_indices = self.candidate_indices[rows, order]
+        self.candidate_distances = self.candidate_distances[rows, order]
+        self.candidate_counts = counts
+        kept = self.candidate_mask()
+        self.probs = self.probs[rows, order] * kept[:, :, np.newaxis]
+        self.probs /= np.sum(self.probs, axis=(1, 2), keepdims=True)
+        self.loopy_probs = self.loopy_probs[rows, order] * kept
+        self.loopy_probs /= np.sum(self.loopy_probs, axis=1, keepdims=True)
+        self.potentials = None
+        self.lbp_state = None
+        return True
+
     def execute_iteration(self):
-        self.loopy()
-        self.compute_posteriors()
-        self.maximization()
-        self.compute_posteriors()
+        if (self.pruning is not None and 
+                self.iteration >= self.pruning["after"]):
+            with self.phase("prune_candidates") as record:
+                record["pruned"] = self.prune_candidates()
+                record["mean_candidates"] = np.mean(np.sum(
+                    self.candidate_mask(), axis=1))
+        with self.phase("loopy") as record:
+            self.loopy()
+            record["lbp"] = self.lbp_statistics
+        with self.phase("compute_posteriors"):
+            self.compute_posteriors()
+        with self.phase("recompute_lambdas"):
+            self.recompute_lambdas()
+        with self.phase("recompute_psis"):
+            self.recompute_psis()
+        with self.phase("compute_posteriors"):
+            self.compute_posteriors()
+        self.iteration += 1
+
+    @contextlib.contextmanager
+    def phase(self, name, iteration=None):
+        """
+        Records a phase of an iteration (the running one by default) with 
+        sizes of arrays of EM after it, see metrics.Metrics.phase.
+        """
+        if iteration is None:
+            iteration = self.iteration + 1
+        with self.metrics.phase(name, iteration=iteration) as record:
+            yield record
+            record["array_bytes"] = self.array_bytes()
+
+    def array_bytes(self):
+        """
+        Returns a dict of sizes of the largest arrays of EM in bytes.
+        """
+        arrays = {
+            "probs": self.probs,
+            "loopy_probs": self.loopy_probs,
+            "candidate_indices": self.candidate_indices,
+            "candidate_distances": self.candidate_distances,
+            "potentials": self.potentials,
+        }
+        sizes = {name: array.nbytes for name, array in arrays.items() 
+                 if array is not None}
+        sizes["psis"] = sum(
+            array.nbytes for array in getattr(self, "psis", ()))
+        return sizes
+
+    def checkpoint_state(self):
+        """
+        Returns a dict of arrays from which EM continues exactly as this one 
+        when passed as state to the constructor with candidates of 
+        candidate_indices and candidate_distances (see checkpoint.py). 
+        Loopy messages are included only with warm start, as otherwise each 
+        loopy run starts from uniform ones, and counts of candidates only 
+        after pruning.
+        """
+        state = {
+            "iteration": np.array(self.iteration),
+            "probs": self.probs,
+            "loopy_probs": self.loopy_probs,
+            "lambdas": self.lambdas,
+            "candidate_indices": self.candidate_indices,
+            "candidate_distances": self.candidate_distances,
+        }
+        for i, array in enumerate(self.psis):
+            state["psis_{}".format(i)] = array
+        if self.candidate_counts is not None:
+            state["candidate_counts"] = self.candidate_counts
+        messages = self.loopy_messages()
+        if self.lbp_params["warm_start"] and messages is not None:
+            state["initial_lbp_messages"] = messages.reshape(
+                [self.patches.patch_count, -1])
+        return state
+
+# Names of EM's attributes which can be given by its state.
+EM.state_names = [
+    "probs", "loopy_probs", "lambdas", "initial_lbp_messages", "iteration", 
+    "candidate_counts", "psis",
+]
+
+EM.psi_estimators = {
+    "full": EM.full_psis,
+    "diag": EM.diagonal_psis,
+    "lowrank": EM.low_rank_psis,
+    "shared": EM.shared_psis,
+}
 
 EM.lambdas_init_dict = {
    "id": 
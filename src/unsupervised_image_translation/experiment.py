@@ -5,21 +5,48 @@ import pprint
 import numpy as np
 from scipy.misc import imsave
 
+from artifact_cache import ArtifactCache
 from patches import Patches
-from em import EM
+from style_model import StyleModel, SETTINGS, compile_style_model
+from checkpoint import Checkpoint, save_checkpoint, FILENAME as CHECKPOINT_FILENAME
+from metrics import Metrics
+from em import EM, lbp_precision_dtypes
+import candidates
+import colors
+import likelihood
 
 
-def prepare_argument_parser():
+def prepare_argument_parser(batch=False):
+    """
+    Creates parser of experiment arguments. In batch mode (see batch.py) 
+    -input is replaced by -inputs and -workers and -resume is not available.
+    """
     argparser = argparse.ArgumentParser(description="Argparser for unsupervised image translation")
     
-    argparser.add_argument("-source", default=None, 
-        help="Path to source image (style).", required=True)
-    argparser.add_argument("-input", default=None, 
-        help="Path to input image (content).", required=True)
+    source = argparser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-source", default=None, 
+        help="Path to source image (style).")
+    source.add_argument("-style_model", default=None, 
+        help="Path to a style model compiled from a source image by compile_style_model.py, "
+             "which also sets patch size, overlap, pca_k and color.")
+    if batch:
+        argparser.add_argument("-inputs", default=None, 
+            help="Directory of input images (content) or a manifest file with a path to an input "
+                 "image on each line, relative to the manifest.", required=True)
+        argparser.add_argument("-workers", type=int, default=1, 
+            help="Number of processes translating input images (0 = all cores).")
+        argparser.set_defaults(resume=None)
+    else:
+        argparser.add_argument("-input", default=None, 
+            help="Path to input image (content).", required=True)
+        argparser.add_argument("-resume", default=None, 
+            help="Checkpoint (or output folder with one) to continue EM from, up to -em_iterations. "
+                 "Arguments other than patches and candidates can differ to branch off it.")
     argparser.add_argument("-output", default="output", 
         help="Path to output folder.")
     argparser.add_argument("-color", default="gray", 
-        help="Colorscheme for output image.", choices=["gray", "color"])
+        help="Colorscheme for output image, a luminance / chrominance color space (\"color\" is YIQ).", 
+        choices=["gray"] + list(colors.color_spaces.keys()))
     
     argparser.add_argument("-patch_size", type=int, default=15, 
         help="Input and source images will be split to patch_size x patch_size squares.")
@@ -29,9 +56,24 @@ def prepare_argument_parser():
         help="Number of PCA componetns of patches.")
     
     argparser.add_argument("-lbp_iterations", type=int, default=8, 
-        help="Number of iterations in loopy belief propagation.")
+        help="Number of iterations in loopy belief propagation (maximum if -lbp_tolerance is set).")
+    argparser.add_argument("-lbp_tolerance", type=float, default=0, 
+        help="Stop loopy belief propagation when no message changes by more than this in an iteration.")
     argparser.add_argument("-lbp_two_sigma2", type=float, default=0.1, 
         help="Sigma in potential pairwise funcion. Local smoothness should increase with lower values.")
+    argparser.add_argument("-lbp_precision", default="float64", 
+        help="Number type of messages in loopy belief propagation, log computes them in log domain (for small sigmas).", 
+        choices=lbp_precision_dtypes.keys())
+    argparser.add_argument("-lbp_schedule", default="tree", 
+        help="Order of message updates in loopy belief propagation: sequential along random spanning trees, "
+             "red/black checkerboard updated in parallel, or messages with the largest residuals first.", 
+        choices=["tree", "checkerboard", "residual"])
+    argparser.add_argument("-lbp_threads", type=int, default=1, 
+        help="Number of threads used by the checkerboard schedule (0 = all cores).")
+    argparser.add_argument("-lbp_warm_start", action="store_true", 
+        help="Start loopy belief propagation from messages of the previous EM iteration.")
+    argparser.add_argument("-lbp_debug_files", action="store_true", 
+        help="Pass matrices to loopy belief propagation via text files in the output folder.")
     
     argparser.add_argument("-num_candidates", type=int, default=16, 
         help="Number of most probable dictionary patches considered for each latent patch.")
@@ -41,7 +83,53 @@ def prepare_argument_parser():
         help="Type of transformation initialization.", choices=EM.lambdas_init_dict.keys())
     argparser.add_argument("-em_iterations", type=int, default=5, 
             help="Number of EM iterations.")
+    argparser.add_argument("-prune", default="none", 
+        help="Drop unlikely candidates of each patch before EM iterations after -prune_after, "
+             "so that loopy and E and M steps consider fewer candidates: those with posterior or "
+             "loopy posterior at least -prune_threshold, or the fewest covering -prune_mass of it.", 
+        choices=["none"] + list(candidates.candidate_pruning.keys()))
+    argparser.add_argument("-prune_threshold", type=float, default=0.01, 
+        help="Smallest probability of a candidate kept by the threshold pruning.")
+    argparser.add_argument("-prune_mass", type=float, default=0.99, 
+        help="Fraction of probability of a patch covered by candidates kept by the mass pruning.")
+    argparser.add_argument("-prune_after", type=int, default=2, 
+        help="Number of EM iterations with all candidates before pruning starts.")
+    argparser.add_argument("-checkpoint_every", type=int, default=0, 
+        help="Save a checkpoint of EM to the output folder every N iterations and after the last one "
+             "(0 = never).")
+    argparser.add_argument("-metrics", action="store_true", 
+        help="Append wall and CPU time, peak memory, array sizes and loopy counters of each phase "
+             "to metrics.jsonl in the output folder.")
+    argparser.add_argument("-em_chunk_size", type=int, 
+        default=likelihood.DEFAULT_CHUNK_SIZE, 
+        help="Number of patches processed at once in E and M steps, bounds their memory.")
+    argparser.add_argument("-covariance", default="full", 
+        help="Structure of covariances of patch noise: full and diag for each patch, lowrank "
+             "(-covariance_rank shared directions with variances of each patch plus its isotropic "
+             "residual) or a single shared matrix.", 
+        choices=EM.psi_estimators.keys())
+    argparser.add_argument("-covariance_rank", type=int, default=4, 
+        help="Number of directions with variances of each patch of the lowrank covariance.")
+    argparser.add_argument("-candidate_search", default="exact", 
+        help="Backend of initial candidate search.", 
+        choices=candidates.candidate_searches.keys())
+    argparser.add_argument("-candidate_block_size", type=int, 
+        default=candidates.DEFAULT_BLOCK_SIZE, 
+        help="Number of patches compared at once in exact candidate search, bounds its memory.")
+    argparser.add_argument("-ivf_lists", type=int, default=None, 
+        help="Number of k-means lists of the ivf search, sqrt of dictionary size by default.")
+    argparser.add_argument("-ivf_probes", type=int, default=1, 
+        help="Number of lists searched by the ivf search for each patch.")
+    argparser.add_argument("-candidate_recall", action="store_true", 
+        help="Report recall@K of the candidate search against the exact search.")
+
 
+    argparser.add_argument("-cache_dir", default=None, 
+        help="Directory of a cache of patches, PCA and candidates, no caching by default.")
+    argparser.add_argument("-cache_max_size", type=float, default=None, 
+        help="Maximal size of the cache in megabytes, least recently used entries are evicted.")
+    argparser.add_argument("-cache_max_age", type=float, default=None, 
+        help="Maximal age of unused cache entries in days.")
 
     argparser.add_argument("-random_seed", type=int, default=0, 
         help="Seed for random number generators.")
@@ -49,9 +137,81 @@ def prepare_argument_parser():
     return argparser
 
 
-def set_up_experiment(args):
+def create_candidate_search(args):
     """
-    Create exp. directory if needed, store used arguments, create patches and em objects.
+    Creates a candidate search backend selected by -candidate_search.
+    """
+    search_params = {
+        "exact": dict(block_size=args.candidate_block_size),
+        "kdtree": dict(),
+        "ivf": dict(lists=args.ivf_lists, probes=args.ivf_probes, 
+                    seed=args.random_seed),
+    }
+    return candidates.candidate_searches[args.candidate_search](
+        **search_params[args.candidate_search])
+
+
+def load_style_model(args):
+    """
+    Loads the style model given by -style_model and sets patch settings in 
+    args to those it was compiled with.
+    """
+    style_model = StyleModel(args.style_model)
+    for name in SETTINGS:
+        value = style_model.settings[name]
+        if name == "color":
+            value = value or "gray"
+        if getattr(args, name) != value:
+            print("Using {}={} of the style model.".format(name, value))
+            setattr(args, name, value)
+    return style_model
+
+
+def create_style_model_search(args, style_model):
+    """
+    Returns a candidate search fitted on dictionary of the style model: its 
+    stored index if it belongs to the backend selected by -candidate_search, 
+    otherwise a newly fitted one.
+    """
+    candidate_search = create_candidate_search(args)
+    if (style_model.search_index is not None and 
+            type(style_model.search_index) == type(candidate_search)):
+        return candidates.FittedSearch(style_model.search_index)
+    return candidates.FittedSearch(
+        candidate_search.fit(style_model.compact_dictionary_vectors))
+
+
+def prepare_style_model(args):
+    """
+    Compiles -source into a style model in the output folder, storing the 
+    index of the candidate search unless it is exact, or loads -style_model. 
+    Sets args to use the style model, which is shared by translations of 
+    many images (batch.py) or tiles (tiling.py).
+    """
+    if args.source is None:
+        load_style_model(args)
+        return
+
+    candidate_search = None
+    if args.candidate_search != "exact":
+        candidate_search = create_candidate_search(args)
+    args.style_model = os.path.join(args.output, "style.model")
+    compile_style_model(
+        source_path=args.source, 
+        model_path=args.style_model, 
+        patch_size=args.patch_size, 
+        patch_overlap=args.patch_overlap, 
+        pca_k=args.pca_k, 
+        color=(None if args.color == "gray" else args.color), 
+        candidate_search=candidate_search, 
+        random_state=args.random_seed,
+    )
+    args.source = None
+
+
+def write_arguments(args):
+    """
+    Creates the output folder if needed and stores used arguments in it.
     """
     if not os.path.exists(args.output):
         os.makedirs(args.output)
@@ -63,31 +223,201 @@ def set_up_experiment(args):
                 continue
             f.write("-{}={} \\\n".format(k, v))
 
-    np.random.seed(args.random_seed)
-
-    patches = Patches(
-        input_path=args.input, 
-        source_path=args.source, 
-        patch_size=args.patch_size, 
-        patch_overlap=args.patch_overlap,
-        pca_k=args.pca_k,
-        color=(args.color == "color"),
-    )
 
-    initial_posteriors_path = os.path.join(args.output, "initial_posteriors.npy")
-    
+def create_lbp_params(args):
+    """
+    Returns parameters of loopy belief propagation used by EM.
+    """
     lbp_params = dict()
     lbp_params["output_dir"] = args.output
     lbp_params["two_sigma2"] = args.lbp_two_sigma2
     lbp_params["iterations"] = args.lbp_iterations
+    lbp_params["tolerance"] = args.lbp_tolerance
     lbp_params["seed"] = args.random_seed
+    lbp_params["precision"] = args.lbp_precision
+    lbp_params["schedule"] = args.lbp_schedule
+    lbp_params["threads"] = args.lbp_threads
+    lbp_params["warm_start"] = args.lbp_warm_start
+    lbp_params["debug_files"] = args.lbp_debug_files
+    return lbp_params
+
+
+def create_pruning_params(args):
+    """
+    Returns parameters of pruning of candidates used by EM, or None.
+    """
+    if args.prune == "none":
+        return None
+    return {
+        "rule": args.prune,
+        "parameter": (args.prune_threshold if args.prune == "threshold" 
+                      else args.prune_mass),
+        "after": args.prune_after,
+    }
+
 
-    em = EM(
+def create_cache(args):
+    """
+    Returns the artifact cache in -cache_dir or None.
+    """
+    if args.cache_dir is None:
+        return None
+    return ArtifactCache(
+        args.cache_dir, 
+        max_bytes=(None if args.cache_max_size is None 
+                   else args.cache_max_size * 2**20),
+        max_age=(None if args.cache_max_age is None 
+                 else args.cache_max_age * 24 * 3600),
+    )
+
+
+def create_patches(args, cache=None, style_model=None, metrics=None, 
+                   **images):
+    """
+    Creates patches of -input and -source (or the style model). Images 
+    already loaded in the color space can be passed as input_image and 
+    source_image, with a fitted pca, see Patches.
+    """
+    metrics = metrics or create_metrics(args)
+    with metrics.phase("patches") as record:
+        patches = Patches(
+            input_path=args.input, 
+            source_path=args.source, 
+            patch_size=args.patch_size, 
+            patch_overlap=args.patch_overlap,
+            pca_k=args.pca_k,
+            color=(None if args.color == "gray" else args.color),
+            cache=cache,
+            style_model=style_model,
+            metrics=metrics,
+            **images
+        )
+        record["patch_count"] = patches.patch_count
+        record["dictionary_size"] = patches.dictionary_size
+    return patches
+
+
+def create_em(args, patches, candidate_search, state=None, metrics=None):
+    return EM(
         patches=patches, 
         num_candidates=args.num_candidates, 
         num_transformations=args.num_transformations, 
-        lbp_params=lbp_params, 
+        lbp_params=create_lbp_params(args), 
         lambdas_init_type=args.init_transformations,
-    )    
+        chunk_size=args.em_chunk_size,
+        candidate_search=candidate_search,
+        state=state,
+        covariance=args.covariance,
+        covariance_rank=args.covariance_rank,
+        metrics=metrics or create_metrics(args),
+        pruning=create_pruning_params(args),
+    )
+
+
+def create_metrics(args, **fields):
+    """
+    Returns metrics.Metrics adding fields to records and writing them to the 
+    output folder with -metrics, otherwise dropping them.
+    """
+    if not args.metrics:
+        return Metrics()
+    return Metrics(os.path.join(args.output, "metrics.jsonl"), fields=fields)
+
+
+def set_up_experiment(args, style_model=None, candidate_search=None):
+    """
+    Create exp. directory if needed, store used arguments, create patches and em objects.
+    A style model and a candidate search fitted on its dictionary can be passed 
+    when they are shared by several experiments.
+    """
+    if style_model is None and args.style_model is not None:
+        style_model = load_style_model(args)
+
+    write_arguments(args)
+
+    np.random.seed(args.random_seed)
+
+    cache = create_cache(args)
+    patches = create_patches(args, cache, style_model)
+
+    checkpoint, state = None, None
+    if args.resume is not None:
+        checkpoint = Checkpoint(args.resume)
+        checkpoint.check_shapes(patches.patch_count, args.num_candidates, 
+                                args.num_transformations, patches.pca_k)
+        candidate_search = checkpoint.candidate_search()
+        state = checkpoint.state(args.covariance, args.lbp_warm_start)
+    elif candidate_search is None and style_model is not None:
+        candidate_search = create_style_model_search(args, style_model)
+    elif candidate_search is None:
+        candidate_search = create_candidate_search(args)
+        if cache is not None:
+            candidate_search = candidates.CachedSearch(
+                candidate_search, cache, patches.cache_key)
+    
+    em = create_em(args, patches, candidate_search, state)
+    if checkpoint is not None:
+        checkpoint.restore_random_state()
+        print("Resumed from iteration {} of {}".format(
+            checkpoint.iteration, checkpoint.path))
+
+    if args.candidate_recall:
+        exact_indices, _ = candidates.nearest_candidates(
+            patches.compact_observed_vectors, 
+            patches.compact_dictionary_vectors, 
+            args.num_candidates, block_size=args.candidate_block_size,
+        )
+        print("Candidate recall@{} ({}): {:.4f}".format(
+            args.num_candidates, args.candidate_search, 
+            candidates.recall_at_k(em.candidate_indices, exact_indices)))
 
     return patches, em
+
+
+def save_checkpoint_if_due(args, em):
+    """
+    Saves a checkpoint of EM to the output folder every -checkpoint_every 
+    iterations and after the last one.
+    """
+    every = args.checkpoint_every
+    if every and (em.iteration % every == 0 or 
+                  em.iteration == args.em_iterations):
+        save_checkpoint(os.path.join(args.output, CHECKPOINT_FILENAME), em)
+
+
+def run_em(args, em, callback=None):
+    """
+    Executes EM iterations (continuing from the iteration EM was resumed 
+    from), saves MAP image after each of them to the output folder and 
+    checkpoints if due. Callback, if given, is called after each iteration 
+    with its number, path of the MAP image and log a posterior probability.
+    Returns a list of log a posterior probabilities after initialization 
+    (or resuming) and each iteration.
+    """
+    log_posteriors = [em.log_a_posterior_probability()]
+    if em.iteration == 0:
+        imsave(os.path.join(args.output, "0_initial.png"), em.MAP_image())
+        print("Initial log a posterior:", log_posteriors[-1])
+    else:
+        print("Log a posterior after iteration {}: {}".format(
+            em.iteration, log_posteriors[-1]))
+    
+    for i in range(em.iteration + 1, args.em_iterations + 1):
+        print("Executing EM iteration", i)
+        em.execute_iteration()
+        if em.lbp_statistics is not None:
+            print("Loopy iterations: {iterations}, max residual: "
+                  "{max_residual:.3g}, mean residual: {mean_residual:.3g}"
+                  .format(**em.lbp_statistics))
+        with em.metrics.phase("reconstruction", iteration=i):
+            image = em.MAP_image()
+        image_path = os.path.join(args.output, "{}.png".format(i))
+        imsave(image_path, image)
+        with em.metrics.phase("log_posterior", iteration=i):
+            log_posteriors.append(em.log_a_posterior_probability())
+        print("Log a posterior", log_posteriors[-1])
+        save_checkpoint_if_due(args, em)
+        if callback is not None:
+            callback(i, image_path, log_posteriors[-1])
+
+    return log_posteriors
@@ -0,0 +1,212 @@
+import numpy as np
+
+
+# Number of observed patches whose likelihoods are evaluated at once. Peak
+# memory of log_likelihoods is proportional to
+# chunk_size * num_candidates * num_transformations * pca_k.
+DEFAULT_CHUNK_SIZE = 256
+
+
+class CovarianceFactors:
+    """
+    Eigendecomposition of a stack of covariance matrices psis[p], computed
+    once and reused for all (t, l) pairs of the patch. Like
+    scipy.stats.multivariate_normal with allow_singular=True, eigenvalues
+    smaller than a relative cutoff are treated as zero, so that singular
+    covariances yield a pseudo-inverse and a pseudo-determinant.
+    """
+    def __init__(self, covariances):
+        eigenvalues, eigenvectors = np.linalg.eigh(covariances)
+        eps = np.finfo(eigenvalues.dtype).eps
+        cutoff = 1e6 * eps * np.max(np.abs(eigenvalues), axis=-1,
+                                    keepdims=True)
+        nonzero = eigenvalues > cutoff
+        safe_eigenvalues = np.where(nonzero, eigenvalues, 1)
+
+        # Multiplying a difference vector by whitening[p] maps it to a space
+        # where its squared norm is the Mahalanobis distance.
+        self.whitening = eigenvectors * np.where(
+            nonzero, 1 / np.sqrt(safe_eigenvalues), 0)[:, np.newaxis, :]
+        self.log_pseudo_determinants = np.sum(np.log(safe_eigenvalues), axis=-1)
+        self.ranks = np.sum(nonzero, axis=-1)
+
+    def squared_distances(self, diffs, chunk):
+        """
+        Returns squared Mahalanobis distances [patches, n] of difference 
+        vectors diffs [patches, n, dim] of patches in a chunk.
+        """
+        whitened = np.matmul(diffs, self.whitening[chunk])
+        return np.sum(whitened ** 2, axis=-1)
+
+
+class SharedCovarianceFactors(CovarianceFactors):
+    """
+    Factors of a single covariance matrix shared by all patches. Log 
+    pseudo-determinants and ranks have one element, broadcast to patches.
+    """
+    def __init__(self, covariance):
+        super().__init__(covariance[np.newaxis])
+
+    def squared_distances(self, diffs, chunk):
+        whitened = np.matmul(diffs, self.whitening[0])
+        return np.sum(whitened ** 2, axis=-1)
+
+
+def _safe_inverses(variances, cutoff):
+    nonzero = variances > cutoff
+    safe_variances = np.where(nonzero, variances, 1)
+    return np.where(nonzero, 1 / safe_variances, 0), safe_variances, nonzero
+
+
+class DiagonalCovarianceFactors:
+    """
+    Diagonal covariance matrices given by variances [patches, dim], with 
+    the same cutoff of small variances as CovarianceFactors.
+    """
+    def __init__(self, variances):
+        eps = np.finfo(variances.dtype).eps
+        cutoff = 1e6 * eps * np.max(variances, axis=-1, keepdims=True)
+        self.inverse_variances, safe_variances, nonzero = _safe_inverses(
+            variances, cutoff)
+        self.log_pseudo_determinants = np.sum(np.log(safe_variances), axis=-1)
+        self.ranks = np.sum(nonzero, axis=-1)
+
+    def squared_distances(self, diffs, chunk):
+        return np.sum(
+            diffs ** 2 * self.inverse_variances[chunk][:, np.newaxis, :], 
+            axis=-1)
+
+
+class LowRankCovarianceFactors:
+    """
+    Covariance matrices basis @ diag(variances[p]) @ basis.T plus 
+    residual_variances[p] times the projection to the orthogonal complement 
+    of the basis, a [dim, rank] matrix with orthonormal columns shared by 
+    all patches. Their eigenvalues are variances[p] and residual_variances[p] 
+    (dim - rank times), cut off like in CovarianceFactors.
+    """
+    def __init__(self, basis, variances, residual_variances):
+        dim, rank = basis.shape
+        eps = np.finfo(variances.dtype).eps
+        cutoff = 1e6 * eps * np.maximum(np.max(variances, axis=-1), 
+                                        residual_variances)
+        self.basis = basis
+        self.inverse_variances, safe_variances, nonzero = _safe_inverses(
+            variances, cutoff[:, np.newaxis])
+        self.inverse_residual_variances, safe_residual_variances, \
+            residual_nonzero = _safe_inverses(residual_variances, cutoff)
+        self.log_pseudo_determinants = (
+            np.sum(np.log(safe_variances), axis=-1) + 
+            (dim - rank) * np.log(safe_residual_variances)
+        )
+        self.ranks = np.sum(nonzero, axis=-1) + (dim - rank) * residual_nonzero
+
+    def squared_distances(self, diffs, chunk):
+        projected = np.matmul(diffs, self.basis)
+        residuals = np.sum(diffs ** 2, axis=-1) - np.sum(projected ** 2, axis=-1)
+        return (
+            np.sum(projected ** 2 * 
+                   self.inverse_variances[chunk][:, np.newaxis, :], axis=-1) + 
+            np.maximum(residuals, 0) * 
+            self.inverse_residual_variances[chunk][:, np.newaxis]
+        )
+
+
+# Factors of covariance structures, created from parameters estimated by 
+# EM.psi_estimators of the same name.
+covariance_factors = {
+    "full": CovarianceFactors,
+    "diag": DiagonalCovarianceFactors,
+    "lowrank": LowRankCovarianceFactors,
+    "shared": SharedCovarianceFactors,
+}
+
+
+def transform_candidates(candidates, lambdas):
+    """
+    Applies every transformation to every candidate: for candidates of shape
+    [patches, k, pca_k] and lambdas of shape [l, pca_k, pca_k], returns array
+    of shape [patches, k, l, pca_k] with result[p, t, l] = lambdas[l] @
+    candidates[p, t].
+    """
+    return np.tensordot(candidates, lambdas, axes=([2], [2]))
+
+
+def patch_chunks(patch_count, chunk_size, candidate_counts=None, 
+                 patch_indices=None):
+    """
+    Yields chunks of at most chunk_size patches (of all patches or of given 
+    patch indices) processed together by vectorized code: slices, or arrays 
+    of patch indices. If only first candidate_counts[p] candidates of each 
+    patch p are considered (see EM.prune_candidates), each chunk holds 
+    patches with the same count, so that only their candidates are 
+    evaluated.
+    """
+    if candidate_counts is None:
+        if patch_indices is None:
+            for start in range(0, patch_count, chunk_size):
+                yield slice(start, start + chunk_size)
+            return
+        for start in range(0, len(patch_indices), chunk_size):
+            yield patch_indices[start:(start + chunk_size)]
+        return
+
+    if patch_indices is None:
+        patch_indices = np.arange(patch_count)
+    counts = candidate_counts[patch_indices]
+    for count in np.unique(counts):
+        group = patch_indices[counts == count]
+        for start in range(0, len(group), chunk_size):
+            yield group[start:(start + chunk_size)]
+
+
+def log_likelihoods(observed_vectors, dictionary_vectors, candidate_indices,
+                    lambdas, covariance_factors, normalized=False,
+                    chunk_size=DEFAULT_CHUNK_SIZE, candidate_counts=None):
+    """
+    Returns array of shape [patches, k, l] of log P(y_p | t, l), where y_p is
+    observed_vectors[p], which is normally distributed with mean
+    lambdas[l] @ dictionary_vectors[candidate_indices[p, t]] and covariance
+    factorized in covariance_factors (of any of the classes above). If not
+    normalized, the constant terms of each patch (which cancel out in
+    posteriors) are left out. With candidate_counts, only first
+    candidate_counts[p] candidates of patch p are evaluated and the others 
+    get -inf.
+    Patches are processed in chunks of chunk_size to bound memory.
+    """
+    patch_count, num_candidates = candidate_indices.shape
+    num_transformations = lambdas.shape[0]
+    dim = observed_vectors.shape[1]
+
+    result = np.full([patch_count, num_candidates, num_transformations], 
+                     -np.inf)
+    for chunk in patch_chunks(patch_count, chunk_size, candidate_counts):
+        k = (num_candidates if candidate_counts is None 
+             else candidate_counts[chunk[0]])
+        means = transform_candidates(
+            dictionary_vectors[candidate_indices[chunk, :k]], lambdas)
+        diffs = observed_vectors[chunk, np.newaxis, np.newaxis, :] - means
+        distances = covariance_factors.squared_distances(
+            diffs.reshape([-1, k * num_transformations, dim]), chunk)
+        result[chunk, :k] = -0.5 * distances.reshape(
+            [-1, k, num_transformations])
+
+    if normalized:
+        constants = -0.5 * (
+            covariance_factors.ranks * np.log(2 * np.pi) +
+            covariance_factors.log_pseudo_determinants
+        )
+        result += constants[:, np.newaxis, np.newaxis]
+
+    return result
+
+
+def normalize_log_probabilities(log_probabilities):
+    """
+    Exponentiates unnormalized log probabilities of shape [patches, ...] and
+    normalizes them to sum to 1 for each patch, without underflowing.
+    """
+    axes = tuple(range(1, log_probabilities.ndim))
+    maxima = np.max(log_probabilities, axis=axes, keepdims=True)
+    probabilities = np.exp(log_probabilities - maxima)
+    return probabilities / np.sum(probabilities, axis=axes, keepdims=True)
@@ -0,0 +1,106 @@
+import contextlib
+import json
+import time
+
+import numpy as np
+
+import utils
+
+# Instrumentation of phases of the pipeline (set-up, EM phases, loopy,
+# reconstruction). Each phase yields one record, a dict with the phase name,
+# its wall and CPU times, the peak RSS of the process after it and fields
+# added by the instrumented code (iteration, sizes of arrays, counters of
+# loopy). Records are appended as JSON lines to a file and passed to
+# callbacks, so that runs can be analysed without a profiler.
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("{} is not JSON serializable".format(type(value)))
+
+
+class Metrics:
+    """
+    Records phases and emits their records to a JSON lines file (appended
+    to, if path is given) and to callbacks, functions of a record. Without
+    a path and callbacks records are dropped. Fields (e.g. a tile or a level
+    of a pyramid) are added to every record.
+    """
+    def __init__(self, path=None, callbacks=(), fields=None):
+        self.path = path
+        self.callbacks = list(callbacks)
+        self.fields = dict(fields or {})
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        """
+        Measures the enclosed code as a phase. Yields its record, to which
+        the code can add fields; the record is emitted when the code
+        finishes without an exception.
+        """
+        record = {"phase": name}
+        record.update(self.fields)
+        record.update(fields)
+        stopwatch = utils.Stopwatch()
+        yield record
+        record.update(stopwatch.elapsed())
+        record["cpu_seconds"] = record["user_seconds"] + record["system_seconds"]
+        record["max_rss_mb"] = utils.peak_rss_mb()
+        self.emit(record)
+
+    def emit(self, record):
+        if self.path is None and not self.callbacks:
+            return
+        record.setdefault("time", time.time())
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record, default=_to_json) + "\n")
+        for callback in self.callbacks:
+            callback(record)
+
+
+def read_metrics(path):
+    """
+    Returns a list of records of a JSON lines file written by Metrics.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records):
+    """
+    Returns a dict from phase name to the number of its records and sums of
+    their wall and CPU seconds.
+    """
+    summary = dict()
+    for record in records:
+        phase = summary.setdefault(record["phase"], {
+            "count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+        })
+        phase["count"] += 1
+        phase["wall_seconds"] += record["wall_seconds"]
+        phase["cpu_seconds"] += record["cpu_seconds"]
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+    argparser = argparse.ArgumentParser(
+        description="Summarize phases recorded in a metrics.jsonl file.")
+    argparser.add_argument("path", help="Path to metrics.jsonl.")
+    args = argparser.parse_args()
+
+    # Nested phases (pairwise_potentials in loopy) are also included in
+    # their enclosing phase.
+    summary = summarize(read_metrics(args.path))
+    print("phase count wall_seconds cpu_seconds")
+    for name, phase in sorted(summary.items(), 
+                              key=lambda item: -item[1]["wall_seconds"]):
+        print("{} {} {:.3f} {:.3f}".format(
+            name, phase["count"], phase["wall_seconds"], phase["cpu_seconds"]))
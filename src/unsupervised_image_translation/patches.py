@@ -1,7 +1,38 @@
+from functools import lru_cache
+import hashlib
+
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import sklearn
 from sklearn.decomposition import PCA
 
+import artifact_cache
+import colors
+import loopy
 import utils
+from metrics import Metrics
+
+
+# Version of arrays of patches stored in a cache, a part of cache keys.
+CACHE_FORMAT = "patches/2"
+
+
+def image_to_patch_grid(image, patch_size, overlap):
+    """
+    Returns a view of an image as a 4D array [rows, cols, patch_size, 
+    patch_size] of patches with a given overlap, without copying the image.
+    Incomplete patches (coming from right and bottom image border) are ignored.
+    """
+    image = np.asarray(image)
+    step = patch_size - overlap
+    rows, cols = rows_cols_of_patches_in_image(image, patch_size, overlap)
+    row_stride, col_stride = image.strides
+    return as_strided(
+        image, 
+        shape=[rows, cols, patch_size, patch_size], 
+        strides=[step * row_stride, step * col_stride, row_stride, col_stride],
+        writeable=False,
+    )
 
 
 def image_to_patches(image, patch_size, overlap):
@@ -9,13 +40,8 @@ def image_to_patches(image, patch_size, overlap):
     Splits an image to patches of patch_size x patch_size, with a given overlap.
     Incomplete patches (coming from right and bottom image border) are ignored.
     """
-    step = patch_size - overlap
-    height, width = np.shape(image)
-    patches = []
-    for y in range(0, height - patch_size + 1, step):
-        for x in range(0, width - patch_size + 1, step):
-            patches.append(image[y:(y + patch_size), x:(x + patch_size)])
-    return np.array(patches)                  
+    grid = image_to_patch_grid(image, patch_size, overlap)
+    return grid.reshape([-1, patch_size, patch_size])
 
 
 def rows_cols_of_patches_in_image(image, patch_size, overlap):
@@ -35,85 +61,268 @@ def patches_to_vectors(patches):
     return patches.reshape(patch_count, patch_size * patch_size)
 
 
+def blend_patch_grid(patch_grid, overlap):
+    """
+    Sums a 4D array [rows, cols, patch_size, patch_size] of patches into an 
+    image where neighbouring patches overlap by a given number of pixels 
+    (or are separated by -overlap zero pixels). Patch pixels are split into 
+    phases of step x step blocks; all patches' blocks of one phase tile the 
+    image without overlap, so each phase is added by a single operation on 
+    a reshaped view of the image.
+    """
+    rows, cols, patch_size, _ = patch_grid.shape
+    step = patch_size - overlap
+    phases = -(-patch_size // step)
+
+    image = np.zeros([(rows + phases - 1) * step, (cols + phases - 1) * step])
+    for i in range(phases):
+        for j in range(phases):
+            blocks = patch_grid[:, :, (i * step):((i + 1) * step), 
+                                (j * step):((j + 1) * step)]
+            tiles = image[(i * step):((i + rows) * step), 
+                          (j * step):((j + cols) * step)]
+            tiles = tiles.reshape([rows, step, cols, step])
+            tiles[:, :blocks.shape[2], :, :blocks.shape[3]] += \
+                blocks.transpose(0, 2, 1, 3)
+
+    return image[:(rows * step + overlap), :(cols * step + overlap)]
+
+
+@lru_cache(maxsize=16)
+def blend_weights(grid_shape, patch_size, overlap):
+    """
+    Returns a read-only map of how many patches cover each pixel of an image 
+    created by blend_patch_grid. It is computed once for each grid.
+    """
+    rows, cols = grid_shape
+    weights = blend_patch_grid(
+        np.ones([rows, cols, patch_size, patch_size]), overlap)
+    weights.flags.writeable = False
+    return weights
+
+
 def plot_patch_vectors(vectors, grid_shape, overlap):
     """
     Transforms pixel vectors into square patches and plots them into 2D grid
     of grid_shape size with specified overlaps. If overlap value is negative,
     image patches are separated by black lines of thickness -overlap.
     """
-    patch_size = round(vectors.shape[1] ** 0.5)
+    patch_size = int(round(vectors.shape[1] ** 0.5))
     patches_in_col, patches_in_row = grid_shape
-    step = patch_size - overlap
-    out_width = patches_in_row * step + overlap
-    out_height = patches_in_col * step + overlap
-
-    image = np.zeros([out_height, out_width])
-    weights = np.zeros([out_height, out_width])
-
-    p = 0
-    for y in range(0, out_height - patch_size + 1, step):
-        for x in range(0, out_width - patch_size + 1, step):
-            patch = vectors[p].reshape([patch_size, patch_size])
-            image[y:(y + patch_size), x:(x + patch_size)] += patch
-            weights[y:(y + patch_size), x:(x + patch_size)] += 1
-            p += 1
+    patch_grid = vectors[:(patches_in_col * patches_in_row)].reshape(
+        [patches_in_col, patches_in_row, patch_size, patch_size])
+
+    image = blend_patch_grid(patch_grid, overlap)
     
     if overlap > 0:
-        image = np.divide(image, weights)
+        image /= blend_weights(
+            (patches_in_col, patches_in_row), patch_size, overlap)
 
     return image  
 
 
+def load_image_in_color_space(path, color_space):
+    """
+    Loads image as grayscale or, if a color space from colors.color_spaces 
+    is given, converts it to that color space. Returns its luminance in 
+    [0, 1] and the converted color image (None for grayscale).
+    """
+    if color_space is None:
+        return utils.load_image(path), None
+    # Image is converted in place, luminance is in channel 0.
+    color_image = utils.load_image_rgb(path)
+    color_space.from_rgb(color_image, out=color_image)
+    return color_image[:, :, 0], color_image
+
+
+def vectors_to_pixel_values(vectors):
+    """
+    Converts patch vectors with values in [0, 1] to 8-bit pixel values.
+    """
+    return np.clip(np.rint(vectors * 255), 0, 255).astype(np.uint8)
+
+
+def overlap_strips(pixel_values, patch_size, overlap):
+    """
+    Returns overlapping regions of patches given by 8-bit pixel values in 
+    the compact uint8 layout used by loopy to compute pairwise potentials: 
+    a row per patch holding its top, right, bottom and left region.
+    Returns None if patches do not overlap.
+    """
+    if overlap <= 0:
+        return None
+    strips = np.empty([pixel_values.shape[0], 4 * overlap * patch_size], 
+                      dtype=np.uint8)
+    loopy.overlap_strips(patch_size, overlap, 
+                         np.ascontiguousarray(pixel_values), strips)
+    return strips
+
+
+def pca_arrays(pca):
+    """
+    Returns a dict of arrays of a fitted PCA from which pca_from_arrays 
+    rebuilds it, so that it is stored without pickle.
+    """
+    return {
+        "pca_components": pca.components_,
+        "pca_mean": pca.mean_,
+        "pca_explained_variance": pca.explained_variance_,
+        "pca_explained_variance_ratio": pca.explained_variance_ratio_,
+    }
+
+
+def pca_from_arrays(arrays):
+    """
+    Returns PCA with attributes stored by pca_arrays, which transforms 
+    vectors as the fitted one.
+    """
+    # In the Fortran order of fitted components, so that projections are 
+    # computed in the same order and equal those of the fitted PCA.
+    components = np.asfortranarray(arrays["pca_components"])
+    pca = PCA(n_components=components.shape[0])
+    pca.components_ = components
+    pca.n_components_ = components.shape[0]
+    pca.n_features_in_ = components.shape[1]
+    pca.mean_ = np.array(arrays["pca_mean"])
+    pca.explained_variance_ = np.array(arrays["pca_explained_variance"])
+    pca.explained_variance_ratio_ = np.array(
+        arrays["pca_explained_variance_ratio"])
+    return pca
+
+
+def global_random_state():
+    """
+    Returns the state of the global NumPy random generator as a dict of 
+    arrays, which can be cached and restored by set_global_random_state.
+    """
+    _, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        "random_keys": keys,
+        "random_position": np.array([position, has_gauss]),
+        "random_gaussian": np.array([cached_gaussian]),
+    }
+
+
+def set_global_random_state(state):
+    np.random.set_state((
+        "MT19937", np.array(state["random_keys"]), 
+        int(state["random_position"][0]), int(state["random_position"][1]), 
+        float(state["random_gaussian"][0]),
+    ))
+
+
+def random_state_digest(state):
+    """
+    Returns SHA-256 of a state returned by global_random_state.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(state):
+        digest.update(np.ascontiguousarray(state[name]).tobytes())
+    return digest.hexdigest()
+
+
 class Patches:
     """
     Holds input and dictionary patches in form of vectors with all informations 
     needed to reconstruct images. Also stores compact patch representations
     in form of principal components.
     """
+    # Array attributes computed from images, which are stored in a cache.
+    cached_arrays = [
+        "observed_vectors", "dictionary_vectors", 
+        "compact_observed_vectors", "compact_dictionary_vectors",
+    ]
+    cached_gray_images = ["input_image_contrast", "source_image_contrast"]
+    cached_color_images = ["color_input_image", "color_source_image"]
+
     def __init__(self, input_path, source_path, patch_size, patch_overlap, 
-                pca_k, color):
+                pca_k, color, cache=None, random_state=None, style_model=None, 
+                input_image=None, source_image=None, pca=None, metrics=None):
         # Store scalar settings.    
         self.patch_size = patch_size
         self.vector_size = patch_size * patch_size
         self.patch_overlap = patch_overlap
         self.pca_k = pca_k
+        # Name of a color space from colors.color_spaces, True for YIQ or 
+        # None / False for grayscale.
         self.color = color
-        
-        # Load images.
-        if not color:
-            self.source_image_contrast = utils.load_image(source_path)
-            self.input_image_contrast = utils.load_image(input_path)
+        if color is True or color == "color":
+            color = "yiq"
+        self.color_space = colors.color_spaces[color] if color else None
+
+        # A compiled style model (see style_model.StyleModel) replaces the 
+        # source image: dictionary patches and PCA are taken from it and 
+        # only the input image is processed.
+        self.style_model = style_model
+        if style_model is not None:
+            style_model.check_settings(
+                patch_size=patch_size, patch_overlap=patch_overlap, 
+                pca_k=pca_k, color=color or None)
+
+        # Input and source images already converted to the color space 
+        # (e.g. a tile of a large image, see tiling.py, or a downsampled 
+        # level of a pyramid, see pyramid.py) can be passed instead of paths.
+        self.input_image = input_image
+        self.source_image = source_image
+        # A fitted PCA, e.g. shared by levels of a pyramid, is used instead
+        # of fitting one.
+        self.pca = pca
+        # Records of phases of computing artifacts (see metrics.py).
+        self.metrics = metrics or Metrics()
+
+        # Random state of PCA (its randomized SVD). None draws from the 
+        # global NumPy generator, as PCA always did, so a given -random_seed 
+        # gives the same PCA and the same draws after it (e.g. initial 
+        # lambdas of EM) as before caching was added.
+        self.random_state = random_state
+
+        # Images, patch vectors and PCA are loaded from a cache (see 
+        # artifact_cache.ArtifactCache) if it holds them for the same image 
+        # contents and settings. With the global generator, its state before 
+        # fitting PCA is a part of the key and its state after fitting is 
+        # cached and restored, so a cache hit leaves the generator as a miss.
+        self.cache_key = None
+        artifacts = None
+        if (cache is not None and style_model is None and input_image is None
+                and source_image is None and pca is None):
+            self.cache_key = cache.key(
+                kind="patches",
+                format=CACHE_FORMAT,
+                input=artifact_cache.file_digest(input_path),
+                source=artifact_cache.file_digest(source_path),
+                patch_size=patch_size, 
+                patch_overlap=patch_overlap, 
+                pca_k=pca_k, 
+                color=color or None,
+                random_state=(
+                    random_state if random_state is not None else 
+                    random_state_digest(global_random_state())),
+                sklearn=sklearn.__version__,
+            )
+            artifacts = cache.load(self.cache_key)
+
+        if style_model is not None:
+            self.load_style_model(input_path)
+        elif artifacts is not None:
+            self.restore_artifacts(artifacts)
         else:
-            input_image = utils.load_image_rgb(input_path)
-            self.yiq_input_image = utils.rgb2yiq(input_image)
-            self.input_image_contrast = self.yiq_input_image[:, :, 0] 
-            
-            source_image = utils.load_image_rgb(source_path)
-            self.yiq_source_image = utils.rgb2yiq(source_image)
-            self.source_image_contrast = self.yiq_source_image[:, :, 0] 
-        
-        # Create observed patches
-        self.observed_vectors = patches_to_vectors(image_to_patches(
-            self.input_image_contrast, patch_size, patch_overlap))
+            self.compute_artifacts(input_path, source_path)
+            if cache is not None:
+                cache.store(self.cache_key, self.artifacts())
+
         self.observed_grid_size = rows_cols_of_patches_in_image(
             self.input_image_contrast, patch_size, patch_overlap)
         self.patch_count = self.observed_vectors.shape[0]
-        
-        # Creaate dictionary_patches
-        self.dictionary_vectors = patches_to_vectors(image_to_patches(
-            self.source_image_contrast, patch_size, patch_overlap))
-        self.source_grid_size = rows_cols_of_patches_in_image(
-            self.source_image_contrast, patch_size, patch_overlap)
         self.dictionary_size = self.dictionary_vectors.shape[0]
-
-        # Create compact patches with PCA
-        self.pca = PCA(n_components=pca_k)
-        self.pca.fit(np.vstack([self.observed_vectors, 
-                                self.dictionary_vectors]))
-        self.compact_observed_vectors = self.pca.transform(
-            self.observed_vectors)
-        self.compact_dictionary_vectors = self.pca.transform(
-            self.dictionary_vectors)
+        if style_model is None:
+            self.source_grid_size = rows_cols_of_patches_in_image(
+                self.source_image_contrast, patch_size, patch_overlap)
+            # 8-bit pixel values of dictionary patches and their overlapping 
+            # regions, as used by loopy.
+            self.dictionary_pixel_values = vectors_to_pixel_values(
+                self.dictionary_vectors)
+            self.dictionary_overlap_strips = overlap_strips(
+                self.dictionary_pixel_values, patch_size, patch_overlap)
         
         # Print patch stats.
         print("Patch count (P)           :", self.patch_count)
@@ -127,12 +336,109 @@ class Patches:
         explained_variance =  np.sum(self.pca.explained_variance_ratio_)
         print("Variance explained by PC:", explained_variance)
 
+    def compute_artifacts(self, input_path, source_path):
+        """
+        Loads images, splits them to patches and fits PCA.
+        """
+        with self.metrics.phase("patch_extraction"):
+            self.input_image_contrast, self.color_input_image = \
+                self.load_image(input_path, self.input_image)
+            self.source_image_contrast, self.color_source_image = \
+                self.load_image(source_path, self.source_image)
+            
+            # Create observed patches
+            self.observed_vectors = patches_to_vectors(image_to_patches(
+                self.input_image_contrast, self.patch_size, self.patch_overlap))
+            
+            # Creaate dictionary_patches
+            self.dictionary_vectors = patches_to_vectors(image_to_patches(
+                self.source_image_contrast, self.patch_size, self.patch_overlap))
+
+        # Create compact patches with PCA
+        with self.metrics.phase("pca"):
+            if self.pca is None:
+                self.pca = PCA(n_components=self.pca_k, 
+                               random_state=self.random_state)
+                self.pca.fit(np.vstack([self.observed_vectors, 
+                                        self.dictionary_vectors]))
+            self.compact_observed_vectors = self.pca.transform(
+                self.observed_vectors)
+            self.compact_dictionary_vectors = self.pca.transform(
+                self.dictionary_vectors)
+
+    def load_image(self, path, image):
+        """
+        Returns luminance and color image (None for grayscale) of an image 
+        loaded from path unless it was already passed as image.
+        """
+        if image is None:
+            return load_image_in_color_space(path, self.color_space)
+        if self.color_space is None:
+            return image, None
+        return image[:, :, 0], image
+
+    def load_style_model(self, input_path):
+        """
+        Loads the input image and splits it to patches, which are projected 
+        by PCA of the style model. Everything about dictionary patches is 
+        memory-mapped from the style model.
+        """
+        self.input_image_contrast, self.color_input_image = \
+            self.load_image(input_path, self.input_image)
+        self.observed_vectors = patches_to_vectors(image_to_patches(
+            self.input_image_contrast, self.patch_size, self.patch_overlap))
+
+        model = self.style_model
+        self.pca = model.pca
+        self.compact_observed_vectors = self.pca.transform(
+            self.observed_vectors)
+        self.dictionary_vectors = model.dictionary_vectors
+        self.compact_dictionary_vectors = model.compact_dictionary_vectors
+        self.dictionary_pixel_values = model.dictionary_pixel_values
+        self.dictionary_overlap_strips = model.dictionary_overlap_strips
+        self.source_grid_size = model.source_grid_size
+
+    def artifacts(self):
+        """
+        Returns a dict of arrays computed by compute_artifacts, with arrays 
+        of the fitted PCA (see pca_arrays). With the global random 
+        generator, its state after fitting PCA is included.
+        """
+        images = (self.cached_gray_images if self.color_space is None 
+                  else self.cached_color_images)
+        artifacts = {
+            name: getattr(self, name) for name in self.cached_arrays + images
+        }
+        artifacts.update(pca_arrays(self.pca))
+        if self.random_state is None:
+            artifacts.update(global_random_state())
+        return artifacts
+
+    def restore_artifacts(self, artifacts):
+        """
+        Sets attributes from arrays returned by artifacts, which stay 
+        memory-mapped and read-only.
+        """
+        for name in self.cached_arrays:
+            setattr(self, name, artifacts[name])
+        if self.color_space is None:
+            for name in self.cached_gray_images:
+                setattr(self, name, artifacts[name])
+        else:
+            for name in self.cached_color_images:
+                setattr(self, name, artifacts[name])
+            self.input_image_contrast = self.color_input_image[:, :, 0]
+            self.source_image_contrast = self.color_source_image[:, :, 0]
+        self.pca = pca_from_arrays(artifacts)
+        if self.random_state is None:
+            set_global_random_state(artifacts)
+
     def reconstruct_image(self, most_probable_patches, 
                           reconstruct_in_color=None):
         """
         With an array of indices of most probable source patches for each 
-        observed patch, creates an image by joining source patches. If yiq 
-        original image is provided, an RGB image is returned where color 
+        observed patch, creates an image by joining source patches. If the 
+        input image is in color, an RGB image is returned where chrominance 
         chennels are copied from original image.
         """
         reconsturcted_grayscale = plot_patch_vectors(
@@ -150,9 +456,10 @@ class Patches:
 
         if reconstruct_in_color:
             shape = reconsturcted_grayscale.shape
-            color_reconstructed = self.yiq_input_image[:shape[0], :shape[1], :]
+            color_reconstructed = \
+                self.color_input_image[:shape[0], :shape[1], :].copy()
             color_reconstructed[:, :, 0] = reconsturcted_grayscale
-            color_reconstructed = utils.yiq2rgb(color_reconstructed)
-            return color_reconstructed
+            return self.color_space.to_rgb(
+                color_reconstructed, out=color_reconstructed)
         else:
             return reconsturcted_grayscale
@@ -0,0 +1,275 @@
+import os
+import time
+
+import numpy as np
+from scipy.misc import imsave
+
+import candidates
+import likelihood
+from em import uniform_messages, normalize_messages
+from experiment import (prepare_argument_parser, write_arguments, run_em,
+                        create_cache, create_patches, create_em,
+                        create_candidate_search, create_metrics)
+
+# Coarse-to-fine translation. The input and source images are downsampled
+# by 2 for each coarser level of a pyramid and split to patches of the same
+# size, projected by PCA of the finest level, so lambdas of all levels live
+# in the same space. EM runs first on the coarsest level, whose candidates
+# are found by the selected candidate search. Each finer level takes
+# candidates, posteriors, lambdas and loopy messages of the coarser one:
+# a patch inherits them from its parent, the coarser patch with the nearest
+# center, and its candidates are the nearest of dictionary patches whose
+# parents are candidates of its parent. Only a few iterations then run on
+# the full resolution.
+
+# Levels with fewer patches in a row or column are not created.
+MIN_GRID_SIZE = 4
+
+# Inherited probabilities are at least this, so that a finer level can move
+# away from nearly certain choices of the coarser one.
+PROBABILITY_FLOOR = 1e-3
+
+
+def downsample(image):
+    """
+    Halves an image (2D or with channels) by averaging blocks of 2 x 2
+    pixels, the last odd row and column are dropped.
+    """
+    height, width = image.shape[0] // 2, image.shape[1] // 2
+    image = image[:(2 * height), :(2 * width)]
+    return image.reshape(
+        [height, 2, width, 2] + list(image.shape[2:])).mean(axis=(1, 3))
+
+
+def parent_rows(count, coarse_count, patch_size, step):
+    """
+    Returns indices of coarse patches with the nearest center for each of
+    count patches in a row (or column) of a twice finer grid.
+    """
+    centers = np.arange(count) * step + patch_size / 2
+    return np.clip(np.rint((centers / 2 - patch_size / 2) / step),
+                   0, coarse_count - 1).astype(int)
+
+
+def parent_indices(grid_size, coarse_grid_size, patch_size, step):
+    """
+    Returns an array with the index of the parent coarse patch of each patch
+    of a grid, see parent_rows.
+    """
+    rows = parent_rows(grid_size[0], coarse_grid_size[0], patch_size, step)
+    cols = parent_rows(grid_size[1], coarse_grid_size[1], patch_size, step)
+    return (rows[:, np.newaxis] * coarse_grid_size[1] +
+            cols[np.newaxis, :]).ravel()
+
+
+def children_indices(parents, coarse_count):
+    """
+    Returns a 2D array with indices of children of each coarse patch in a
+    row, padded by -1.
+    """
+    order = np.argsort(parents, kind="mergesort")
+    counts = np.bincount(parents, minlength=coarse_count)
+    starts = np.cumsum(counts) - counts
+    children = np.full([coarse_count, max(counts.max(), 1)], -1, dtype=int)
+    sorted_parents = parents[order]
+    children[sorted_parents, np.arange(len(parents)) - starts[sorted_parents]] = \
+        order
+    return children
+
+
+class PyramidSearch:
+    """
+    Candidate search of a finer level of a pyramid. Candidates of a patch
+    are the nearest of children of candidates of its parent patch. Patches
+    with fewer than k such children are searched exactly.
+    """
+    def __init__(self, parent_candidates, dictionary_children,
+                 chunk_size=likelihood.DEFAULT_CHUNK_SIZE):
+        self.pool = dictionary_children[parent_candidates].reshape(
+            [parent_candidates.shape[0], -1])
+        self.chunk_size = chunk_size
+
+    def fit(self, dictionary_vectors):
+        self.dictionary_vectors = dictionary_vectors
+        return self
+
+    def search(self, observed_vectors, k):
+        patch_count = observed_vectors.shape[0]
+        k = min(k, self.dictionary_vectors.shape[0])
+        k_indices = np.full([patch_count, k], -1, dtype=int)
+        k_distances = np.full([patch_count, k], np.inf)
+
+        if self.pool.shape[1] >= k:
+            for start in range(0, patch_count, self.chunk_size):
+                chunk = slice(start, start + self.chunk_size)
+                pool = self.pool[chunk]
+                differences = (self.dictionary_vectors[np.maximum(pool, 0)] -
+                               observed_vectors[chunk, np.newaxis])
+                distances = np.sum(differences ** 2, axis=-1)
+                distances[pool < 0] = np.inf
+                rows = np.arange(pool.shape[0])[:, np.newaxis]
+                nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                k_indices[chunk] = pool[rows, nearest]
+                k_distances[chunk] = distances[rows, nearest]
+
+        incomplete = np.flatnonzero(np.isinf(k_distances).any(axis=1))
+        if len(incomplete) > 0:
+            k_indices[incomplete], k_distances[incomplete] = \
+                candidates.nearest_candidates(observed_vectors[incomplete],
+                                              self.dictionary_vectors, k)
+
+        return candidates.sort_from_farthest(k_indices, k_distances)
+
+
+def create_levels(args, fine_patches, levels):
+    """
+    Returns patches of pyramid levels from the coarsest to fine_patches.
+    """
+    color = fine_patches.color_space is not None
+    input_image = (fine_patches.color_input_image if color
+                   else fine_patches.input_image_contrast)
+    source_image = (fine_patches.color_source_image if color
+                    else fine_patches.source_image_contrast)
+
+    pyramid = [fine_patches]
+    for _ in range(1, levels):
+        input_image = downsample(input_image)
+        source_image = downsample(source_image)
+        step = args.patch_size - args.patch_overlap
+        if min(input_image.shape[:2] + source_image.shape[:2]) < \
+                MIN_GRID_SIZE * step + args.patch_overlap:
+            break
+        pyramid.append(create_patches(
+            args, input_image=input_image, source_image=source_image,
+            pca=fine_patches.pca))
+    return pyramid[::-1]
+
+
+def refine(args, coarse_em, patches, metrics=None):
+    """
+    Creates EM of a finer level initialized from EM of the coarser level:
+    a patch inherits lambdas, posteriors of candidates and transformations,
+    loopy posteriors and loopy messages of the parent's candidate which is
+    the parent of its candidate (uniform if there is none). Inherited
+    messages are normalized again.
+    """
+    coarse_patches = coarse_em.patches
+    step = args.patch_size - args.patch_overlap
+    parents = parent_indices(patches.observed_grid_size,
+                             coarse_patches.observed_grid_size,
+                             args.patch_size, step)
+    dictionary_parents = parent_indices(patches.source_grid_size,
+                                        coarse_patches.source_grid_size,
+                                        args.patch_size, step)
+    search = PyramidSearch(
+        coarse_em.candidate_indices[parents],
+        children_indices(dictionary_parents, coarse_patches.dictionary_size),
+        chunk_size=args.em_chunk_size)
+    candidate_indices, candidate_distances = search.fit(
+        patches.compact_dictionary_vectors).search(
+            patches.compact_observed_vectors, args.num_candidates)
+
+    # Position of the parent of each candidate among candidates of the
+    # patch's parent, or -1.
+    matches = (coarse_em.candidate_indices[parents][:, :, np.newaxis] ==
+               dictionary_parents[candidate_indices][:, np.newaxis, :])
+    slots = np.where(matches.any(axis=1), matches.argmax(axis=1), -1)
+    rows = parents[:, np.newaxis]
+    # Pruned candidates of the parent (see EM.prune_candidates) are none.
+    if coarse_em.candidate_counts is not None:
+        slots[slots >= coarse_em.candidate_counts[rows]] = -1
+
+    def inherit(values, default):
+        inherited = values[rows, np.maximum(slots, 0)]
+        inherited[slots < 0] = default
+        return inherited
+
+    k = coarse_em.num_candidates
+    log_probs = np.log(np.maximum(
+        inherit(coarse_em.probs, 1 / k), PROBABILITY_FLOOR))
+    log_probs -= 0.5 * candidate_distances[:, :, np.newaxis]
+    loopy_probs = np.maximum(
+        inherit(coarse_em.loopy_probs, 1 / k), PROBABILITY_FLOOR)
+    state = {
+        "probs": likelihood.normalize_log_probabilities(log_probs),
+        "loopy_probs": loopy_probs / np.sum(loopy_probs, axis=1, keepdims=True),
+        "lambdas": coarse_em.lambdas,
+    }
+
+    messages = coarse_em.loopy_messages()
+    if messages is not None:
+        # Elements without a parent are uniform, each message is then
+        # normalized again. Messages from outside of the grid stay uniform.
+        log_domain = args.lbp_precision == "log"
+        active = np.ones(candidate_distances.shape, dtype=bool)
+        uniform = uniform_messages(active, log_domain)
+        messages = np.stack([
+            inherit(messages[:, direction], uniform[slots < 0])
+            for direction in range(4)
+        ], axis=1)
+        messages = normalize_messages(
+            messages, active[:, np.newaxis], log_domain)
+        grid_shape = list(patches.observed_grid_size)
+        messages = messages.reshape(grid_shape + [4, -1])
+        uniform = uniform.reshape(grid_shape + [-1])
+        messages[0, :, 0], messages[:, -1, 1] = uniform[0], uniform[:, -1]
+        messages[-1, :, 2], messages[:, 0, 3] = uniform[-1], uniform[:, 0]
+        state["initial_lbp_messages"] = messages.reshape(
+            [patches.patch_count, -1])
+
+    return create_em(args, patches, candidates.PrecomputedSearch(
+        candidate_indices, candidate_distances), state, metrics)
+
+
+def run_pyramid(args):
+    """
+    Runs -pyramid_iterations EM iterations on each coarser level and
+    -em_iterations on the finest level. Saves MAP image of each coarser
+    level and returns EM of the finest level with log a posterior
+    probabilities of its iterations.
+    """
+    write_arguments(args)
+    np.random.seed(args.random_seed)
+    fine_patches = create_patches(args, create_cache(args))
+    pyramid = create_levels(args, fine_patches, args.pyramid_levels)
+
+    em = None
+    for level, patches in enumerate(pyramid):
+        start = time.time()
+        metrics = create_metrics(args, level=level)
+        if em is None:
+            em = create_em(args, patches, create_candidate_search(args),
+                           metrics=metrics)
+        else:
+            em = refine(args, em, patches, metrics)
+        if level == len(pyramid) - 1:
+            print("Level {} set up in {:.3f} s, grid {}".format(
+                level, time.time() - start, patches.observed_grid_size))
+            return em, run_em(args, em)
+
+        for i in range(args.pyramid_iterations):
+            em.execute_iteration()
+        imsave(os.path.join(args.output, "level_{}.png".format(level)),
+               em.MAP_image())
+        print("Level {}: {:.3f} s, grid {}, log a posterior {}".format(
+            level, time.time() - start, patches.observed_grid_size,
+            em.log_a_posterior_probability()))
+
+
+def add_pyramid_arguments(argparser):
+    argparser.add_argument("-pyramid_levels", type=int, default=3,
+        help="Number of levels of the pyramid, each coarser level halves the images.")
+    argparser.add_argument("-pyramid_iterations", type=int, default=3,
+        help="Number of EM iterations on each coarser level, -em_iterations run on the finest one.")
+
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser()
+    add_pyramid_arguments(argparser)
+    args, _ = argparser.parse_known_args()
+    if args.style_model is not None:
+        argparser.error("pyramid needs -source, downsampled levels are created from it.")
+    if args.resume is not None:
+        argparser.error("pyramid can't resume, resume its finest level with main.py instead.")
+
+    run_pyramid(args)
@@ -0,0 +1,237 @@
+import contextlib
+import copy
+import os
+import time
+
+import numpy as np
+from scipy.misc import imsave
+
+import candidates
+import likelihood
+from batch import list_inputs
+from em import uniform_messages
+from experiment import (prepare_argument_parser, write_arguments, run_em,
+                        prepare_style_model, create_style_model_search,
+                        create_cache, create_patches, create_em,
+                        create_metrics)
+from style_model import StyleModel
+
+# Translates a sequence of frames (e.g. extracted from a video) with one
+# style. The source image is compiled into a style model once, so all frames
+# share its dictionary and PCA, and consecutive frames share most patches.
+# The first frame runs -em_iterations from scratch. Every next frame starts
+# from EM of the previous one: lambdas, psis and candidates of each patch
+# are kept, and only patches whose content changed by more than
+# -change_threshold are searched for candidates again. Unchanged patches
+# also keep their posteriors and loopy messages, changed ones start from
+# their candidate distances and uniform messages. Then only
+# -frame_em_iterations run. A frame with a different size starts from
+# scratch.
+
+SUMMARY_COLUMNS = [
+    "frame", "start", "changed_patches", "setup_seconds", "em_seconds",
+    "seconds", "final_log_posterior",
+]
+
+
+def changed_patches(patches, previous_patches, threshold):
+    """
+    Returns a boolean array marking patches whose luminance differs from the
+    same patch of the previous frame by more than threshold (root mean
+    square over pixels, which are in [0, 1]).
+    """
+    differences = patches.observed_vectors - previous_patches.observed_vectors
+    return np.sqrt(np.mean(differences ** 2, axis=1)) > threshold
+
+
+class TemporalSearch:
+    """
+    Candidate search of a frame which keeps candidates of unchanged patches
+    from the previous frame, in the same order (with distances to their new
+    vectors), and finds candidates of changed patches by a backend.
+    """
+    def __init__(self, backend, previous_indices, changed):
+        self.backend = backend
+        self.previous_indices = previous_indices
+        self.changed = changed
+
+    def fit(self, dictionary_vectors):
+        self.dictionary_vectors = dictionary_vectors
+        self.backend = self.backend.fit(dictionary_vectors)
+        return self
+
+    def search(self, observed_vectors, k):
+        k_indices = self.previous_indices.copy()
+        if self.changed.any():
+            k_indices[self.changed], _ = self.backend.search(
+                observed_vectors[self.changed], k)
+        k_distances = np.sum((self.dictionary_vectors[k_indices] -
+                              observed_vectors[:, np.newaxis]) ** 2, axis=-1)
+        return k_indices, k_distances
+
+
+def follow(args, previous_em, patches, candidate_search, metrics=None):
+    """
+    Creates EM of a frame initialized from EM of the previous frame, see
+    the comment at the top. Returns it and the number of changed patches.
+    """
+    changed = changed_patches(patches, previous_em.patches,
+                              args.change_threshold)
+    previous_indices = previous_em.candidate_indices
+    search = TemporalSearch(candidate_search, previous_indices, changed)
+    candidate_indices, candidate_distances = search.fit(
+        patches.compact_dictionary_vectors).search(
+            patches.compact_observed_vectors, args.num_candidates)
+
+    # Candidates of an unchanged patch are those of the previous frame in
+    # the same order, so they inherit its values, changed patches don't.
+    def inherit(values, default):
+        inherited = values.copy()
+        inherited[changed] = default[changed]
+        return inherited
+
+    # Changed patches keep marginals of transformations of the previous
+    # frame.
+    k = args.num_candidates
+    marginals = np.sum(previous_em.probs, axis=1)
+    initial_probs = likelihood.normalize_log_probabilities(
+        -0.5 * candidate_distances)
+    state = {
+        "probs": inherit(
+            previous_em.probs,
+            initial_probs[:, :, np.newaxis] * marginals[:, np.newaxis, :]),
+        "loopy_probs": inherit(
+            previous_em.loopy_probs, np.full(candidate_distances.shape, 1 / k)),
+        "lambdas": previous_em.lambdas,
+        "psis": previous_em.psis,
+    }
+
+    messages = previous_em.loopy_messages()
+    if messages is not None:
+        # Messages received by changed patches, which consider all their
+        # candidates, start as uniform.
+        uniform = uniform_messages(
+            np.ones(candidate_distances.shape, dtype=bool),
+            args.lbp_precision == "log")
+        messages = np.stack([
+            inherit(messages[:, direction], uniform) for direction in range(4)
+        ], axis=1)
+        state["initial_lbp_messages"] = messages.reshape(
+            [patches.patch_count, -1])
+
+    # Unchanged patches keep their pruned candidates (see
+    # EM.prune_candidates), changed ones have all k.
+    if previous_em.candidate_counts is not None:
+        state["candidate_counts"] = np.where(
+            changed, candidate_indices.shape[1], previous_em.candidate_counts)
+
+    em = create_em(args, patches, candidates.PrecomputedSearch(
+        candidate_indices, candidate_distances), state, metrics)
+    # Potentials of pruned candidates were not computed.
+    if (previous_em.potentials is not None and
+            np.array_equal(candidate_indices, previous_indices) and
+            (previous_em.candidate_counts is None or not changed.any())):
+        em.use_pairwise_potentials(previous_em.potentials)
+    return em, int(np.sum(changed))
+
+
+def translate_frame(args, name, path, previous_em, style_model,
+                    candidate_search):
+    """
+    Translates a frame into its own output folder, printing into its
+    log.txt, and saves its MAP image to the frames folder. Returns its EM
+    and a dict with a value for each of SUMMARY_COLUMNS.
+    """
+    frame_args = copy.copy(args)
+    frame_args.input = path
+    frame_args.output = os.path.join(args.output, name)
+    write_arguments(frame_args)
+
+    start = time.time()
+    with open(os.path.join(frame_args.output, "log.txt"), "w") as log, \
+            contextlib.redirect_stdout(log):
+        metrics = create_metrics(frame_args, frame=name)
+        patches = create_patches(frame_args, create_cache(frame_args),
+                                 style_model, metrics)
+        if (previous_em is None or patches.observed_grid_size !=
+                previous_em.patches.observed_grid_size):
+            em = create_em(frame_args, patches, candidate_search,
+                           metrics=metrics)
+            kind, changed = "cold", patches.patch_count
+        else:
+            frame_args.em_iterations = args.frame_em_iterations
+            em, changed = follow(frame_args, previous_em, patches,
+                                 candidate_search, metrics)
+            kind = "warm"
+        setup_end = time.time()
+        log_posteriors = run_em(frame_args, em)
+        end = time.time()
+
+    imsave(os.path.join(args.output, "frames", "{}.png".format(name)),
+           em.MAP_image())
+    summary = {
+        "frame": name,
+        "start": kind,
+        "changed_patches": str(changed),
+        "setup_seconds": "{:.3f}".format(setup_end - start),
+        "em_seconds": "{:.3f}".format(end - setup_end),
+        "seconds": "{:.3f}".format(end - start),
+        "final_log_posterior": "{:.6g}".format(log_posteriors[-1]),
+    }
+    return em, summary
+
+
+def run_sequence(args):
+    """
+    Translates frames listed by -inputs in order. Returns a list of their
+    summaries.
+    """
+    frames = list_inputs(args.inputs)
+    frames_dir = os.path.join(args.output, "frames")
+    if not os.path.exists(frames_dir):
+        os.makedirs(frames_dir)
+
+    start = time.time()
+    prepare_style_model(args)
+    style_model = StyleModel(args.style_model)
+    candidate_search = create_style_model_search(args, style_model)
+    print("Style model prepared in {:.3f} s: {}".format(
+        time.time() - start, args.style_model))
+
+    np.random.seed(args.random_seed)
+    em = None
+    summaries = []
+    with open(os.path.join(args.output, "summary.txt"), "w") as f:
+        f.write(" ".join(SUMMARY_COLUMNS) + "\n")
+        for i, (name, path) in enumerate(frames, 1):
+            em, summary = translate_frame(args, name, path, em, style_model,
+                                          candidate_search)
+            line = " ".join(summary[column] for column in SUMMARY_COLUMNS)
+            print("[{}/{}] {}".format(i, len(frames), line))
+            f.write(line + "\n")
+            f.flush()
+            summaries.append(summary)
+    return summaries
+
+
+def add_sequence_arguments(argparser):
+    argparser.add_argument("-frame_em_iterations", type=int, default=2,
+        help="Number of EM iterations of each frame after the first one, which runs -em_iterations.")
+    argparser.add_argument("-change_threshold", type=float, default=0.02,
+        help="Patches whose luminance changed by more (RMS over pixels in [0, 1]) since the previous "
+             "frame are searched for candidates again.")
+
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser(batch=True)
+    add_sequence_arguments(argparser)
+    args, _ = argparser.parse_known_args()
+    if args.workers != 1:
+        argparser.error("frames are translated one after another, -workers can't be used.")
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    start = time.time()
+    summaries = run_sequence(args)
+    print("Translated {} frames in {:.3f} s.".format(
+        len(summaries), time.time() - start))
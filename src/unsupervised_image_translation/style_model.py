@@ -0,0 +1,128 @@
+import json
+import os
+
+import numpy as np
+from sklearn.decomposition import PCA
+
+import artifact_cache
+import candidates
+import colors
+import patches as patches_module
+
+
+FORMAT = "style_model/2"
+
+# Settings fixed when a style model is compiled, which translation must use.
+SETTINGS = ["patch_size", "patch_overlap", "pca_k", "color"]
+
+
+def compile_style_model(source_path, model_path, patch_size, patch_overlap,
+                        pca_k, color=None, candidate_search=None,
+                        random_state=None):
+    """
+    Compiles a source image into a self-contained style model file: its
+    dictionary patch vectors, PCA fitted on the source only, projected
+    dictionary vectors, 8-bit pixel values and overlap strips used by loopy
+    and optionally a candidate search backend (see candidates.py) fitted on
+    the dictionary. Color is a name from colors.color_spaces or None. The
+    model holds only plain arrays and JSON settings, PCA and the index are
+    rebuilt from them when it is loaded, so loading runs no stored code.
+    """
+    if color == "color":
+        color = "yiq"
+    color_space = colors.color_spaces[color] if color else None
+    source_image_contrast, _ = patches_module.load_image_in_color_space(
+        source_path, color_space)
+    dictionary_vectors = patches_module.patches_to_vectors(
+        patches_module.image_to_patches(
+            source_image_contrast, patch_size, patch_overlap))
+
+    pca = PCA(n_components=pca_k, random_state=random_state)
+    compact_dictionary_vectors = pca.fit_transform(dictionary_vectors)
+    pixel_values = patches_module.vectors_to_pixel_values(dictionary_vectors)
+
+    settings = {
+        "format": FORMAT,
+        "patch_size": patch_size,
+        "patch_overlap": patch_overlap,
+        "pca_k": pca_k,
+        "color": color or None,
+        "source": os.path.basename(source_path),
+        "source_digest": artifact_cache.file_digest(source_path),
+        "candidate_search": None,
+        "candidate_search_settings": None,
+    }
+    arrays = {
+        "dictionary_vectors": dictionary_vectors,
+        "compact_dictionary_vectors": compact_dictionary_vectors,
+        "dictionary_pixel_values": pixel_values,
+        "source_grid_size": np.array(
+            patches_module.rows_cols_of_patches_in_image(
+                source_image_contrast, patch_size, patch_overlap)),
+    }
+    arrays.update(patches_module.pca_arrays(pca))
+    strips = patches_module.overlap_strips(
+        pixel_values, patch_size, patch_overlap)
+    if strips is not None:
+        arrays["dictionary_overlap_strips"] = strips
+    if candidate_search is not None:
+        settings["candidate_search"] = type(candidate_search).__name__
+        settings["candidate_search_settings"] = dict(vars(candidate_search))
+        candidate_search.fit(compact_dictionary_vectors)
+        for name, array in candidate_search.index_arrays().items():
+            arrays["search_index_" + name] = array
+    arrays["settings"] = np.frombuffer(
+        json.dumps(settings).encode("utf-8"), np.uint8)
+
+    # Written under a temporary name, so that a model being used by a running
+    # translation is replaced at once.
+    artifact_cache.replace_arrays(model_path, arrays)
+
+    return settings
+
+
+class StyleModel:
+    """
+    Style model compiled by compile_style_model. Arrays are memory-mapped
+    from the model file, so loading it does not depend on the source size.
+    """
+    def __init__(self, path):
+        self.path = path
+        arrays = artifact_cache.read_arrays(path)
+        if "settings" not in arrays:
+            raise ValueError("{} is not a style model.".format(path))
+        self.settings = json.loads(arrays["settings"].tobytes().decode("utf-8"))
+        if self.settings.get("format") != FORMAT:
+            raise ValueError("{} has unknown style model format {}.".format(
+                path, self.settings.get("format")))
+
+        self.dictionary_vectors = arrays["dictionary_vectors"]
+        self.compact_dictionary_vectors = arrays["compact_dictionary_vectors"]
+        self.dictionary_pixel_values = arrays["dictionary_pixel_values"]
+        self.dictionary_overlap_strips = arrays.get("dictionary_overlap_strips")
+        self.source_grid_size = [int(n) for n in arrays["source_grid_size"]]
+        self.pca = patches_module.pca_from_arrays(arrays)
+        self.search_index = None
+        if self.settings["candidate_search"] is not None:
+            backends = {
+                backend.__name__: backend
+                for backend in candidates.candidate_searches.values()
+            }
+            backend = backends[self.settings["candidate_search"]](
+                **self.settings["candidate_search_settings"])
+            prefix = "search_index_"
+            index = {name[len(prefix):]: array for name, array in arrays.items()
+                     if name.startswith(prefix)}
+            self.search_index = backend.restore_index(
+                self.compact_dictionary_vectors, index)
+
+    def check_settings(self, **settings):
+        """
+        Raises ValueError if settings differ from those the model was
+        compiled with.
+        """
+        for name, value in settings.items():
+            if self.settings[name] != value:
+                raise ValueError(
+                    "Style model {} was compiled with {}={}, not {}.".format(
+                        self.path, name, self.settings[name], value))
@@ -0,0 +1,290 @@
+import contextlib
+import copy
+import itertools
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from artifact_cache import ArtifactCache, file_digest
+from experiment import prepare_argument_parser, set_up_experiment, run_em
+
+# Runs an experiment for every point of a grid of arguments. Stages of the
+# experiment which are the same for several points (patches and PCA, initial
+# candidates, pairwise potentials of loopy) are computed once in the main
+# process and stored in an artifact cache in shared memory, from which
+# worker processes memory-map them. The rest of every point runs on a pool
+# of processes and its results are written to a single table.
+
+# Arguments which determine each shared stage. Points share a stage if they
+# agree on arguments of the stage and of all previous stages.
+STAGES = [
+    ("patches", ["input", "source", "style_model", "patch_size",
+                 "patch_overlap", "pca_k", "color", "random_seed"]),
+    ("candidates", ["resume", "num_candidates", "candidate_search",
+                    "candidate_block_size", "ivf_lists", "ivf_probes"]),
+    ("potentials", ["lbp_two_sigma2", "lbp_precision"]),
+]
+
+TRUE_VALUES = ("1", "true", "yes")
+
+
+def parse_sweep(sweep):
+    """
+    Parses "name=value1,value2,..." into a name and a list of values.
+    """
+    name, _, values = sweep.partition("=")
+    return name.lstrip("-"), values.split(",")
+
+
+def sweep_points(argparser, argv, grid):
+    """
+    Returns (overrides, args) for each point of the cartesian product of a
+    grid, a list of (argument name, list of values). Each args is parsed from
+    argv with the point's values appended, so they are converted and checked
+    as if given on the command line.
+    """
+    base_args, _ = argparser.parse_known_args(argv)
+    names = [name for name, _ in grid]
+    for name in names:
+        if not hasattr(base_args, name):
+            raise ValueError("Unknown argument of a sweep: {}".format(name))
+
+    points = []
+    for values in itertools.product(*[values for _, values in grid]):
+        overrides = list(zip(names, values))
+        point_argv = list(argv)
+        flags = []
+        for name, value in overrides:
+            if isinstance(getattr(base_args, name), bool):
+                flags.append((name, str(value).lower() in TRUE_VALUES))
+            else:
+                point_argv.append("-{}={}".format(name, value))
+        args, _ = argparser.parse_known_args(point_argv)
+        for name, value in flags:
+            setattr(args, name, value)
+        points.append((overrides, args))
+    return points
+
+
+def point_name(overrides):
+    return "_".join("{}={}".format(name, value) for name, value in overrides)
+
+
+def stage_key(args, stage):
+    """
+    Returns values of arguments determining the stage with given index.
+    """
+    return tuple(
+        (name, getattr(args, name))
+        for _, names in STAGES[:stage + 1] for name in names
+    )
+
+
+def potentials_key(cache, patches, args):
+    content = patches.cache_key
+    if content is None:
+        content = file_digest(args.style_model)
+    return cache.key(kind="sweep_potentials", content=content,
+                     stages=dict(stage_key(args, 2)))
+
+
+def prepare_shared_stages(points_args, cache, output):
+    """
+    Computes shared stages of points in the main process. Patches and
+    candidates are stored in the cache by set_up_experiment (once for each
+    distinct candidates stage), pairwise potentials are computed and stored
+    for each distinct potentials stage.
+    """
+    for stage, (stage_name, _) in enumerate(STAGES):
+        count = len(set(stage_key(args, stage) for args in points_args))
+        print("Stage {}: computed {} times for {} points.".format(
+            stage_name, count, len(points_args)))
+
+    groups = dict()
+    for args in points_args:
+        groups.setdefault(stage_key(args, 1), []).append(args)
+
+    for group in groups.values():
+        args = copy.copy(group[0])
+        args.output = os.path.join(output, "shared")
+        patches, em = set_up_experiment(args)
+        done = set()
+        for point_args in group:
+            key = stage_key(point_args, 2)
+            if point_args.lbp_debug_files or key in done:
+                continue
+            done.add(key)
+            em.lbp_params["two_sigma2"] = point_args.lbp_two_sigma2
+            em.lbp_params["precision"] = point_args.lbp_precision
+            cache.store(potentials_key(cache, patches, point_args),
+                        {"potentials": em.pairwise_potentials()})
+
+
+def run_experiment_point(args, run_point):
+    """
+    Sets up the experiment of a point from shared stages and runs it.
+    """
+    patches, em = set_up_experiment(args)
+    if not args.lbp_debug_files:
+        cache = ArtifactCache(args.cache_dir)
+        arrays = cache.load(potentials_key(cache, patches, args))
+        if arrays is not None:
+            em.use_pairwise_potentials(arrays["potentials"])
+    return run_point(args, patches, em)
+
+
+# Function running a point in worker processes, set by init_worker.
+_worker_run_point = None
+
+
+def init_worker(run_point):
+    global _worker_run_point
+    _worker_run_point = run_point
+
+
+def run_job(job):
+    """
+    Runs a point in its own output folder, printing into its log.txt.
+    Returns its index, status, seconds and a dict of results; failure of one
+    point does not stop the sweep.
+    """
+    index, args = job
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    start = time.time()
+    with open(os.path.join(args.output, "log.txt"), "w") as log, \
+            contextlib.redirect_stdout(log):
+        try:
+            results = run_experiment_point(args, _worker_run_point)
+            status = "ok"
+        except Exception:
+            traceback.print_exc(file=log)
+            results = dict()
+            status = "failed"
+    return index, status, time.time() - start, results
+
+
+def run_sweep(points, run_point, output, workers=1, cache_dir=None):
+    """
+    Runs run_point(args, patches, em) for each point returned by
+    sweep_points on a pool of worker processes (0 = all cores), after shared
+    stages are prepared. run_point returns a dict of results, which are
+    written with swept values to output/results.txt, one line per point.
+    Every point writes to its own output folder. Shared stages are stored
+    in cache_dir, by default in a temporary directory in shared memory
+    which is removed afterwards.
+    """
+    if not os.path.exists(output):
+        os.makedirs(output)
+
+    temporary_dir = None
+    if cache_dir is None:
+        shared_memory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        temporary_dir = tempfile.mkdtemp(prefix="sweep", dir=shared_memory)
+        cache_dir = temporary_dir
+
+    jobs = []
+    for index, (overrides, args) in enumerate(points):
+        args = copy.copy(args)
+        args.output = os.path.join(output, point_name(overrides) or "point")
+        args.cache_dir = cache_dir
+        if temporary_dir is not None:
+            args.cache_max_size = args.cache_max_age = None
+        jobs.append((index, args))
+
+    pool = None
+    try:
+        start = time.time()
+        prepare_shared_stages([args for _, args in jobs],
+                              ArtifactCache(cache_dir), output)
+        print("Shared stages prepared in {:.3f} s.".format(time.time() - start))
+
+        workers = min(workers or multiprocessing.cpu_count(), len(jobs)) or 1
+        start = time.time()
+        if workers == 1:
+            init_worker(run_point)
+            finished = map(run_job, jobs)
+        else:
+            pool = multiprocessing.Pool(
+                workers, initializer=init_worker, initargs=(run_point,))
+            finished = pool.imap_unordered(run_job, jobs)
+
+        rows = [None] * len(jobs)
+        for i, (index, status, seconds, results) in enumerate(finished, 1):
+            rows[index] = (status, seconds, results)
+            print("[{}/{}] {} {} {:.3f} s".format(
+                i, len(jobs), point_name(points[index][0]) or "point",
+                status, seconds))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
+        print("Swept {} points in {:.3f} s with {} workers.".format(
+            len(jobs), time.time() - start, workers))
+    finally:
+        # After an error, workers are stopped before removing the temporary
+        # cache they may still map arrays from.
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if temporary_dir is not None:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+    write_results(os.path.join(output, "results.txt"), points, rows)
+    return rows
+
+
+def write_results(path, points, rows):
+    """
+    Writes a table of swept values, status, seconds and results of points.
+    """
+    names = [name for name, _ in points[0][0]]
+    result_names = []
+    for _, _, results in rows:
+        result_names += [name for name in results if name not in result_names]
+
+    with open(path, "w") as f:
+        f.write(" ".join(names + ["status", "seconds"] + result_names) + "\n")
+        for (overrides, _), (status, seconds, results) in zip(points, rows):
+            values = [str(value) for _, value in overrides]
+            values += [status, "{:.3f}".format(seconds)]
+            values += [str(results.get(name, "-")) for name in result_names]
+            f.write(" ".join(values) + "\n")
+
+
+def run_em_point(args, patches, em):
+    """
+    Runs EM iterations, results are log a posterior probabilities and
+    statistics of the last loopy run.
+    """
+    log_posteriors = run_em(args, em)
+    results = {
+        "initial_log_posterior": "{:.6g}".format(log_posteriors[0]),
+        "final_log_posterior": "{:.6g}".format(log_posteriors[-1]),
+    }
+    if em.lbp_statistics is not None:
+        results["lbp_iterations"] = em.lbp_statistics["iterations"]
+        results["lbp_max_residual"] = "{:.3g}".format(
+            em.lbp_statistics["max_residual"])
+    return results
+
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser()
+    argparser.add_argument("-sweep", action="append", default=[],
+        help="Swept argument and its comma separated values, e.g. -sweep=lbp_two_sigma2=0.01,0.1,1. "
+             "Can be repeated, all combinations of values are run.")
+    argparser.add_argument("-workers", type=int, default=1,
+        help="Number of processes running points of the sweep (0 = all cores).")
+    args, _ = argparser.parse_known_args()
+
+    points = sweep_points(argparser, sys.argv[1:],
+                          [parse_sweep(sweep) for sweep in args.sweep])
+    run_sweep(points, run_em_point, args.output, workers=args.workers,
+              cache_dir=args.cache_dir)
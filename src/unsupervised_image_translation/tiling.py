@@ -0,0 +1,415 @@
+import collections
+import contextlib
+import multiprocessing
+import os
+import shutil
+import struct
+import time
+import zlib
+
+import numpy as np
+from scipy.misc import imread
+
+import artifact_cache
+import candidates
+import colors
+from em import EM
+from experiment import (prepare_argument_parser, prepare_style_model,
+                        write_arguments, create_lbp_params,
+                        create_style_model_search, create_metrics)
+from patches import Patches, plot_patch_vectors, vectors_to_pixel_values
+from style_model import StyleModel
+
+# Translates input images too large for EM over all patches at once. The
+# patch grid of the input image is split into tiles, each extended by a halo
+# of patches on every side, so that loopy belief propagation of a tile sees
+# neighbours of its border patches. EM and loopy run on one tile at a time
+# (or on several in parallel), with state of tiles kept on disk between
+# iterations. Transformations (lambdas) are global: their statistics are
+# summed over core patches of all tiles. The MAP image is stitched with the
+# same blending as plot_patch_vectors into a memory-mapped .npy file and
+# written to PNG in strips. Peak memory is bounded by the tile size; the
+# input image is memory-mapped as 8-bit pixels in a .npy file. An input image
+# in another format is loaded once in full to convert it.
+#
+# Iteration i of a tile recomputes psis of its patches from their posteriors
+# and lambdas of iteration i - 1 (finishing the M step of iteration i - 1),
+# computes posteriors again, runs loopy and the E step. With a single tile,
+# the result equals the result of EM over the whole image, except that
+# -lbp_warm_start has no effect. Shared parts of covariances (-covariance
+# shared or lowrank) are estimated for each tile separately.
+
+Tile = collections.namedtuple("Tile", [
+    "index",
+    # Rows and columns of core patches in the patch grid.
+    "row_start", "row_end", "col_start", "col_end",
+    # Rows and columns of core and halo patches in the patch grid.
+    "halo_row_start", "halo_row_end", "halo_col_start", "halo_col_end",
+])
+
+
+def split_grid(grid_size, tile_size, halo):
+    """
+    Splits a patch grid into tiles of at most tile_size x tile_size core
+    patches, with halos of halo patches.
+    """
+    rows, cols = grid_size
+    tiles = []
+    for row_start in range(0, rows, tile_size):
+        for col_start in range(0, cols, tile_size):
+            row_end = min(row_start + tile_size, rows)
+            col_end = min(col_start + tile_size, cols)
+            tiles.append(Tile(
+                len(tiles), row_start, row_end, col_start, col_end,
+                max(row_start - halo, 0), min(row_end + halo, rows),
+                max(col_start - halo, 0), min(col_end + halo, cols),
+            ))
+    return tiles
+
+
+def open_input_image(path, color, npy_path):
+    """
+    Returns the input image as 8-bit pixels (RGB if color is set) memory-
+    mapped from a .npy file. Other image files are loaded in full and
+    converted to npy_path first.
+    """
+    if not path.endswith(".npy"):
+        np.save(npy_path, imread(path, mode=("RGB" if color else "L")))
+        path = npy_path
+    return np.load(path, mmap_mode="r")
+
+
+def write_png(path, image, strip_rows=256):
+    """
+    Writes 8-bit pixels (grayscale or RGB, e.g. memory-mapped) to a PNG file
+    strip by strip, so at most strip_rows rows of the image are in memory.
+    """
+    height, width = image.shape[:2]
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    color_type = {1: 0, 3: 2}[channels]
+
+    def write_chunk(f, kind, data):
+        f.write(struct.pack(">I", len(data)))
+        f.write(kind)
+        f.write(data)
+        f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    compressor = zlib.compressobj()
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        write_chunk(f, b"IHDR", struct.pack(
+            ">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+        for start in range(0, height, strip_rows):
+            strip = np.asarray(image[start:(start + strip_rows)],
+                               dtype=np.uint8).reshape([-1, width * channels])
+            # Every row starts with its filter type, 0 is none.
+            rows = np.hstack([np.zeros([len(strip), 1], dtype=np.uint8), strip])
+            data = compressor.compress(rows.tobytes())
+            if data:
+                write_chunk(f, b"IDAT", data)
+        write_chunk(f, b"IDAT", compressor.flush())
+        write_chunk(f, b"IEND", b"")
+
+
+def to_color_space(pixels, color_space):
+    """
+    Converts 8-bit pixels to the luminance / chrominance color space used by
+    patches (luminance in [0, 1] for grayscale).
+    """
+    image = pixels / 255
+    if color_space is None:
+        return image
+    return color_space.from_rgb(image, out=image)
+
+
+class TiledTranslation:
+    """
+    State of a tiled translation shared by all tiles: arguments, the style
+    model, the input image and files of the output folder.
+    """
+    def __init__(self, args, input_image_path):
+        self.args = args
+        self.style_model = StyleModel(args.style_model)
+        self.candidate_search = create_style_model_search(
+            args, self.style_model)
+        self.color_space = (None if args.color == "gray"
+                            else colors.color_spaces[args.color])
+        self.input_image = np.load(input_image_path, mmap_mode="r")
+        self.step = args.patch_size - args.patch_overlap
+        self.tiles_dir = os.path.join(args.output, "tiles")
+        self.map_path = os.path.join(args.output, "map_indices.npy")
+        self.image_path = os.path.join(args.output, "MAP.npy")
+
+    def pixel_range(self, start, end):
+        """
+        Returns the range of pixels covered by patches from start to end in
+        a row or column of the patch grid.
+        """
+        return start * self.step, (end - 1) * self.step + self.args.patch_size
+
+    def tile_patches(self, tile):
+        rows = self.pixel_range(tile.halo_row_start, tile.halo_row_end)
+        cols = self.pixel_range(tile.halo_col_start, tile.halo_col_end)
+        args = self.args
+        return Patches(
+            input_path=None,
+            source_path=None,
+            patch_size=args.patch_size,
+            patch_overlap=args.patch_overlap,
+            pca_k=args.pca_k,
+            color=(None if args.color == "gray" else args.color),
+            style_model=self.style_model,
+            input_image=to_color_space(
+                self.input_image[rows[0]:rows[1], cols[0]:cols[1]],
+                self.color_space),
+        )
+
+    def core_indices(self, tile):
+        """
+        Returns indices of core patches of a tile among its patches.
+        """
+        width = tile.halo_col_end - tile.halo_col_start
+        rows = np.arange(tile.row_start, tile.row_end) - tile.halo_row_start
+        cols = np.arange(tile.col_start, tile.col_end) - tile.halo_col_start
+        return (rows[:, np.newaxis] * width + cols[np.newaxis, :]).ravel()
+
+    def state_path(self, tile):
+        return os.path.join(self.tiles_dir, "{}{}".format(
+            tile.index, artifact_cache.EXTENSION))
+
+    def tile_em(self, tile, patches, lambdas):
+        """
+        Creates EM of a tile with given lambdas, restoring its candidates,
+        posteriors and loopy posteriors from the previous iteration if they
+        were stored. Returns the EM and whether it was restored.
+        """
+        args = self.args
+        state = {"lambdas": lambdas}
+        restored = os.path.exists(self.state_path(tile))
+        if restored:
+            arrays = artifact_cache.read_arrays(self.state_path(tile))
+            candidate_search = candidates.PrecomputedSearch(
+                np.array(arrays["candidate_indices"]),
+                np.array(arrays["candidate_distances"]))
+            state["probs"] = arrays["probs"]
+            state["loopy_probs"] = arrays["loopy_probs"]
+        else:
+            candidate_search = self.candidate_search
+
+        lbp_params = create_lbp_params(args)
+        lbp_params["output_dir"] = os.path.join(
+            self.tiles_dir, str(tile.index))
+        if args.lbp_debug_files and not os.path.exists(lbp_params["output_dir"]):
+            os.makedirs(lbp_params["output_dir"])
+
+        np.random.seed(args.random_seed + tile.index)
+        em = EM(
+            patches=patches,
+            num_candidates=args.num_candidates,
+            num_transformations=args.num_transformations,
+            lbp_params=lbp_params,
+            lambdas_init_type=args.init_transformations,
+            chunk_size=args.em_chunk_size,
+            candidate_search=candidate_search,
+            state=state,
+            covariance=args.covariance,
+            covariance_rank=args.covariance_rank,
+            metrics=create_metrics(args, tile=tile.index),
+        )
+        return em, restored
+
+    def run_tile(self, tile, lambdas, final=False):
+        """
+        Runs an iteration of EM on a tile and stores its state. Returns sums
+        of lambda statistics (see EM.lambda_statistics) and log a posterior
+        probability of core patches. With final=True, only posteriors are
+        updated and MAP dictionary patches of core patches are stored.
+        """
+        with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+            patches = self.tile_patches(tile)
+            em, restored = self.tile_em(tile, patches, lambdas)
+            if restored:
+                em.compute_posteriors()
+            if not final:
+                em.loopy()
+                em.compute_posteriors()
+
+        core = self.core_indices(tile)
+        log_posterior = np.sum(np.log(np.max(em.probs[core], axis=(1, 2))))
+        if final:
+            map_indices = np.load(self.map_path, mmap_mode="r+")
+            map_indices[tile.row_start:tile.row_end,
+                        tile.col_start:tile.col_end] = \
+                em.find_most_probable_patches_from_k(
+                    np.max(em.probs, axis=-1))[core].reshape(
+                        [tile.row_end - tile.row_start,
+                         tile.col_end - tile.col_start])
+            map_indices.flush()
+            return None, None, log_posterior
+
+        artifact_cache.write_arrays(self.state_path(tile), {
+            "candidate_indices": em.candidate_indices,
+            "candidate_distances": em.candidate_distances,
+            "probs": em.probs,
+            "loopy_probs": em.loopy_probs,
+        })
+        numerator, denominator = em.lambda_statistics(core)
+        return numerator, denominator, log_posterior
+
+    def render_tile(self, tile):
+        """
+        Writes pixels of core patches of a tile into the MAP image. Patches
+        are blended together with patches of preceding rows and columns
+        overlapping them, so pixels equal those of the whole image blended
+        by plot_patch_vectors.
+        """
+        args = self.args
+        patch_size, overlap = args.patch_size, args.patch_overlap
+        rows, cols = np.load(self.map_path, mmap_mode="r").shape
+        ring = max(-(-patch_size // self.step) - 1, 0)
+        row_start = max(tile.row_start - ring, 0)
+        col_start = max(tile.col_start - ring, 0)
+
+        map_indices = np.load(self.map_path, mmap_mode="r")[
+            row_start:tile.row_end, col_start:tile.col_end]
+        blended = plot_patch_vectors(
+            self.style_model.dictionary_vectors[map_indices.ravel()],
+            map_indices.shape, overlap)
+
+        # Pixels of core patches up to the next row and column of patches.
+        top, left = tile.row_start * self.step, tile.col_start * self.step
+        bottom = tile.row_end * self.step + (
+            overlap if tile.row_end == rows else 0)
+        right = tile.col_end * self.step + (
+            overlap if tile.col_end == cols else 0)
+        image = blended[(top - row_start * self.step):
+                        (bottom - row_start * self.step),
+                        (left - col_start * self.step):
+                        (right - col_start * self.step)]
+
+        if self.color_space is not None:
+            color_image = to_color_space(
+                self.input_image[top:bottom, left:right], self.color_space)
+            color_image[:, :, 0] = image
+            image = self.color_space.to_rgb(color_image, out=color_image)
+
+        output = np.load(self.image_path, mmap_mode="r+")
+        output[top:bottom, left:right] = vectors_to_pixel_values(image)
+        output.flush()
+
+
+# Tiled translation of a worker process, set by init_worker.
+_worker_translation = None
+
+
+def init_worker(args, input_image_path):
+    global _worker_translation
+    _worker_translation = TiledTranslation(args, input_image_path)
+
+
+def run_tile_job(job):
+    tile, lambdas, final = job
+    return _worker_translation.run_tile(tile, lambdas, final)
+
+
+def render_tile_job(tile):
+    return _worker_translation.render_tile(tile)
+
+
+def translate_tiled(args):
+    """
+    Translates args.input tile by tile into args.output: MAP.npy and MAP.png
+    with the MAP image, map_indices.npy with indices of MAP dictionary
+    patches. Returns log a posterior probabilities after each iteration.
+    """
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    prepare_style_model(args)
+    write_arguments(args)
+
+    input_image = open_input_image(
+        args.input, args.color != "gray",
+        os.path.join(args.output, "input.npy"))
+    input_image_path = input_image.filename
+    step = args.patch_size - args.patch_overlap
+    height, width = input_image.shape[:2]
+    grid_size = [(height - args.patch_overlap) // step,
+                 (width - args.patch_overlap) // step]
+    tiles = split_grid(grid_size, args.tile_size, args.tile_halo)
+    print("Input image split to grid :", grid_size)
+    print("Tiles                     :", len(tiles))
+
+    translation = TiledTranslation(args, input_image_path)
+    if os.path.exists(translation.tiles_dir):
+        shutil.rmtree(translation.tiles_dir)
+    os.makedirs(translation.tiles_dir)
+    np.lib.format.open_memmap(translation.map_path, mode="w+",
+                              dtype=np.int32, shape=tuple(grid_size))
+    output_shape = [grid_size[0] * step + args.patch_overlap,
+                    grid_size[1] * step + args.patch_overlap]
+    if args.color != "gray":
+        output_shape.append(3)
+    np.lib.format.open_memmap(translation.image_path, mode="w+",
+                              dtype=np.uint8, shape=tuple(output_shape))
+
+    np.random.seed(args.random_seed)
+    lambdas = np.array([
+        EM.lambdas_init_dict[args.init_transformations](args.pca_k)
+        for _ in range(args.num_transformations)
+    ])
+
+    workers = min(args.workers or multiprocessing.cpu_count(), len(tiles))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                    initargs=(args, input_image_path))
+        map_tiles = pool.map
+    else:
+        init_worker(args, input_image_path)
+        map_tiles = lambda function, jobs: list(map(function, jobs))
+
+    log_posteriors = []
+    for i in range(1, args.em_iterations + 2):
+        final = i > args.em_iterations
+        start = time.time()
+        results = map_tiles(run_tile_job,
+                            [(tile, lambdas, final) for tile in tiles])
+        log_posteriors.append(sum(result[2] for result in results))
+        if not final:
+            numerator = sum(result[0] for result in results)
+            denominator = sum(result[1] for result in results)
+            lambdas = np.matmul(numerator, np.linalg.inv(denominator))
+            print("EM iteration {}: {:.3f} s, log a posterior of E step: {}"
+                  .format(i, time.time() - start, log_posteriors[-1]))
+
+    start = time.time()
+    map_tiles(render_tile_job, tiles)
+    if workers > 1:
+        pool.close()
+        pool.join()
+    print("Log a posterior", log_posteriors[-1])
+    print("Rendered in {:.3f} s".format(time.time() - start))
+
+    write_png(os.path.join(args.output, "MAP.png"),
+              np.load(translation.image_path, mmap_mode="r"))
+    shutil.rmtree(translation.tiles_dir)
+    return log_posteriors
+
+
+if __name__ == "__main__":
+    argparser = prepare_argument_parser()
+    argparser.description = (
+        "Tiled translation of very large images. Memory is bounded by -tile_size, except that "
+        "an -input other than a .npy file of 8-bit pixels is loaded once in full to convert it.")
+    argparser.add_argument("-tile_size", type=int, default=64,
+        help="Number of patches in a row and a column of a tile (without halo), bounds memory.")
+    argparser.add_argument("-tile_halo", type=int, default=4,
+        help="Number of patches added to each side of a tile as a context for loopy.")
+    argparser.add_argument("-workers", type=int, default=1,
+        help="Number of processes running tiles in parallel (0 = all cores).")
+    args, _ = argparser.parse_known_args()
+    if args.resume is not None:
+        argparser.error("tiled translation can't resume from a checkpoint of EM.")
+    if args.prune != "none":
+        argparser.error("tiled translation can't prune candidates, -prune can't be used.")
+
+    translate_tiled(args)
@@ -1,24 +1,43 @@
-import colorsys
 import resource
+import sys
+import time
 
 import numpy as np
 from scipy.misc import imread
 
-_utime = 0
-_stime = 0
+import colors
 
-def start_stopwatch():
-    info = resource.getrusage(resource.RUSAGE_SELF)
-    global _utime, _stime
-    _utime = info.ru_utime
-    _stime = info.ru_stime
+class Stopwatch:
+    """
+    Measures wall time and CPU time (user and system) of this process since
+    it was created or restarted.
+    """
+    def __init__(self):
+        self.restart()
+
+    def restart(self):
+        self.wall = time.perf_counter()
+        self.usage = resource.getrusage(resource.RUSAGE_SELF)
 
+    def elapsed(self):
+        """
+        Returns a dict of wall_seconds, user_seconds and system_seconds.
+        """
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            "wall_seconds": time.perf_counter() - self.wall,
+            "user_seconds": usage.ru_utime - self.usage.ru_utime,
+            "system_seconds": usage.ru_stime - self.usage.ru_stime,
+        }
 
-def stop_stopwatch(label):
-    info = resource.getrusage(resource.RUSAGE_SELF)
-    user = info.ru_utime - _utime
-    system = info.ru_stime - _stime
-    print('{} user: {:.3f}, system: {:.3f}'.format(label, user, system))
+
+def peak_rss_mb():
+    """
+    Returns peak resident set size of this process so far in megabytes.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
 
 
 def load_image(path):
@@ -39,15 +58,11 @@ def rgb2yiq(image):
     """
     Converts image from RGB colorscheme to YIQ.
     """
-    return np.array(
-        [colorsys.rgb_to_yiq(*pixel) for pixel in image.reshape([-1, 3])]
-    ).reshape(image.shape)
+    return colors.yiq.from_rgb(image)
 
 
 def yiq2rgb(image):
     """
     Converts image from YIQ colorscheme to RGB.
     """
-    return np.array(
-        [colorsys.yiq_to_rgb(*pixel) for pixel in image.reshape([-1, 3])]
-    ).reshape(image.shape)
+    return colors.yiq.to_rgb(image)
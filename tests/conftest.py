@@ -0,0 +1,5 @@
+import os
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.join(PROJECT_DIR, "src", "unsupervised_image_translation"))
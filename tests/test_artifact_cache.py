@@ -0,0 +1,124 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+import artifact_cache
+from artifact_cache import ArtifactCache
+
+
+def test_arrays_round_trip(tmp_path):
+    arrays = {
+        "floats": np.random.RandomState(0).rand(3, 4),
+        "ints": np.arange(10, dtype=np.int32),
+        "bytes": np.frombuffer(b"pickled", np.uint8),
+        "scalar": np.array(2.5),
+        "empty": np.empty([0, 3]),
+        "strided": np.arange(20.0).reshape([4, 5])[:, ::2],
+    }
+    path = str(tmp_path / ("entry" + artifact_cache.EXTENSION))
+    artifact_cache.write_arrays(path, arrays)
+    loaded = artifact_cache.read_arrays(path)
+
+    assert set(loaded) == set(arrays)
+    for name, array in arrays.items():
+        assert loaded[name].dtype == array.dtype
+        assert np.array_equal(loaded[name], array)
+    assert not loaded["floats"].flags.writeable
+
+
+def test_object_arrays_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        artifact_cache.write_arrays(str(tmp_path / "entry"),
+                                    {"objects": np.array([None, 1])})
+
+
+def test_key_depends_on_fields_not_their_order(tmp_path):
+    cache = ArtifactCache(str(tmp_path))
+    assert cache.key(a=1, b="x") == cache.key(b="x", a=1)
+    assert cache.key(a=1, b="x") != cache.key(a=2, b="x")
+
+
+def test_store_and_load(tmp_path):
+    cache = ArtifactCache(str(tmp_path))
+    key = cache.key(kind="test")
+    assert cache.load(key) is None
+    cache.store(key, {"values": np.arange(5)})
+    assert np.array_equal(cache.load(key)["values"], np.arange(5))
+
+
+def test_corrupt_entry_is_a_miss_and_removed(tmp_path):
+    cache = ArtifactCache(str(tmp_path))
+    key = cache.key(kind="test")
+    cache.store(key, {"values": np.arange(1000)})
+    with open(cache.path(key), "r+b") as f:
+        f.truncate(100)
+    assert cache.load(key) is None
+    assert not os.path.exists(cache.path(key))
+
+
+def store_entries(cache, count, size):
+    keys = [cache.key(index=i) for i in range(count)]
+    now = time.time()
+    for i, key in enumerate(keys):
+        cache.store(key, {"values": np.zeros(size, dtype=np.uint8)})
+        # Entries are used one after another, an hour apart.
+        os.utime(cache.path(key), (now - 3600 * (count - i),) * 2)
+    return keys
+
+
+def test_least_recently_used_entries_are_evicted_above_max_bytes(tmp_path):
+    entry_bytes = 4096
+    cache = ArtifactCache(str(tmp_path))
+    keys = store_entries(cache, 3, entry_bytes)
+    # Using the oldest entry makes the second one least recently used.
+    cache.load(keys[0])
+
+    cache.max_bytes = 3.5 * os.path.getsize(cache.path(keys[0]))
+    cache.store(cache.key(index=3), {"values": np.zeros(entry_bytes, np.uint8)})
+    assert cache.load(keys[1]) is None
+    for key in [keys[0], keys[2], cache.key(index=3)]:
+        assert cache.load(key) is not None
+
+
+def test_entries_older_than_max_age_are_evicted(tmp_path):
+    cache = ArtifactCache(str(tmp_path))
+    keys = store_entries(cache, 3, 16)
+    cache.max_age = 1.5 * 3600
+    cache.evict()
+    assert [cache.load(key) is not None for key in keys] == [False, False, True]
+
+
+def test_patches_from_cache_equal_computed_ones(tmp_path):
+    pytest.importorskip("loopy")
+    from PIL import Image
+    import patches
+
+    rng = np.random.RandomState(0)
+    paths = []
+    # A source of over 500 patches makes PCA use its randomized solver.
+    for name, size in [("input.png", 40), ("source.png", 150)]:
+        paths.append(str(tmp_path / name))
+        Image.fromarray(rng.randint(0, 256, [size, size, 3]).astype(
+            np.uint8)).save(paths[-1])
+
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    results = []
+    for use_cache in [False, True, True]:
+        np.random.seed(0)
+        computed = patches.Patches(
+            paths[0], paths[1], patch_size=8, patch_overlap=2, pca_k=10,
+            color="yiq", cache=(cache if use_cache else None))
+        # Draws after patches (e.g. initialization of EM) do not depend on
+        # whether they come from the cache.
+        results.append((computed, np.random.rand(3)))
+
+    first, draws = results[0]
+    for computed, other_draws in results[1:]:
+        assert np.array_equal(other_draws, draws)
+        for name in patches.Patches.cached_arrays:
+            assert np.array_equal(getattr(computed, name), getattr(first, name))
+        # PCA restored from its arrays projects as the fitted one.
+        assert np.array_equal(computed.pca.transform(first.observed_vectors),
+                              first.compact_observed_vectors)
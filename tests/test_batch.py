@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+pytest.importorskip("loopy")
+from batch import list_inputs
+
+
+def touch(path):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, "w").close()
+
+
+def test_directory_lists_images_in_order(tmp_path):
+    for filename in ["b.png", "a.JPG", "notes.txt", "c.tiff"]:
+        touch(str(tmp_path / filename))
+    assert list_inputs(str(tmp_path)) == [
+        ("a", str(tmp_path / "a.JPG")),
+        ("b", str(tmp_path / "b.png")),
+        ("c", str(tmp_path / "c.tiff")),
+    ]
+
+
+def test_manifest_names_are_unique(tmp_path):
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("\n".join([
+        "# frames", "one/a.png", "", "two/a.png", "a.jpg", "a_1.png",
+    ]))
+    names = [name for name, _ in list_inputs(str(manifest))]
+    assert names == ["a", "a_1", "a_2", "a_1_1"]
+    assert len(set(names)) == len(names)
+
+
+def test_manifest_paths_are_relative_to_it(tmp_path):
+    manifest = tmp_path / "lists" / "manifest.txt"
+    touch(str(manifest))
+    manifest.write_text("../images/x.png\n")
+    assert list_inputs(str(manifest)) == [
+        ("x", os.path.join(str(tmp_path / "lists"), "../images/x.png")),
+    ]
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+import candidates
+
+
+def brute_force(observed_vectors, dictionary_vectors, k):
+    distances = np.sum((observed_vectors[:, np.newaxis] -
+                        dictionary_vectors[np.newaxis]) ** 2, axis=-1)
+    indices = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    rows = np.arange(len(observed_vectors))[:, np.newaxis]
+    return indices, distances[rows, indices]
+
+
+def random_vectors(observed, dictionary, dimension=5, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randn(observed, dimension), rng.randn(dictionary, dimension)
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 64, 1024])
+@pytest.mark.parametrize("k", [1, 5, 16])
+def test_nearest_candidates_equal_brute_force(block_size, k):
+    observed_vectors, dictionary_vectors = random_vectors(50, 40)
+    indices, distances = candidates.nearest_candidates(
+        observed_vectors, dictionary_vectors, k, block_size=block_size)
+    exact_indices, exact_distances = brute_force(
+        observed_vectors, dictionary_vectors, k)
+
+    assert indices.shape == distances.shape == (50, k)
+    # Ordered from the farthest to the nearest.
+    assert np.all(np.diff(distances, axis=1) <= 0)
+    np.testing.assert_allclose(distances[:, ::-1], exact_distances, atol=1e-9)
+    assert np.array_equal(np.sort(indices, axis=1),
+                          np.sort(exact_indices, axis=1))
+
+
+def test_nearest_candidates_with_k_above_dictionary_size():
+    observed_vectors, dictionary_vectors = random_vectors(3, 4)
+    indices, distances = candidates.nearest_candidates(
+        observed_vectors, dictionary_vectors, 10)
+    assert indices.shape == (3, 4)
+    assert np.array_equal(np.sort(indices, axis=1), np.tile(np.arange(4), [3, 1]))
+
+
+def test_merge_nearest_keeps_k_nearest():
+    indices = np.array([[0, 1, 2]])
+    distances = np.array([[5.0, 1.0, 3.0]])
+    merged_indices, merged_distances = candidates.merge_nearest(
+        indices, distances, np.array([[3, 4]]), np.array([[2.0, 4.0]]), 3)
+    assert sorted(merged_indices[0]) == [1, 2, 3]
+    assert sorted(merged_distances[0]) == [1.0, 2.0, 3.0]
+
+
+@pytest.mark.parametrize("search", [
+    candidates.ExactSearch(block_size=8),
+    candidates.KDTreeSearch(leaf_size=4),
+    # Probing all lists makes the inverted file exact.
+    candidates.IVFSearch(lists=6, probes=6),
+])
+def test_exact_backends_equal_brute_force(search):
+    observed_vectors, dictionary_vectors = random_vectors(30, 60)
+    indices, distances = search.fit(dictionary_vectors).search(
+        observed_vectors, 8)
+    exact_indices, exact_distances = brute_force(
+        observed_vectors, dictionary_vectors, 8)
+    np.testing.assert_allclose(distances[:, ::-1], exact_distances, atol=1e-9)
+    assert candidates.recall_at_k(indices, exact_indices) == 1
+
+
+def test_ivf_search_completes_patches_with_few_probed_vectors():
+    observed_vectors, dictionary_vectors = random_vectors(30, 60)
+    search = candidates.IVFSearch(lists=20, probes=1).fit(dictionary_vectors)
+    indices, distances = search.search(observed_vectors, 16)
+    assert np.all(indices >= 0) and np.all(np.isfinite(distances))
+    assert all(len(set(row)) == 16 for row in indices)
+
+
+def test_recall_at_k():
+    exact_indices = np.array([[0, 1, 2, 3], [4, 5, 6, 7]])
+    indices = np.array([[3, 2, 9, 8], [7, 6, 5, 4]])
+    assert candidates.recall_at_k(indices, exact_indices) == 0.75
+
+
+def test_keep_above_threshold():
+    probabilities = np.array([[0.5, 0.3, 0.2], [0.1, 0.1, 0.8]])
+    assert np.array_equal(candidates.keep_above_threshold(probabilities, 0.3),
+                          [[True, True, False], [False, False, True]])
+
+
+def test_keep_mass_keeps_the_smallest_most_probable_set():
+    probabilities = np.array([[0.2, 0.5, 0.3], [0.1, 0.1, 0.8], [1, 1, 2]])
+    assert np.array_equal(candidates.keep_mass(probabilities, 0.75),
+                          [[False, True, True], [False, False, True],
+                           [True, False, True]])
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("loopy")
+from PIL import Image
+
+from experiment import prepare_argument_parser, set_up_experiment, run_em
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.RandomState(0)
+    paths = []
+    for name, size in [("input.png", 40), ("source.png", 60)]:
+        paths.append(str(tmp_path / name))
+        Image.fromarray(rng.randint(0, 256, [size, size, 3]).astype(
+            np.uint8)).save(paths[-1])
+    return paths
+
+
+def translate(images, output, *argv):
+    args = prepare_argument_parser().parse_args([
+        "-input=" + images[0], "-source=" + images[1], "-output=" + output,
+        "-patch_size=8", "-patch_overlap=2", "-pca_k=10",
+        "-num_candidates=6", "-init_transformations=rand",
+    ] + list(argv))
+    _, em = set_up_experiment(args)
+    return run_em(args, em), em
+
+
+@pytest.mark.parametrize("options", [
+    [],
+    ["-lbp_warm_start", "-lbp_precision=log"],
+    ["-covariance=lowrank", "-lbp_schedule=checkerboard"],
+    ["-prune=mass", "-prune_mass=0.9", "-prune_after=1"],
+])
+def test_resumed_run_equals_uninterrupted_run(images, tmp_path, options):
+    uninterrupted, em = translate(
+        images, str(tmp_path / "uninterrupted"), "-em_iterations=4", *options)
+    translate(images, str(tmp_path / "first"), "-em_iterations=2",
+              "-checkpoint_every=2", *options)
+    resumed, resumed_em = translate(
+        images, str(tmp_path / "resumed"), "-em_iterations=4",
+        "-resume=" + str(tmp_path / "first"), *options)
+
+    # Log a posterior after iteration 2, 3 and 4.
+    assert resumed == uninterrupted[2:]
+    assert np.array_equal(resumed_em.probs, em.probs)
+    assert np.array_equal(resumed_em.lambdas, em.lambdas)
+    assert np.array_equal(resumed_em.MAP_image(), em.MAP_image())
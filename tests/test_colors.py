@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+import colors
+
+
+def test_color_space_without_conversions_cannot_be_created():
+    with pytest.raises(TypeError):
+        colors.ColorSpace()
+
+
+@pytest.mark.parametrize("name", sorted(colors.color_spaces))
+def test_conversions_round_trip_in_chunks(name):
+    color_space = colors.color_spaces[name]
+    image = np.random.RandomState(0).rand(7, 5, 3)
+    converted = color_space.from_rgb(image)
+    # Chunks of 4 pixels do not divide 35 pixels.
+    assert np.array_equal(color_space.from_rgb(image, chunk_size=4), converted)
+    assert 0 <= converted[:, :, 0].min() and converted[:, :, 0].max() <= 1
+    np.testing.assert_allclose(color_space.to_rgb(converted), image, atol=1e-9)
+
+    in_place = image.copy()
+    color_space.from_rgb(in_place, out=in_place)
+    assert np.array_equal(in_place, converted)
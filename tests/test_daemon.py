@@ -0,0 +1,107 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip("loopy")
+from PIL import Image
+
+from daemon import (LRUCache, Translator, argument_list, object_bytes,
+                    serve_stream)
+
+
+def test_least_recently_used_values_are_evicted():
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", 1, 4)
+    cache.put("b", 2, 4)
+    assert cache.get("a") == 1
+    cache.put("c", 3, 4)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.statistics() == {
+        "entries": 2, "bytes": 8, "max_bytes": 10,
+        "hits": 3, "misses": 1, "evictions": 1,
+    }
+
+
+def test_replaced_and_too_large_values():
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", 1, 4)
+    cache.put("a", 2, 6)
+    assert cache.get("a") == 2 and cache.bytes == 6
+    cache.put("a", 3, 11)
+    assert cache.get("a") is None and cache.bytes == 0
+
+
+def test_object_bytes_counts_nested_arrays():
+    class Holder:
+        def __init__(self):
+            self.array = np.zeros(10)
+            self.items = [np.zeros(5, dtype=np.uint8), {"x": np.zeros(2)}]
+    assert object_bytes(Holder()) == 80 + 5 + 16
+
+
+def test_argument_list():
+    assert argument_list(["-input=a.png", 3]) == ["-input=a.png", "3"]
+    assert argument_list({"input": "a.png", "lbp_warm_start": True,
+                          "metrics": False, "resume": None}) == [
+        "-input=a.png", "-lbp_warm_start"]
+
+
+def serve_lines(translator, lines):
+    """
+    Returns whether the translator keeps running after lines of requests
+    and the events it wrote.
+    """
+    out = io.StringIO()
+    running = serve_stream(translator, lines, out)
+    return running, [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_requests_and_errors_are_answered_in_order(tmp_path):
+    running, events = serve_lines(Translator(str(tmp_path), 2 ** 20), [
+        '{"id": 1, "command": "stats"}',
+        "not json",
+        '{"id": 2, "command": "no_such_command"}',
+        '{"id": 3, "args": ["-no_input"]}',
+        '{"id": 4, "command": "shutdown"}',
+        '{"id": 5, "command": "stats"}',
+    ])
+    assert not running
+    assert [(event["id"], event["event"]) for event in events] == [
+        (1, "stats"), (None, "error"), (2, "error"), (3, "error"),
+        (4, "shutdown")]
+
+
+def test_cached_job_equals_the_first_one(tmp_path):
+    rng = np.random.RandomState(0)
+    paths = []
+    for name, size in [("input.png", 40), ("source.png", 60)]:
+        paths.append(str(tmp_path / name))
+        Image.fromarray(rng.randint(0, 256, [size, size, 3]).astype(
+            np.uint8)).save(paths[-1])
+    arguments = {
+        "input": paths[0], "source": paths[1], "patch_size": 8,
+        "patch_overlap": 2, "pca_k": 10, "num_candidates": 6,
+        "em_iterations": 2,
+    }
+    requests = [
+        {"id": i, "args": dict(arguments, output=str(tmp_path / str(i)))}
+        for i in range(2)
+    ]
+    (tmp_path / "models").mkdir()
+    running, events = serve_lines(
+        Translator(str(tmp_path / "models"), 2 ** 26),
+        [json.dumps(request) for request in requests])
+
+    assert running
+    set_up = [event for event in events if event["event"] == "set_up"]
+    done = [event for event in events if event["event"] == "done"]
+    assert [event["cache_hits"] for event in set_up] == [
+        {"style": False, "candidates": False, "potentials": False},
+        {"style": True, "candidates": True, "potentials": True},
+    ]
+    assert done[0]["log_posteriors"] == done[1]["log_posteriors"]
+    assert [event["iteration"] for event in events
+            if event["event"] == "iteration"] == [1, 2, 1, 2]
@@ -0,0 +1,213 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("loopy")
+from PIL import Image
+from scipy.stats import multivariate_normal
+
+import candidates
+import likelihood
+from em import EM
+from experiment import (prepare_argument_parser, create_patches, create_em,
+                        create_candidate_search)
+
+# The vectorized E and M steps are compared with loops over patches,
+# candidates and transformations computing the original formulas.
+
+
+def considered_candidates(em, p):
+    if em.candidate_counts is None:
+        return range(em.num_candidates)
+    return range(em.candidate_counts[p])
+
+
+def transformed_candidates(em, p):
+    """
+    Yields t, l and the difference of patch p from candidate t transformed
+    by lambdas[l].
+    """
+    observed = em.patches.compact_observed_vectors[p]
+    for t in considered_candidates(em, p):
+        candidate = em.patches.compact_dictionary_vectors[
+            em.candidate_indices[p, t]]
+        for l in range(em.num_transformations):
+            yield t, l, observed - np.matmul(em.lambdas[l], candidate)
+
+
+def reference_posteriors(em):
+    marginals_for_lambdas = np.sum(em.probs, axis=1)
+    log_probs = np.full(em.probs.shape, -np.inf)
+    for p in range(em.patches.patch_count):
+        invpsi = np.linalg.pinv(em.psis[0][p])
+        for t, l, diff in transformed_candidates(em, p):
+            log_probs[p, t, l] = (
+                np.log(em.loopy_probs[p, t]) +
+                np.log(marginals_for_lambdas[p, l]) -
+                0.5 * np.dot(np.dot(diff, invpsi), diff)
+            )
+    maxima = np.max(log_probs, axis=(1, 2), keepdims=True)
+    probs = np.exp(log_probs - maxima)
+    return probs / np.sum(probs, axis=(1, 2), keepdims=True)
+
+
+def reference_maximized_term(em):
+    result = 0
+    for p in range(em.patches.patch_count):
+        for t, l, diff in transformed_candidates(em, p):
+            result += em.probs[p, t, l] * multivariate_normal.logpdf(
+                diff, cov=em.psis[0][p], allow_singular=True)
+    return result
+
+
+def reference_lambdas(em):
+    pca_k = em.patches.pca_k
+    lambdas = np.zeros(em.lambdas.shape)
+    lambda_denominator = np.zeros([pca_k, pca_k])
+    for p in range(em.patches.patch_count):
+        observed = em.patches.compact_observed_vectors[p]
+        for t in considered_candidates(em, p):
+            candidate = em.patches.compact_dictionary_vectors[
+                em.candidate_indices[p, t]]
+            for l in range(em.num_transformations):
+                lambdas[l] += em.probs[p, t, l] * np.outer(observed, candidate)
+                lambda_denominator += (em.probs[p, t, l] *
+                                       np.outer(candidate, candidate))
+    return np.matmul(lambdas, np.linalg.inv(lambda_denominator))
+
+
+def reference_psis(em):
+    pca_k = em.patches.pca_k
+    psis = np.zeros([em.patches.patch_count, pca_k, pca_k])
+    for p in range(em.patches.patch_count):
+        for t, l, diff in transformed_candidates(em, p):
+            psis[p] += em.probs[p, t, l] * np.outer(diff, diff)
+    return psis / np.sum(em.probs, axis=(1, 2))[:, np.newaxis, np.newaxis]
+
+
+@pytest.fixture(params=[False, True], ids=["all", "pruned"])
+def em(request, tmp_path):
+    rng = np.random.RandomState(0)
+    paths = []
+    for name, size in [("input.png", 40), ("source.png", 60)]:
+        paths.append(str(tmp_path / name))
+        Image.fromarray(rng.randint(0, 256, [size, size, 3]).astype(
+            np.uint8)).save(paths[-1])
+    args = prepare_argument_parser().parse_args([
+        "-input=" + paths[0], "-source=" + paths[1],
+        "-output=" + str(tmp_path), "-patch_size=8", "-patch_overlap=2",
+        "-pca_k=10", "-num_candidates=6",
+    ])
+    np.random.seed(0)
+    em = create_em(args, create_patches(args), create_candidate_search(args))
+    # Psis of EM's initialization are better conditioned than those after
+    # an iteration, only loopy and posteriors run.
+    em.loopy()
+    em.compute_posteriors()
+    if request.param:
+        em.pruning = {"rule": "mass", "parameter": 0.9, "after": 0}
+        assert em.prune_candidates()
+        assert len(np.unique(em.candidate_counts)) > 1
+    return em
+
+
+# One patch per chunk, 36 patches in chunks of 5 and all in one chunk.
+CHUNK_SIZES = [1, 5, 100]
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_posteriors_equal_reference(em, chunk_size):
+    expected = reference_posteriors(em)
+    em.chunk_size = chunk_size
+    em.compute_posteriors()
+    np.testing.assert_allclose(em.probs, expected, rtol=1e-7, atol=1e-12)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_maximized_term_equals_reference(em, chunk_size):
+    em.chunk_size = chunk_size
+    np.testing.assert_allclose(em.compute_maximized_term(),
+                               reference_maximized_term(em), rtol=1e-7)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_lambdas_equal_reference(em, chunk_size):
+    expected = reference_lambdas(em)
+    em.chunk_size = chunk_size
+    em.recompute_lambdas()
+    np.testing.assert_allclose(em.lambdas, expected, rtol=1e-7, atol=1e-10)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_psis_equal_reference(em, chunk_size):
+    em.chunk_size = chunk_size
+    psis, = em.full_psis()
+    np.testing.assert_allclose(psis, reference_psis(em), rtol=1e-7,
+                               atol=1e-12)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_patch_chunks_cover_patches_once(chunk_size):
+    counts = np.array([3, 1, 3, 2, 3, 3, 1])
+    for candidate_counts in [None, counts]:
+        covered = np.zeros(len(counts), dtype=int)
+        for chunk in likelihood.patch_chunks(len(counts), chunk_size,
+                                             candidate_counts):
+            covered[chunk] += 1
+            assert len(covered[chunk]) <= chunk_size
+            if candidate_counts is not None:
+                assert len(np.unique(candidate_counts[chunk])) == 1
+        assert np.all(covered == 1)
+
+
+def restored_em(em, state):
+    search = candidates.PrecomputedSearch(em.candidate_indices,
+                                          em.candidate_distances)
+    return EM(em.patches, em.num_candidates, em.num_transformations,
+              em.lbp_params, "id", candidate_search=search, state=state)
+
+
+def test_state_replaces_attributes(em):
+    restored = restored_em(em, {
+        "probs": em.probs, "lambdas": em.lambdas, "iteration": np.array(3),
+    })
+    assert np.array_equal(restored.probs, em.probs)
+    assert np.array_equal(restored.lambdas, em.lambdas)
+    assert restored.iteration == 3 and isinstance(restored.iteration, int)
+
+
+def test_unknown_state_is_rejected(em):
+    with pytest.raises(ValueError):
+        restored_em(em, {"prob": em.probs})
+
+
+def test_diagonal_psis_are_diagonals_of_full(em):
+    full, = em.full_psis()
+    variances, = em.diagonal_psis()
+    np.testing.assert_allclose(variances,
+                               np.diagonal(full, axis1=1, axis2=2),
+                               rtol=1e-10)
+
+
+def test_shared_psis_average_full(em):
+    full, = em.full_psis()
+    weights = np.sum(em.probs, axis=(1, 2))
+    covariance, = em.shared_psis()
+    np.testing.assert_allclose(
+        covariance, np.tensordot(weights, full, axes=1) / np.sum(weights),
+        rtol=1e-10)
+
+
+@pytest.mark.parametrize("rank", [3, 10])
+def test_low_rank_psis_restrict_full(em, rank):
+    # With rank == pca_k, variances are the full covariances in the basis
+    # and the residual is none.
+    em.covariance_rank = rank
+    full, = em.full_psis()
+    basis, variances, residual_variances = em.low_rank_psis()
+    restricted = np.matmul(np.matmul(basis.T, full), basis)
+    np.testing.assert_allclose(
+        variances, np.diagonal(restricted, axis1=1, axis2=2), rtol=1e-10)
+    np.testing.assert_allclose(
+        residual_variances * (em.patches.pca_k - rank),
+        np.trace(full, axis1=1, axis2=2) - np.sum(variances, axis=1),
+        rtol=1e-8, atol=1e-12)
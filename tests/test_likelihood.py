@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+import likelihood
+
+# Factors of the diagonal, low-rank and shared covariance structures are
+# compared with CovarianceFactors of the full covariance matrices they
+# stand for.
+
+PATCHES, DIM, N = 5, 6, 7
+
+
+def assert_factors_equal(factors, full_factors):
+    diffs = np.random.RandomState(1).randn(PATCHES, N, DIM)
+    chunk = slice(1, 4)
+    np.testing.assert_allclose(factors.squared_distances(diffs[chunk], chunk),
+                               full_factors.squared_distances(diffs[chunk],
+                                                              chunk),
+                               rtol=1e-10)
+    np.testing.assert_allclose(
+        np.broadcast_to(factors.log_pseudo_determinants, [PATCHES]),
+        full_factors.log_pseudo_determinants, rtol=1e-10, atol=1e-12)
+    assert np.array_equal(np.broadcast_to(factors.ranks, [PATCHES]),
+                          full_factors.ranks)
+
+
+def test_diagonal_factors_equal_full():
+    variances = np.random.RandomState(0).rand(PATCHES, DIM) + 0.1
+    # A singular covariance, the zero variance is cut off.
+    variances[2, 3] = 0
+    full = np.zeros([PATCHES, DIM, DIM])
+    full[:, np.arange(DIM), np.arange(DIM)] = variances
+    assert_factors_equal(likelihood.DiagonalCovarianceFactors(variances),
+                         likelihood.CovarianceFactors(full))
+
+
+@pytest.mark.parametrize("rank", [1, 3, DIM])
+def test_low_rank_factors_equal_full(rank):
+    rng = np.random.RandomState(0)
+    orthonormal, _ = np.linalg.qr(rng.randn(DIM, DIM))
+    basis = orthonormal[:, :rank]
+    variances = rng.rand(PATCHES, rank) + 0.1
+    residual_variances = (rng.rand(PATCHES) + 0.1 if rank < DIM
+                          else np.zeros(PATCHES))
+    complement = np.eye(DIM) - np.matmul(basis, basis.T)
+    full = (np.matmul(basis * variances[:, np.newaxis, :], basis.T) +
+            residual_variances[:, np.newaxis, np.newaxis] * complement)
+    assert_factors_equal(
+        likelihood.LowRankCovarianceFactors(basis, variances,
+                                            residual_variances),
+        likelihood.CovarianceFactors(full))
+
+
+def test_shared_factors_equal_full():
+    matrix = np.random.RandomState(0).randn(DIM, DIM)
+    covariance = np.matmul(matrix, matrix.T)
+    assert_factors_equal(
+        likelihood.SharedCovarianceFactors(covariance),
+        likelihood.CovarianceFactors(np.repeat(covariance[np.newaxis],
+                                               PATCHES, axis=0)))
@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+
+loopy = pytest.importorskip("loopy")
+
+# Grid larger than one random tree: a tree covers only a part of the directed
+# edges, so every iteration updates some messages for the first time.
+ROWS, COLS, K = 15, 15, 16
+
+
+def run(potentials, priors, schedule, iterations, tolerance, log_domain=False):
+    state = loopy.LoopyState(ROWS, COLS, potentials, log_domain=log_domain)
+    state.update_priors(priors)
+    result = np.empty(priors.shape)
+    statistics = state.run(iterations, 0, result, schedule=schedule,
+                           tolerance=tolerance)
+    return statistics, result
+
+
+@pytest.mark.parametrize("log_domain", [False, True])
+@pytest.mark.parametrize("schedule", ["tree", "checkerboard", "residual"])
+def test_uniform_potentials_stop_after_one_iteration(schedule, log_domain):
+    # Messages of uniform potentials stay uniform, so no message changes.
+    potentials = np.full([ROWS * COLS, 2 * K * K], 0.0 if log_domain else 1.0)
+    priors = np.random.RandomState(0).dirichlet(np.ones(K), ROWS * COLS)
+    statistics, result = run(potentials, priors, schedule, 8, 1e-9, log_domain)
+    assert statistics["iterations"] == 1
+    assert statistics["max_residual"] < 1e-9
+    np.testing.assert_allclose(result, priors)
+
+
+@pytest.mark.parametrize("schedule", ["tree", "checkerboard", "residual"])
+def test_tolerance_stops_before_iteration_limit(schedule):
+    rng = np.random.RandomState(0)
+    potentials = np.exp(-3 * rng.rand(ROWS * COLS, 2 * K * K))
+    priors = rng.dirichlet(np.ones(K), ROWS * COLS)
+    statistics, _ = run(potentials, priors, schedule, 100, 1e-3)
+    assert statistics["iterations"] < 100
+    assert statistics["max_residual"] < 1e-3
+    assert statistics["mean_residual"] <= statistics["max_residual"]
+
+
+@pytest.mark.parametrize("threads", [2, 3, 0])
+def test_checkerboard_does_not_depend_on_threads(threads):
+    rng = np.random.RandomState(0)
+    potentials = np.exp(-3 * rng.rand(ROWS * COLS, 2 * K * K))
+    priors = rng.dirichlet(np.ones(K), ROWS * COLS)
+    state = loopy.LoopyState(ROWS, COLS, potentials)
+    state.update_priors(priors)
+    single, parallel = np.empty(priors.shape), np.empty(priors.shape)
+    state.run(5, 0, single, schedule="checkerboard", threads=1)
+    state.reset_messages()
+    state.run(5, 0, parallel, schedule="checkerboard", threads=threads)
+    assert np.array_equal(single, parallel)
+
+
+@pytest.fixture
+def patches(tmp_path):
+    from PIL import Image
+    from experiment import prepare_argument_parser, create_patches
+
+    rng = np.random.RandomState(0)
+    paths = []
+    for name, size in [("input.png", 40), ("source.png", 60)]:
+        paths.append(str(tmp_path / name))
+        Image.fromarray(rng.randint(0, 256, [size, size, 3]).astype(
+            np.uint8)).save(paths[-1])
+    args = prepare_argument_parser().parse_args([
+        "-input=" + paths[0], "-source=" + paths[1],
+        "-output=" + str(tmp_path), "-patch_size=8", "-patch_overlap=2",
+        "-pca_k=10",
+    ])
+    return create_patches(args)
+
+
+def candidates_and_priors(patches, k=6):
+    import candidates
+    indices, distances = candidates.nearest_candidates(
+        patches.compact_observed_vectors, patches.compact_dictionary_vectors, k)
+    priors = np.exp(-0.5 * (distances - distances.min(axis=1, keepdims=True)))
+    return indices, priors / np.sum(priors, axis=1, keepdims=True)
+
+
+def run_on_patches(patches, indices, priors, two_sigma2, iterations,
+                   precision="float64"):
+    from em import pairwise_potentials
+    potentials = pairwise_potentials(patches, indices, two_sigma2, precision)
+    rows, cols = patches.observed_grid_size
+    state = loopy.LoopyState(rows, cols, potentials,
+                             log_domain=(precision == "log"))
+    state.update_priors(priors)
+    result = np.empty(priors.shape)
+    state.run(iterations, 0, result, schedule="tree")
+    return result
+
+
+def test_buffers_equal_text_files(patches, tmp_path):
+    from em import loopy_belief_propagation_via_files
+    indices, priors = candidates_and_priors(patches)
+    lbp_params = {"two_sigma2": 0.5, "output_dir": str(tmp_path),
+                  "iterations": 5, "seed": 0}
+    expected = loopy_belief_propagation_via_files(
+        patches, indices, priors, lbp_params)
+    result = run_on_patches(patches, indices, priors, 0.5, 5)
+    # Results are written to the text file with 6 significant digits.
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-12)
+
+
+def test_potential_tables_equal_overlap_distances(patches):
+    from em import pairwise_potentials
+    indices, _ = candidates_and_priors(patches)
+    potentials = pairwise_potentials(patches, indices, 0.5)
+    rows, cols = patches.observed_grid_size
+    size, overlap = patches.patch_size, patches.patch_overlap
+    pixels = patches.dictionary_pixel_values.reshape([-1, size, size]) / 255
+    # Regions of a patch and of its right and bottom neighbour.
+    regions = [
+        (lambda a: a[:, size - overlap:], lambda b: b[:, :overlap], 1),
+        (lambda a: a[size - overlap:, :], lambda b: b[:overlap, :], cols),
+    ]
+    k = indices.shape[1]
+    for p in range(rows * cols):
+        for direction, (region, neighbour_region, step) in enumerate(regions):
+            table = potentials[p, direction * k * k:(direction + 1) * k * k]
+            if (direction == 0 and p % cols == cols - 1 or
+                    direction == 1 and p // cols == rows - 1):
+                assert np.all(table == 0)
+                continue
+            for i in range(k):
+                for j in range(k):
+                    # Mean squared difference of overlapping pixels.
+                    distance = np.mean((
+                        region(pixels[indices[p, i]]) -
+                        neighbour_region(pixels[indices[p + step, j]])) ** 2)
+                    np.testing.assert_allclose(
+                        table[i * k + j], np.exp(-distance / 0.5), rtol=1e-12)
+
+
+def test_precisions_agree(patches):
+    indices, priors = candidates_and_priors(patches)
+    results = {
+        precision: run_on_patches(patches, indices, priors, 0.5, 5, precision)
+        for precision in ["float32", "float64", "longdouble", "log"]
+    }
+    for precision, result in results.items():
+        np.testing.assert_allclose(result, results["float64"], atol=(
+            1e-5 if precision == "float32" else 1e-10))
@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("loopy")
+from PIL import Image
+
+from experiment import prepare_argument_parser, set_up_experiment, run_em
+from metrics import Metrics, read_metrics, summarize
+
+# Phases of an iteration, in order, without pruning.
+ITERATION_PHASES = [
+    "loopy", "compute_posteriors", "recompute_lambdas", "recompute_psis",
+    "compute_posteriors", "reconstruction", "log_posterior",
+]
+
+
+@pytest.fixture
+def records(tmp_path):
+    rng = np.random.RandomState(0)
+    paths = []
+    for name, size in [("input.png", 40), ("source.png", 60)]:
+        paths.append(str(tmp_path / name))
+        Image.fromarray(rng.randint(0, 256, [size, size, 3]).astype(
+            np.uint8)).save(paths[-1])
+    args = prepare_argument_parser().parse_args([
+        "-input=" + paths[0], "-source=" + paths[1],
+        "-output=" + str(tmp_path), "-patch_size=8", "-patch_overlap=2",
+        "-pca_k=10", "-num_candidates=6", "-em_iterations=2", "-metrics",
+    ])
+    _, em = set_up_experiment(args)
+    run_em(args, em)
+    return read_metrics(os.path.join(str(tmp_path), "metrics.jsonl"))
+
+
+def test_iterations_emit_their_phases(records):
+    for iteration in [1, 2]:
+        phases = [record["phase"] for record in records
+                  if record.get("iteration") == iteration and
+                  record["phase"] != "pairwise_potentials"]
+        assert phases == ITERATION_PHASES
+    for record in records:
+        assert record["wall_seconds"] >= 0 and record["cpu_seconds"] >= 0
+        assert record["max_rss_mb"] > 0
+
+
+def test_loopy_counters(records):
+    k = 6
+    for record in records:
+        if record["phase"] == "loopy":
+            statistics = record["lbp"]
+            assert len(statistics["iteration_seconds"]) == \
+                statistics["iterations"]
+            assert statistics["messages"] > 0
+            # Each message sums k potentials for each of its k elements.
+            assert statistics["potentials"] == statistics["messages"] * k * k
+            # Float64 probs of 36 patches, k candidates and 3 transformations.
+            assert record["array_bytes"]["probs"] == 36 * k * 3 * 8
+
+
+def test_records_round_trip_through_json_lines(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    received = []
+    metrics = Metrics(path, callbacks=[received.append], fields={"level": 1})
+    for iteration in [1, 2]:
+        with metrics.phase("loopy", iteration=iteration) as record:
+            record["sizes"] = np.arange(3)
+            record["count"] = np.int64(4)
+    with pytest.raises(RuntimeError):
+        with metrics.phase("failed"):
+            raise RuntimeError()
+
+    records = read_metrics(path)
+    assert [record["phase"] for record in records] == ["loopy", "loopy"]
+    assert [record["iteration"] for record in records] == [1, 2]
+    assert records[0]["level"] == 1
+    assert records[0]["sizes"] == [0, 1, 2] and records[0]["count"] == 4
+    assert len(received) == 2 and received[1]["time"] == records[1]["time"]
+
+
+def test_summarize():
+    records = [
+        {"phase": "loopy", "wall_seconds": 1.0, "cpu_seconds": 2.0},
+        {"phase": "recompute_psis", "wall_seconds": 0.5, "cpu_seconds": 0.5},
+        {"phase": "loopy", "wall_seconds": 3.0, "cpu_seconds": 1.0},
+    ]
+    assert summarize(records) == {
+        "loopy": {"count": 2, "wall_seconds": 4.0, "cpu_seconds": 3.0},
+        "recompute_psis": {"count": 1, "wall_seconds": 0.5,
+                           "cpu_seconds": 0.5},
+    }
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("loopy")
+import patches
+
+# Strided extraction and blending of patches are compared with the original
+# loops over patch positions.
+
+
+def reference_image_to_patches(image, patch_size, overlap):
+    step = patch_size - overlap
+    height, width = np.shape(image)
+    result = []
+    for y in range(0, height - patch_size + 1, step):
+        for x in range(0, width - patch_size + 1, step):
+            result.append(image[y:(y + patch_size), x:(x + patch_size)])
+    return np.array(result)
+
+
+def reference_plot_patch_vectors(vectors, grid_shape, overlap):
+    patch_size = round(vectors.shape[1] ** 0.5)
+    patches_in_col, patches_in_row = grid_shape
+    step = patch_size - overlap
+    out_width = patches_in_row * step + overlap
+    out_height = patches_in_col * step + overlap
+
+    image = np.zeros([out_height, out_width])
+    weights = np.zeros([out_height, out_width])
+    p = 0
+    for y in range(0, out_height - patch_size + 1, step):
+        for x in range(0, out_width - patch_size + 1, step):
+            patch = vectors[p].reshape([patch_size, patch_size])
+            image[y:(y + patch_size), x:(x + patch_size)] += patch
+            weights[y:(y + patch_size), x:(x + patch_size)] += 1
+            p += 1
+    if overlap > 0:
+        image = np.divide(image, weights)
+    return image
+
+
+# Overlaps of more than half of a patch need more than two phases, negative
+# ones separate patches.
+@pytest.mark.parametrize("overlap", [0, 1, 3, 5, -2])
+def test_extraction_and_blending_equal_loops(overlap):
+    patch_size = 8
+    image = np.random.RandomState(0).rand(37, 30)
+    if overlap >= 0:
+        extracted = patches.image_to_patches(image, patch_size, overlap)
+        assert np.array_equal(
+            extracted, reference_image_to_patches(image, patch_size, overlap))
+
+    grid_shape = [5, 4]
+    vectors = np.random.RandomState(1).rand(20, patch_size * patch_size)
+    np.testing.assert_allclose(
+        patches.plot_patch_vectors(vectors, grid_shape, overlap),
+        reference_plot_patch_vectors(vectors, grid_shape, overlap),
+        rtol=1e-12)
+
+
+@pytest.mark.parametrize("overlap", [0, 2, 5])
+def test_blending_extracted_patches_gives_the_image(overlap):
+    patch_size = 8
+    image = np.random.RandomState(0).rand(37, 30)
+    grid_shape = patches.rows_cols_of_patches_in_image(
+        image, patch_size, overlap)
+    blended = patches.plot_patch_vectors(
+        patches.patches_to_vectors(
+            patches.image_to_patches(image, patch_size, overlap)),
+        grid_shape, overlap)
+    np.testing.assert_allclose(blended, image[:blended.shape[0],
+                                              :blended.shape[1]], rtol=1e-12)
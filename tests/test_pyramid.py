@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("loopy")
+from PIL import Image
+
+from experiment import (prepare_argument_parser, create_patches, create_em,
+                        create_candidate_search)
+from pyramid import add_pyramid_arguments, create_levels, refine
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.RandomState(0)
+    paths = []
+    for name, size in [("input.png", 60), ("source.png", 60)]:
+        paths.append(str(tmp_path / name))
+        Image.fromarray(rng.randint(0, 256, [size, size, 3]).astype(
+            np.uint8)).save(paths[-1])
+    return paths
+
+
+@pytest.mark.parametrize("precision", ["float64", "log"])
+def test_inherited_messages_are_normalized(images, tmp_path, precision):
+    argparser = prepare_argument_parser()
+    add_pyramid_arguments(argparser)
+    args = argparser.parse_args([
+        "-input=" + images[0], "-source=" + images[1],
+        "-output=" + str(tmp_path), "-patch_size=8", "-patch_overlap=2",
+        "-pca_k=10", "-num_candidates=6", "-lbp_precision=" + precision,
+    ])
+    np.random.seed(args.random_seed)
+    coarse_patches, patches = create_levels(args, create_patches(args), 2)
+    coarse_em = create_em(args, coarse_patches, create_candidate_search(args))
+    coarse_em.execute_iteration()
+
+    em = refine(args, coarse_em, patches)
+    # Messages the first loopy run of the finer level starts from.
+    messages = em.initial_lbp_messages.reshape([patches.patch_count, 4, -1])
+    if precision == "log":
+        messages = np.exp(messages)
+    np.testing.assert_allclose(np.sum(messages, axis=-1), 1)
+    assert np.all(messages > 0)
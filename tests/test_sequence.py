@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("loopy")
+from PIL import Image
+
+from experiment import (prepare_argument_parser, prepare_style_model,
+                        create_style_model_search, create_patches, create_em)
+from sequence import add_sequence_arguments, changed_patches, follow
+from style_model import StyleModel
+
+
+@pytest.fixture
+def frames(tmp_path):
+    rng = np.random.RandomState(0)
+    source = rng.randint(0, 256, [60, 60, 3]).astype(np.uint8)
+    first = rng.randint(0, 256, [40, 40, 3]).astype(np.uint8)
+    # The second frame differs in its top left corner.
+    second = first.copy()
+    second[:14, :14] = rng.randint(0, 256, [14, 14, 3])
+    paths = []
+    for name, image in [("source.png", source), ("first.png", first),
+                        ("second.png", second)]:
+        paths.append(str(tmp_path / name))
+        Image.fromarray(image).save(paths[-1])
+    return paths
+
+
+@pytest.fixture
+def args(frames, tmp_path):
+    argparser = prepare_argument_parser()
+    add_sequence_arguments(argparser)
+    args = argparser.parse_args([
+        "-input=" + frames[1], "-source=" + frames[0],
+        "-output=" + str(tmp_path), "-patch_size=8", "-patch_overlap=2",
+        "-pca_k=10", "-num_candidates=6",
+    ])
+    prepare_style_model(args)
+    return args
+
+
+def followed_frame(args, path):
+    style_model = StyleModel(args.style_model)
+    search = create_style_model_search(args, style_model)
+    np.random.seed(args.random_seed)
+    previous_em = create_em(
+        args, create_patches(args, style_model=style_model), search)
+    previous_em.execute_iteration()
+
+    args.input = path
+    patches = create_patches(args, style_model=style_model)
+    em, changed_count = follow(args, previous_em, patches, search)
+    return previous_em, em, search, changed_count
+
+
+def test_changed_patches_are_searched_again(args, frames):
+    previous_em, em, search, changed_count = followed_frame(args, frames[2])
+    changed = changed_patches(em.patches, previous_em.patches,
+                              args.change_threshold)
+    assert changed_count == np.sum(changed)
+    assert 0 < changed_count < em.patches.patch_count
+
+    # Unchanged patches keep candidates, posteriors and loopy messages.
+    kept = ~changed
+    assert np.array_equal(em.candidate_indices[kept],
+                          previous_em.candidate_indices[kept])
+    assert np.array_equal(em.probs[kept], previous_em.probs[kept])
+    assert np.array_equal(em.loopy_probs[kept], previous_em.loopy_probs[kept])
+    messages = em.initial_lbp_messages.reshape([em.patches.patch_count, 4, -1])
+    assert np.array_equal(messages[kept], previous_em.loopy_messages()[kept])
+
+    # Changed patches have candidates of a new search and uniform messages.
+    observed_vectors = em.patches.compact_observed_vectors
+    indices, _ = search.search(observed_vectors[changed], args.num_candidates)
+    assert np.array_equal(em.candidate_indices[changed], indices)
+    assert not np.array_equal(indices, previous_em.candidate_indices[changed])
+    np.testing.assert_allclose(messages[changed], 1 / args.num_candidates)
+
+    # Distances of all candidates are to the vectors of the new frame.
+    dictionary_vectors = em.patches.compact_dictionary_vectors
+    np.testing.assert_allclose(
+        em.candidate_distances,
+        np.sum((dictionary_vectors[em.candidate_indices] -
+                observed_vectors[:, np.newaxis]) ** 2, axis=-1))
+
+
+def test_same_frame_keeps_everything(args, frames):
+    previous_em, em, _, changed_count = followed_frame(args, frames[1])
+    assert changed_count == 0
+    assert np.array_equal(em.candidate_indices, previous_em.candidate_indices)
+    assert np.array_equal(em.probs, previous_em.probs)
+    assert em.potentials is previous_em.potentials
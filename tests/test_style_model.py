@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("loopy")
+from PIL import Image
+
+import candidates
+from style_model import compile_style_model, StyleModel
+
+
+@pytest.mark.parametrize("backend", [
+    lambda: None,
+    lambda: candidates.ExactSearch(block_size=8),
+    lambda: candidates.KDTreeSearch(leaf_size=4),
+    lambda: candidates.IVFSearch(lists=4, probes=2),
+])
+def test_loaded_model_equals_compiled_one(tmp_path, backend):
+    rng = np.random.RandomState(0)
+    source_path = str(tmp_path / "source.png")
+    Image.fromarray(rng.randint(0, 256, [60, 60, 3]).astype(np.uint8)).save(
+        source_path)
+    model_path = str(tmp_path / "style.model")
+    compiled_search = backend()
+    compile_style_model(source_path, model_path, patch_size=8,
+                        patch_overlap=2, pca_k=10, color="yiq",
+                        candidate_search=compiled_search, random_state=0)
+    model = StyleModel(model_path)
+
+    np.testing.assert_allclose(model.pca.transform(model.dictionary_vectors),
+                               model.compact_dictionary_vectors, atol=1e-9)
+    if compiled_search is None:
+        assert model.search_index is None
+        return
+    assert type(model.search_index) == type(compiled_search)
+    observed_vectors = rng.randn(20, 10)
+    indices, distances = model.search_index.search(observed_vectors, 6)
+    expected_indices, expected_distances = compiled_search.search(
+        observed_vectors, 6)
+    assert np.array_equal(indices, expected_indices)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-12)
@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("loopy")
+from experiment import prepare_argument_parser
+from sweep import parse_sweep, point_name, stage_key, sweep_points
+
+ARGV = ["-input=in.png", "-source=source.png"]
+
+
+def test_parse_sweep():
+    assert parse_sweep("-lbp_two_sigma2=0.1,1") == ("lbp_two_sigma2", ["0.1", "1"])
+
+
+def test_points_are_the_cartesian_product_of_parsed_values():
+    points = sweep_points(prepare_argument_parser(), ARGV, [
+        ("lbp_two_sigma2", ["0.1", "1"]),
+        ("init_transformations", ["id", "rand"]),
+    ])
+    assert [point_name(overrides) for overrides, _ in points] == [
+        "lbp_two_sigma2=0.1_init_transformations=id",
+        "lbp_two_sigma2=0.1_init_transformations=rand",
+        "lbp_two_sigma2=1_init_transformations=id",
+        "lbp_two_sigma2=1_init_transformations=rand",
+    ]
+    assert [(args.lbp_two_sigma2, args.init_transformations)
+            for _, args in points] == [
+        (0.1, "id"), (0.1, "rand"), (1.0, "id"), (1.0, "rand")]
+    assert all(args.input == "in.png" for _, args in points)
+
+
+def test_flags_are_set_from_boolean_values():
+    points = sweep_points(prepare_argument_parser(), ARGV,
+                          [("lbp_warm_start", ["true", "0"])])
+    assert [args.lbp_warm_start for _, args in points] == [True, False]
+
+
+def test_unknown_and_invalid_values_are_rejected():
+    with pytest.raises(ValueError):
+        sweep_points(prepare_argument_parser(), ARGV, [("no_such", ["1"])])
+    with pytest.raises(SystemExit):
+        sweep_points(prepare_argument_parser(), ARGV,
+                     [("lbp_schedule", ["no_such_schedule"])])
+
+
+def test_points_share_stages_they_agree_on():
+    points = sweep_points(prepare_argument_parser(), ARGV, [
+        ("lbp_two_sigma2", ["0.1", "1"]), ("num_candidates", ["8", "16"]),
+    ])
+    args = [point_args for _, point_args in points]
+    assert len(set(stage_key(point_args, 0) for point_args in args)) == 1
+    assert len(set(stage_key(point_args, 1) for point_args in args)) == 2
+    assert len(set(stage_key(point_args, 2) for point_args in args)) == 4
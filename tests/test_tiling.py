@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("loopy")
+from PIL import Image
+
+from experiment import prepare_argument_parser, set_up_experiment, run_em
+from patches import vectors_to_pixel_values
+from tiling import split_grid, translate_tiled, write_png
+
+
+def test_tiles_cover_the_grid_once():
+    tiles = split_grid([10, 7], 4, 2)
+    covered = np.zeros([10, 7], dtype=int)
+    for tile in tiles:
+        covered[tile.row_start:tile.row_end, tile.col_start:tile.col_end] += 1
+        assert tile.halo_row_start == max(tile.row_start - 2, 0)
+        assert tile.halo_col_end == min(tile.col_end + 2, 7)
+    assert len(tiles) == 6 and np.all(covered == 1)
+
+
+@pytest.mark.parametrize("shape", [[30, 7], [30, 7, 3]])
+def test_png_written_in_strips(tmp_path, shape):
+    image = np.random.RandomState(0).randint(0, 256, shape).astype(np.uint8)
+    path = str(tmp_path / "image.png")
+    write_png(path, image, strip_rows=4)
+    assert np.array_equal(np.array(Image.open(path)), image)
+
+
+def test_single_tile_equals_whole_image(tmp_path):
+    rng = np.random.RandomState(0)
+    paths = []
+    for name, size in [("input.png", 40), ("source.png", 60)]:
+        paths.append(str(tmp_path / name))
+        Image.fromarray(rng.randint(0, 256, [size, size, 3]).astype(
+            np.uint8)).save(paths[-1])
+    # Identity transformations do not depend on the order of random draws.
+    argv = ["-input=" + paths[0], "-patch_size=8", "-patch_overlap=2",
+            "-pca_k=10", "-num_candidates=6", "-em_iterations=2",
+            "-color=yiq", "-init_transformations=id"]
+
+    argparser = prepare_argument_parser()
+    argparser.add_argument("-tile_size", type=int, default=100)
+    argparser.add_argument("-tile_halo", type=int, default=4)
+    argparser.add_argument("-workers", type=int, default=1)
+    tiled_args = argparser.parse_args(
+        argv + ["-source=" + paths[1], "-output=" + str(tmp_path / "tiled")])
+    tiled_log_posteriors = translate_tiled(tiled_args)
+
+    # The same style model, compiled by the tiled translation.
+    args = prepare_argument_parser().parse_args(argv + [
+        "-style_model=" + tiled_args.style_model,
+        "-output=" + str(tmp_path / "whole")])
+    _, em = set_up_experiment(args)
+    log_posteriors = run_em(args, em)
+
+    np.testing.assert_allclose(tiled_log_posteriors[-1], log_posteriors[-1])
+    assert np.array_equal(np.load(str(tmp_path / "tiled" / "MAP.npy")),
+                          vectors_to_pixel_values(em.MAP_image()))